@@ -0,0 +1,2 @@
+"""Modules shared by the pipeline, report and dashboard images.
+Each image installs this package, so there is one copy of each module to change"""
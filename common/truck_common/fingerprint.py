@@ -0,0 +1,129 @@
+"""Detects when the dimension tables have changed, so unchanged ones aren't moved again.
+Extract probes each table with MySQL's CHECKSUM TABLE, and load hashes the cleaned
+table's contents. Both are stored in a _fingerprint.json beside the table's parquet
+file, which Athena skips as it starts with an underscore"""
+import json
+from hashlib import sha256
+from os import path, remove, replace
+from tempfile import NamedTemporaryFile
+import boto3
+import pandas as pd
+import awswrangler as wr
+from pymysql import Connection
+from pymysql.err import Error
+
+DIMENSION_TABLES = {
+    "truck": 'DIM_Truck',
+    "payment_method": 'DIM_Payment_Method'
+}
+DEFAULT_BASE_PATH = 's3://c20-sami-truck-s3-bucket/input/'
+FINGERPRINT_FILENAME = '_fingerprint.json'
+PENDING_CHECKSUMS_PATH = 'data/pending_checksums.json'
+
+
+def read_json(location: str) -> dict | None:
+    """Returns the json object stored locally or on S3, or None if there isn't one"""
+    if location.startswith('s3://'):
+        bucket, _, key = location.removeprefix('s3://').partition('/')
+        s3_client = boto3.client('s3')
+        try:
+            return json.loads(s3_client.get_object(Bucket=bucket, Key=key)['Body'].read())
+        except s3_client.exceptions.NoSuchKey:
+            return None
+
+    if not path.exists(location):
+        return None
+    with open(location, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def write_json(body: dict, location: str) -> None:
+    """Saves the json object locally or on S3, replacing any old one in one step"""
+    if location.startswith('s3://'):
+        bucket, _, key = location.removeprefix('s3://').partition('/')
+        boto3.client('s3').put_object(Bucket=bucket, Key=key,
+                                      Body=json.dumps(body).encode('utf-8'))
+        return
+
+    with NamedTemporaryFile('w', encoding='utf-8', delete=False,
+                            dir=path.dirname(location) or '.') as f:
+        json.dump(body, f)
+    replace(f.name, location)
+
+
+def get_fingerprint_path(table: str, base_path: str = DEFAULT_BASE_PATH) -> str:
+    """Returns where the fingerprint of a loaded table is kept"""
+    return f'{base_path}{table}/{FINGERPRINT_FILENAME}'
+
+
+def get_loaded_table_path(table: str, base_path: str = DEFAULT_BASE_PATH) -> str:
+    """Returns the parquet file a dimension table is loaded to"""
+    return f'{base_path}{table}/{table}.parquet'
+
+
+def get_source_checksum(conn: Connection, source_table: str) -> str | None:
+    """Returns MySQL's checksum of the table, or None if it can't be worked out"""
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute(f'CHECKSUM TABLE {source_table};')
+            row = cursor.fetchone()
+    except Error as e:
+        print(f'Could not checksum {source_table}: {e}')
+        return None
+
+    return None if row is None or row[1] is None else str(row[1])
+
+
+def get_content_hash(df: pd.DataFrame) -> str:
+    """Returns a hash of the table's columns, types and values"""
+    content = sha256(json.dumps([list(df.columns), df.dtypes.astype(str).tolist()]).encode())
+    content.update(pd.util.hash_pandas_object(df, index=False).to_numpy().tobytes())
+
+    return content.hexdigest()
+
+
+def find_unchanged_tables(conn: Connection, base_path: str = DEFAULT_BASE_PATH) -> list[str]:
+    """Returns the dimension tables whose source checksum matches the one last loaded.
+    The checksums are staged for load to store once the tables are uploaded"""
+    checksums = {
+        table: get_source_checksum(conn, source_table)
+        for table, source_table in DIMENSION_TABLES.items()
+    }
+    write_json(checksums, PENDING_CHECKSUMS_PATH)
+
+    return [
+        table for table, checksum in checksums.items()
+        if checksum is not None
+        and read_fingerprint(table, base_path).get('source_checksum') == checksum
+    ]
+
+
+def read_loaded_table(table: str, base_path: str = DEFAULT_BASE_PATH) -> pd.DataFrame:
+    """Returns the copy of a dimension table that was last loaded"""
+    location = get_loaded_table_path(table, base_path)
+    if location.startswith('s3://'):
+        return wr.s3.read_parquet(location)
+
+    return pd.read_parquet(location)
+
+
+def get_fingerprint(df: pd.DataFrame, table: str) -> dict:
+    """Returns the fingerprint to store for the cleaned table, with the checksum extract staged"""
+    checksums = read_json(PENDING_CHECKSUMS_PATH) or {}
+    return {"content_hash": get_content_hash(df), "source_checksum": checksums.get(table)}
+
+
+def read_fingerprint(table: str, base_path: str = DEFAULT_BASE_PATH) -> dict:
+    """Returns the fingerprint of the loaded copy of the table, empty if there isn't one"""
+    return read_json(get_fingerprint_path(table, base_path)) or {}
+
+
+def write_fingerprint(table: str, fingerprint: dict, base_path: str = DEFAULT_BASE_PATH) -> None:
+    """Stores the fingerprint of the table that has just been loaded"""
+    write_json(fingerprint, get_fingerprint_path(table, base_path))
+
+
+def clear_pending_checksums() -> None:
+    """Removes the checksums staged by extract once load has stored them"""
+    if path.exists(PENDING_CHECKSUMS_PATH):
+        remove(PENDING_CHECKSUMS_PATH)
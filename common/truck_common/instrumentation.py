@@ -0,0 +1,109 @@
+"""Records how long each pipeline stage took and how much it processed.
+Each stage emits one json line with its wall and CPU time, peak RSS, rows in and
+out, bytes read and written and anything else the stage adds, to stdout or the
+file in METRICS_PATH. The peak RSS is the stage's own, found by resetting Linux's
+high-water mark when it starts, and is left empty where that can't be done.
+Set PROFILE_DIR to also write a cProfile of each run of a stage there"""
+import cProfile
+import json
+from collections.abc import Iterator
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from os import environ, makedirs, path
+from time import perf_counter, process_time
+from uuid import uuid4
+
+METRICS_PATH = environ.get('METRICS_PATH')
+PROFILE_DIR = environ.get('PROFILE_DIR')
+# The running peak RSS in kB of each stage still open, so a stage that starts inside
+# another and resets the high-water mark doesn't lose the outer stage's peak
+open_stage_peaks = {}
+
+
+def emit_metrics(metrics: dict) -> None:
+    """Writes the metrics as one json line to METRICS_PATH, or prints it if that isn't set"""
+    line = json.dumps(metrics, default=str)
+    if METRICS_PATH is None:
+        print(line)
+        return
+
+    with open(METRICS_PATH, 'a', encoding='utf-8') as f:
+        f.write(line + '\n')
+
+
+def read_peak_rss_kb() -> int | None:
+    """Returns the process's RSS high-water mark in kB since it was last reset,
+    or None where /proc isn't available"""
+    try:
+        with open('/proc/self/status', encoding='utf-8') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+def reset_peak_rss() -> bool:
+    """Resets the RSS high-water mark to the current RSS. Returns False if it can't be"""
+    try:
+        with open('/proc/self/clear_refs', 'w', encoding='utf-8') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def update_open_stage_peaks() -> None:
+    """Folds the high-water mark so far into the peak of every open stage"""
+    peak_kb = read_peak_rss_kb()
+    if peak_kb is not None:
+        for key, stage_peak_kb in list(open_stage_peaks.items()):
+            if stage_peak_kb is not None:
+                open_stage_peaks[key] = max(stage_peak_kb, peak_kb)
+
+
+def get_frame_bytes(df) -> int:
+    """Returns the memory a dataframe's values take up, including the strings"""
+    return int(df.memory_usage(deep=True).sum())
+
+
+@contextmanager
+def stage(name: str, **fields) -> Iterator[dict]:
+    """Times the code run inside it as the named stage and emits its metrics when it ends.
+    The yielded dict can be given rows_in, rows_out, bytes_read, bytes_written or any
+    other values to report. cProfile only follows the thread that enters the stage"""
+    started_at = datetime.now(timezone.utc)
+    metrics = {"stage": name, "started_at": started_at.isoformat(),
+               "rows_in": None, "rows_out": None, "bytes_read": None, "bytes_written": None,
+               **fields}
+    profiler = cProfile.Profile() if PROFILE_DIR else None
+    stage_key = uuid4().hex
+    update_open_stage_peaks()
+    open_stage_peaks[stage_key] = read_peak_rss_kb() if reset_peak_rss() else None
+    start_wall = perf_counter()
+    start_cpu = process_time()
+    status = 'error'
+
+    if profiler:
+        profiler.enable()
+    try:
+        yield metrics
+        status = 'ok'
+    finally:
+        if profiler:
+            profiler.disable()
+            makedirs(PROFILE_DIR, exist_ok=True)
+            metrics['profile'] = path.join(
+                PROFILE_DIR, f'{name}-{started_at.strftime("%Y%m%dT%H%M%S%f")}.prof')
+            profiler.dump_stats(metrics['profile'])
+
+        update_open_stage_peaks()
+        peak_kb = open_stage_peaks.pop(stage_key)
+        metrics.update(
+            status=status,
+            wall_seconds=round(perf_counter() - start_wall, 4),
+            cpu_seconds=round(process_time() - start_cpu, 4),
+            peak_rss_mb=round(peak_kb / 1024, 1) if peak_kb is not None else None
+        )
+        emit_metrics(metrics)
@@ -0,0 +1,71 @@
+"""A mergeable t-digest of transaction totals, for percentiles without the raw rows.
+A sketch is a list of centroids, each a mean total and the number of transactions
+it stands for. Merging sketches is concatenating their centroids and compressing
+them again, so any number of hourly sketches merge into one of at most about
+SKETCH_COMPRESSION centroids, most of them at the tails where percentiles are read"""
+from __future__ import annotations
+from typing import TYPE_CHECKING
+import numpy as np
+
+if TYPE_CHECKING:
+    import pandas as pd
+
+SKETCH_COMPRESSION = 100
+DEFAULT_PERCENTILES = [50, 95]
+
+
+def compress_centroids(means: np.ndarray, weights: np.ndarray,
+                       compression: int = SKETCH_COMPRESSION) -> tuple[np.ndarray, np.ndarray]:
+    """Merges neighbouring centroids until there are about compression of them.
+    Centroids with the same mean are combined first, and if that leaves few enough
+    the sketch is exact. Otherwise they are bucketed on the t-digest k1 scale of their
+    position in the distribution, which keeps the buckets near the tails small"""
+    means, inverse = np.unique(np.asarray(means, dtype='float64'), return_inverse=True)
+    weights = np.bincount(inverse, weights=np.asarray(weights, dtype='float64'),
+                          minlength=len(means))
+    if len(means) <= compression:
+        return means, weights
+
+    cumulative = np.cumsum(weights)
+    quantiles = (cumulative - weights / 2) / cumulative[-1]
+    buckets = np.floor(compression / np.pi * np.arcsin(2 * quantiles - 1))
+    starts = np.flatnonzero(np.r_[True, buckets[1:] != buckets[:-1]])
+
+    merged_weights = np.add.reduceat(weights, starts)
+    return np.add.reduceat(means * weights, starts) / merged_weights, merged_weights
+
+
+def get_quantiles(means: np.ndarray, weights: np.ndarray, percentiles: list[float]) -> np.ndarray:
+    """Returns the estimated value at each percentile of the sketched distribution.
+    Each centroid is taken as its weight of values at its mean, so percentiles of
+    totals that repeat, like menu prices, are exact"""
+    means = np.asarray(means, dtype='float64')
+    weights = np.asarray(weights, dtype='float64')
+    if len(means) == 0:
+        return np.full(len(percentiles), np.nan)
+
+    order = np.argsort(means, kind='stable')
+    means, weights = means[order], weights[order]
+    cumulative = np.cumsum(weights)
+    ranks = np.ravel(np.column_stack([cumulative - weights, cumulative]))
+
+    return np.interp(np.asarray(percentiles) / 100 * cumulative[-1], ranks, np.repeat(means, 2))
+
+
+def get_percentiles(sketch_df: pd.DataFrame, group_columns: list[str],
+                    percentiles: list[float] | None = None) -> pd.DataFrame:
+    """Returns the percentiles of total for each group, from the mean and weight
+    columns of its centroids, with a p<percentile> column for each"""
+    import pandas as pd # pylint: disable = C0415
+
+    percentiles = percentiles or DEFAULT_PERCENTILES
+    columns = [f'p{percentile:g}' for percentile in percentiles]
+    rows = []
+    groups = sketch_df.groupby(group_columns, observed=True) if group_columns else [((), sketch_df)]
+
+    for key, group_df in groups:
+        means, weights = compress_centroids(group_df['mean'], group_df['weight'])
+        key = key if isinstance(key, tuple) else (key,)
+        rows.append([*key, int(weights.sum()), *get_quantiles(means, weights, percentiles)])
+
+    return pd.DataFrame(rows, columns=group_columns + ['transaction_count'] + columns)
@@ -0,0 +1,126 @@
+"""Runs SQL against the truck tables through Athena or a local DuckDB engine.
+Set QUERY_BACKEND=duckdb to query the parquet dataset directly, from a local
+directory or S3 (DATASET_PATH), without waiting in Athena's queue"""
+from __future__ import annotations
+import json
+from os import environ, path
+from functools import lru_cache
+from tempfile import TemporaryDirectory
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    import pandas as pd
+
+DATABASE_NAME = 'c20-sami-truck-database'
+DEFAULT_DATASET_PATH = 's3://c20-sami-truck-s3-bucket/input'
+PARTITIONED_TABLES = ['transaction', 'transaction_rollup', 'transaction_sketch']
+SINGLE_FILE_TABLES = ['truck', 'payment_method']
+
+
+class AthenaBackend:
+    """Runs queries through Athena against the glue catalog"""
+
+    def __init__(self, database: str = DATABASE_NAME, **athena_options):
+        self.database = database
+        self.athena_options = athena_options
+
+    def query(self, sql_query: str) -> pd.DataFrame:
+        """Returns the result of the query as a dataframe"""
+        import awswrangler as wr # pylint: disable = C0415
+
+        return wr.athena.read_sql_query(sql_query, self.database, **self.athena_options)
+
+    def get_bytes_scanned(self, sql_query: str) -> int:
+        """Runs the query and returns the number of bytes Athena scanned for it"""
+        df = self.query(sql_query)
+        return df.query_metadata['Statistics']['DataScannedInBytes']
+
+
+class DuckDBBackend:
+    """Runs queries in process with DuckDB, reading the hive partitioned parquet dataset.
+    Partition values are kept as strings, as they are in Athena, and filters on them
+    skip the files of partitions that don't match"""
+
+    def __init__(self, dataset_path: str = DEFAULT_DATASET_PATH):
+        import duckdb # pylint: disable = C0415
+
+        self.dataset_path = dataset_path.rstrip('/')
+        self.connection = duckdb.connect()
+        if self.dataset_path.startswith('s3://'):
+            self.connect_to_s3()
+        self.create_views()
+
+    def connect_to_s3(self) -> None:
+        """Loads the S3 extension and gives it the AWS credentials from the environment"""
+        self.connection.execute('INSTALL httpfs; LOAD httpfs;')
+        if 'AWS_ACCESS_KEY_ID' in environ:
+            self.connection.execute(
+                'CREATE SECRET (TYPE s3, KEY_ID ?, SECRET ?, REGION ?);',
+                [environ['AWS_ACCESS_KEY_ID'], environ['AWS_SECRET_ACCESS_KEY'],
+                 environ.get('AWS_REGION', 'eu-west-2')]
+            )
+        else:
+            self.connection.execute('CREATE SECRET (TYPE s3, PROVIDER credential_chain);')
+
+    def create_views(self) -> None:
+        """Creates a view for each table over its parquet files.
+        Files starting with an underscore are skipped, as Athena skips them.
+        A partitioned table with no files yet, such as the sketches of an older
+        dataset, gets no view"""
+        import duckdb # pylint: disable = C0415
+
+        for table in PARTITIONED_TABLES:
+            try:
+                self.connection.execute(f"""
+                    CREATE VIEW {table} AS
+                    SELECT * FROM read_parquet(
+                        '{self.dataset_path}/{table}/{table}.parquet/*/*/*/*/[!_]*.parquet',
+                        hive_partitioning = true,
+                        hive_types_autocast = false,
+                        union_by_name = true
+                    );
+                """)
+            except duckdb.IOException:
+                print(f'No files found for {table}, it cannot be queried')
+        for table in SINGLE_FILE_TABLES:
+            self.connection.execute(f"""
+                CREATE VIEW {table} AS
+                SELECT * FROM read_parquet('{self.dataset_path}/{table}/{table}.parquet');
+            """)
+
+    def query(self, sql_query: str) -> pd.DataFrame:
+        """Returns the result of the query as a dataframe.
+        Each query gets its own cursor so the backend can be shared between threads"""
+        return self.connection.cursor().execute(sql_query).df()
+
+    def get_bytes_scanned(self, sql_query: str) -> int:
+        """Runs the query with profiling on and returns the number of bytes DuckDB read.
+        The file cache is turned off while it runs so cached reads are still counted"""
+        cursor = self.connection.cursor()
+        with TemporaryDirectory() as profile_dir:
+            profile_path = path.join(profile_dir, 'profile.json')
+            cursor.execute('SET enable_external_file_cache = false;')
+            cursor.execute("SET enable_profiling = 'json';")
+            cursor.execute("SET custom_profiling_settings = '{\"TOTAL_BYTES_READ\": \"true\"}';")
+            cursor.execute(f"SET profiling_output = '{profile_path}';")
+            cursor.execute(sql_query).fetchall()
+            with open(profile_path, encoding='utf-8') as f:
+                bytes_read = json.load(f)['total_bytes_read']
+            cursor.execute("SET enable_profiling = 'no_output';")
+            cursor.execute('RESET enable_external_file_cache;')
+
+        return bytes_read
+
+
+@lru_cache
+def get_backend(name: str | None = None, **athena_options) -> AthenaBackend | DuckDBBackend:
+    """Returns the query backend named, or set by QUERY_BACKEND, defaulting to Athena.
+    athena_options are passed to awswrangler and ignored by DuckDB.
+    Backends are reused between calls with the same arguments"""
+    name = name or environ.get('QUERY_BACKEND', 'athena')
+    if name == 'athena':
+        return AthenaBackend(**athena_options)
+    if name == 'duckdb':
+        return DuckDBBackend(environ.get('DATASET_PATH', DEFAULT_DATASET_PATH))
+
+    raise ValueError(f'Unknown query backend {name}, expected athena or duckdb')
@@ -0,0 +1,197 @@
+"""Builds SQL for the truck tables that only scans the partitions it needs.
+Dates are turned into literal year/month/day values rather than casts or date
+functions, which Athena can match against partitions before reading any files"""
+from datetime import date, timedelta
+
+ROLLUP_COLUMNS = {
+    "year": 'rollup.year',
+    "month": 'rollup.month',
+    "day": 'rollup.day',
+    "hour": 'rollup.hour',
+    "truck_id": 'rollup.truck_id',
+    "payment_method_id": 'rollup.payment_method_id',
+    "truck_name": 'truck.truck_name',
+    "payment_method": 'pm.payment_method'
+}
+SKETCH_COLUMNS = {
+    "year": 'sketch.year',
+    "month": 'sketch.month',
+    "day": 'sketch.day',
+    "hour": 'sketch.hour',
+    "truck_id": 'sketch.truck_id',
+    "truck_name": 'truck.truck_name'
+}
+# The dashboard's summary queries, filled in with a date filter by build_dashboard_query
+DASHBOARD_QUERIES = {
+    "highest transaction truck": """
+        SELECT
+            truck.truck_name,
+            SUM(transaction_count) AS count
+        FROM transaction_rollup
+        JOIN truck
+            ON truck.truck_id = transaction_rollup.truck_id
+        WHERE {date_filter}
+        GROUP BY truck_name
+        ORDER BY count DESC;
+    """,
+    "lowest value truck": """
+        SELECT
+            truck.truck_name,
+            SUM(total_value) AS total_value
+        FROM transaction_rollup
+        JOIN truck
+            ON truck.truck_id = transaction_rollup.truck_id
+        WHERE {date_filter}
+        GROUP BY truck_name
+        ORDER BY total_value ASC;
+    """,
+    "average value": """
+        SELECT
+            SUM(total_value) * 1.0 / SUM(transaction_count) as average
+        FROM transaction_rollup
+        WHERE {date_filter};
+    """,
+    "average value per truck": """
+        SELECT
+            truck.truck_name,
+            SUM(total_value) * 1.0 / SUM(transaction_count) as average
+        FROM transaction_rollup
+        JOIN truck
+            ON truck.truck_id = transaction_rollup.truck_id
+        WHERE {date_filter}
+        GROUP BY truck.truck_name
+        ORDER BY average DESC;
+    """,
+    "cash proportion": """
+        SELECT
+            SUM(CASE WHEN payment_method.payment_method = 'cash'
+                THEN transaction_count ELSE 0 END) * 1.0
+                / SUM(transaction_count) AS cash_proportion
+        FROM transaction_rollup
+        JOIN payment_method
+            ON payment_method.payment_method_id = transaction_rollup.payment_method_id
+        WHERE {date_filter};
+    """
+}
+
+
+def get_partition_filter(start_date: date, end_date: date, table_alias: str = '') -> str:
+    """Returns a predicate on the literal year/month/day partition values in the range.
+    Whole months are matched on year and month alone to keep the query short"""
+    prefix = f'{table_alias}.' if table_alias else ''
+    conditions = []
+    month_start = start_date.replace(day=1)
+    while month_start <= end_date:
+        next_month = (month_start + timedelta(days=32)).replace(day=1)
+        first_day = max(month_start, start_date)
+        last_day = min(next_month - timedelta(days=1), end_date)
+        condition = (f"({prefix}year = '{month_start.year}' "
+                     f"AND {prefix}month = '{month_start.month}'")
+
+        if first_day == month_start and last_day == next_month - timedelta(days=1):
+            conditions.append(condition + ')')
+        else:
+            days = ', '.join(f"'{day}'" for day in range(first_day.day, last_day.day + 1))
+            conditions.append(condition + f' AND {prefix}day IN ({days}))')
+        month_start = next_month
+
+    return '(' + ' OR '.join(conditions) + ')' if conditions else 'FALSE'
+
+
+def get_date_filter(start_date: date | None = None, end_date: date | None = None,
+                    table_alias: str = '') -> str:
+    """Returns a partition filter for the dates, or TRUE if no dates are given.
+    A missing start or end leaves that side of the range open up to today"""
+    if start_date is None and end_date is None:
+        return 'TRUE'
+
+    end_date = end_date or date.today()
+    start_date = start_date or date(2000, 1, 1)
+    return get_partition_filter(start_date, end_date, table_alias)
+
+
+def build_rollup_query(group_columns: list[str], start_date: date, end_date: date,
+                       truck_ids: list[int] | None = None) -> str:
+    """Returns a query summing transaction counts and values from the hourly rollup
+    per group column, joining truck and payment method names only if they're asked for"""
+    unknown_columns = set(group_columns) - set(ROLLUP_COLUMNS)
+    if unknown_columns:
+        raise ValueError(f'Cannot group the rollup by {unknown_columns}')
+
+    select_columns = [f'{ROLLUP_COLUMNS[column]} AS {column}' for column in group_columns]
+    joins = []
+    if 'truck_name' in group_columns:
+        joins.append('JOIN truck ON rollup.truck_id = truck.truck_id')
+    if 'payment_method' in group_columns:
+        joins.append('JOIN payment_method AS pm ON rollup.payment_method_id = pm.payment_method_id')
+
+    conditions = [get_partition_filter(start_date, end_date, 'rollup')]
+    if truck_ids is not None:
+        truck_id_list = ', '.join(str(int(truck_id)) for truck_id in truck_ids)
+        conditions.append(f'rollup.truck_id IN ({truck_id_list or "NULL"})')
+
+    group_by = ', '.join(str(position) for position in range(1, len(group_columns) + 1))
+    newline = '\n        '
+
+    return f"""
+        SELECT
+            {(',' + newline + '    ').join(select_columns + [
+                'SUM(rollup.transaction_count) AS transaction_count',
+                'SUM(rollup.total_value) AS total_value'
+            ])}
+        FROM transaction_rollup AS rollup
+        {newline.join(joins)}
+        WHERE {(newline + 'AND ').join(conditions)}
+        {'GROUP BY ' + group_by if group_by else ''};
+    """
+
+
+def build_sketch_query(group_columns: list[str], start_date: date, end_date: date,
+                       truck_ids: list[int] | None = None) -> str:
+    """Returns a query for the centroids of the hourly sketches of total per group column,
+    ready for get_percentiles. Centroids with the same mean to the penny are summed in
+    the query, so the rows returned are bounded by the range of totals, not of dates"""
+    unknown_columns = set(group_columns) - set(SKETCH_COLUMNS)
+    if unknown_columns:
+        raise ValueError(f'Cannot group the sketches by {unknown_columns}')
+
+    select_columns = [f'{SKETCH_COLUMNS[column]} AS {column}' for column in group_columns]
+    join = 'JOIN truck ON sketch.truck_id = truck.truck_id' if 'truck_name' in group_columns else ''
+
+    conditions = [get_partition_filter(start_date, end_date, 'sketch')]
+    if truck_ids is not None:
+        truck_id_list = ', '.join(str(int(truck_id)) for truck_id in truck_ids)
+        conditions.append(f'sketch.truck_id IN ({truck_id_list or "NULL"})')
+
+    group_by = ', '.join(str(position) for position in range(1, len(group_columns) + 2))
+    newline = '\n        '
+
+    return f"""
+        SELECT
+            {(',' + newline + '    ').join(select_columns + [
+                'ROUND(sketch.mean) AS mean',
+                'SUM(sketch.weight) AS weight'
+            ])}
+        FROM transaction_sketch AS sketch
+        {join}
+        WHERE {(newline + 'AND ').join(conditions)}
+        GROUP BY {group_by};
+    """
+
+
+def build_dashboard_query(name: str, start_date: date | None = None,
+                          end_date: date | None = None) -> str:
+    """Returns one of the dashboard's summary queries, scanning only the partitions
+    between the dates"""
+    if name not in DASHBOARD_QUERIES:
+        raise ValueError(f'Unknown dashboard query {name}')
+
+    return DASHBOARD_QUERIES[name].format(date_filter=get_date_filter(start_date, end_date))
+
+
+def build_dashboard_workload(start_date: date, end_date: date) -> dict[str, str]:
+    """Returns every query the dashboard's queries.py runs over the dates, by name"""
+    return {
+        **{name: build_dashboard_query(name, start_date, end_date) for name in DASHBOARD_QUERIES},
+        "value percentiles": build_sketch_query(['truck_name'], start_date, end_date)
+    }
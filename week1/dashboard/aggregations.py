@@ -0,0 +1,78 @@
+"""Builds the aggregated tables behind the dashboard charts.
+Each (metric, time scale, truck selection) table is computed once per dataset
+and kept in a small LRU cache, so changing a widget back is only a lookup.
+Every session's thread shares the cache, so it is only touched while holding its lock"""
+from collections import OrderedDict
+from threading import Lock
+import pandas as pd
+
+MAX_CACHED_CUBES = 64
+TIME_SCALE_COLUMNS = {
+    "Hour": 'hour',
+    "Day": 'day_of_week'
+}
+DAYS_OF_WEEK = ['Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday', 'Sunday']
+METRICS = ['total_revenue', 'average_transaction_value', 'payment_method_revenue']
+
+cube_cache = OrderedDict()
+cube_cache_lock = Lock()
+
+
+def add_derived_columns(df: pd.DataFrame) -> pd.DataFrame:
+    """Returns a new dataframe with revenue in pounds and the hour and weekday of each row.
+    Called once per fetch so the charts never modify the shared data themselves"""
+    return df.assign(
+        revenue=df['total_value'] / 100,
+        hour=df['at'].dt.hour,
+        day_of_week=pd.Categorical(df['at'].dt.day_name(), categories=DAYS_OF_WEEK, ordered=True)
+    )
+
+
+def compute_cube(df: pd.DataFrame, metric: str, time_scale: str,
+                 truck_filter: tuple[str]) -> pd.DataFrame:
+    """Returns the metric per truck and time period, or per payment method"""
+    if metric == 'payment_method_revenue':
+        group_column = 'payment_method'
+    else:
+        group_column = TIME_SCALE_COLUMNS[time_scale]
+
+    selected = df[df['truck_name'].isin(truck_filter)]
+    cube = selected.groupby([group_column, 'truck_name'], observed=True)[
+        ['revenue', 'transaction_count']].sum().reset_index()
+
+    if metric == 'average_transaction_value':
+        cube[metric] = cube['revenue'] / cube['transaction_count']
+    else:
+        cube[metric] = cube['revenue']
+
+    if group_column != 'payment_method':
+        cube = cube.rename(columns={group_column: 'time_period'})
+
+    return cube.drop(columns=['revenue', 'transaction_count'])
+
+
+def get_cube(df: pd.DataFrame, data_version: tuple, metric: str, time_scale: str,
+             truck_filter: list[str]) -> pd.DataFrame:
+    """Returns the aggregated table for the metric, computing it only if it isn't cached.
+    data_version identifies the dataset, so refreshed data is never served stale cubes"""
+    if metric not in METRICS:
+        raise ValueError(f'Unknown metric {metric}, expected one of {METRICS}')
+
+    truck_filter = tuple(sorted(truck_filter))
+    if metric == 'payment_method_revenue':
+        time_scale = None
+    key = (data_version, metric, time_scale, truck_filter)
+
+    with cube_cache_lock:
+        if key in cube_cache:
+            cube_cache.move_to_end(key)
+            return cube_cache[key]
+
+    cube = compute_cube(df, metric, time_scale, truck_filter)
+    with cube_cache_lock:
+        cube_cache[key] = cube
+        cube_cache.move_to_end(key)
+        if len(cube_cache) > MAX_CACHED_CUBES:
+            cube_cache.popitem(last=False)
+
+    return cube
@@ -1,71 +1,51 @@
-import awswrangler as wr
+from datetime import date
 import pandas as pd
-
-DATABASE_NAME = 'c20-sami-truck-database'
-
-def query_highest_transaction_truck() -> pd.DataFrame:
-    """Returns a dataframe of the food trucks sorted by total transactions"""
-    sql_query = """
-        SELECT
-            truck.truck_name,
-            COUNT(*) AS count
-        FROM transaction
-        JOIN truck
-            ON truck.truck_id = transaction.truck_id
-        GROUP BY truck_name
-        ORDER BY count DESC;
-    """
-    return wr.athena.read_sql_query(sql_query, DATABASE_NAME)
-
-def query_lowest_value_truck() -> pd.DataFrame:
-    """Returns a dataframe of the food trucks sorted by least total transaction value"""
-    sql_query = """
-        SELECT
-            truck.truck_name,
-            SUM(total) AS total_value
-        FROM transaction
-        JOIN truck
-            ON truck.truck_id = transaction.truck_id
-        GROUP BY truck_name
-        ORDER BY total_value ASC;
-    """
-    return wr.athena.read_sql_query(sql_query, DATABASE_NAME)
-
-def query_average_transaction_value() -> pd.DataFrame:
-    """Returns the average transaction value across all transactions"""
-    sql_query = """
-        SELECT
-            AVG(total) as average
-        FROM transaction;
-    """
-    return wr.athena.read_sql_query(sql_query, DATABASE_NAME)['average'][0]
-
-def query_average_transaction_value_per_truck() -> pd.DataFrame:
-    """Returns the average transaction value per truck"""
-    sql_query = """
-        SELECT
-            truck.truck_name,
-            AVG(total) as average
-        FROM transaction
-        JOIN truck
-            ON truck.truck_id = transaction.truck_id
-        GROUP BY truck.truck_name
-        ORDER BY average DESC;
-    """
-    return wr.athena.read_sql_query(sql_query, DATABASE_NAME)
-
-def query_cash_proportion() -> pd.DataFrame:
-    """Returns the proportion of transactions that use cash"""
-    sql_query = """
-        SELECT
-            (COUNT(*) * 1.0) / (SELECT COUNT(*) FROM transaction) AS cash_proportion
-        FROM transaction
-        JOIN payment_method
-            ON payment_method.payment_method_id = transaction.payment_method_id
-        WHERE payment_method.payment_method = 'cash';
-    """
-
-    return wr.athena.read_sql_query(sql_query, DATABASE_NAME)
+from truck_common.query_backend import get_backend
+from truck_common.query_builder import build_dashboard_query, build_sketch_query
+from truck_common.quantile_sketch import get_percentiles
+
+def query_highest_transaction_truck(start_date: date | None = None,
+        end_date: date | None = None) -> pd.DataFrame:
+    """Returns a dataframe of the food trucks sorted by total transactions.
+    Only the partitions between the given dates are scanned"""
+    sql_query = build_dashboard_query('highest transaction truck', start_date, end_date)
+    return get_backend().query(sql_query)
+
+def query_lowest_value_truck(start_date: date | None = None,
+        end_date: date | None = None) -> pd.DataFrame:
+    """Returns a dataframe of the food trucks sorted by least total transaction value.
+    Only the partitions between the given dates are scanned"""
+    sql_query = build_dashboard_query('lowest value truck', start_date, end_date)
+    return get_backend().query(sql_query)
+
+def query_average_transaction_value(start_date: date | None = None,
+        end_date: date | None = None) -> pd.DataFrame:
+    """Returns the average transaction value across all transactions.
+    Only the partitions between the given dates are scanned"""
+    sql_query = build_dashboard_query('average value', start_date, end_date)
+    return get_backend().query(sql_query)['average'][0]
+
+def query_average_transaction_value_per_truck(start_date: date | None = None,
+        end_date: date | None = None) -> pd.DataFrame:
+    """Returns the average transaction value per truck.
+    Only the partitions between the given dates are scanned"""
+    sql_query = build_dashboard_query('average value per truck', start_date, end_date)
+    return get_backend().query(sql_query)
+
+def query_cash_proportion(start_date: date | None = None,
+        end_date: date | None = None) -> pd.DataFrame:
+    """Returns the proportion of transactions that use cash.
+    Only the partitions between the given dates are scanned"""
+    sql_query = build_dashboard_query('cash proportion', start_date, end_date)
+    return get_backend().query(sql_query)
+
+def query_transaction_value_percentiles(start_date: date, end_date: date,
+        percentiles: list[float] | None = None) -> pd.DataFrame:
+    """Returns percentiles of transaction value per truck, the median and 95th by default.
+    They are merged from the hourly sketches, so no transactions are read"""
+    centroids = get_backend().query(build_sketch_query(['truck_name'], start_date, end_date))
+
+    return get_percentiles(centroids, ['truck_name'], percentiles)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,247 @@
+"""Keeps a local snapshot of every transaction joined to its truck and payment method.
+The snapshot is an uncompressed Arrow IPC file, so sessions memory-map it instead of
+parsing and joining the tables: opening it takes milliseconds and every process reading
+it shares the same pages of the OS page cache. A manifest beside it records the files
+each hour partition was built from and where its rows sit, so a refresh only reads the
+partitions that are new or have changed and copies the rest from the old snapshot"""
+import json
+from argparse import ArgumentParser
+from datetime import date, datetime, timedelta, timezone
+from hashlib import sha1
+from os import environ, makedirs, path, replace
+from time import perf_counter
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+from pyarrow import fs
+
+DEFAULT_DATASET_PATH = 's3://c20-sami-truck-s3-bucket/input'
+SNAPSHOT_PATH = environ.get('SNAPSHOT_PATH', 'data/transactions.arrow')
+MANIFEST_SUFFIX = '.manifest.json'
+PARTITION_COLS = ['year', 'month', 'day', 'hour']
+SNAPSHOT_SCHEMA = pa.schema([
+    ('transaction_id', pa.int32()),
+    ('truck_id', pa.int16()),
+    ('truck_name', pa.dictionary(pa.int8(), pa.string())),
+    ('payment_method', pa.dictionary(pa.int8(), pa.string())),
+    ('total', pa.int32()),
+    ('at', pa.timestamp('s'))
+])
+SNAPSHOT_GROUP_COLUMNS = ['year', 'month', 'day', 'hour', 'truck_id', 'truck_name',
+                          'payment_method']
+
+
+def get_filesystem(dataset_path: str) -> tuple[fs.FileSystem, str]:
+    """Returns the filesystem for a local or s3:// path and the path within it"""
+    if dataset_path.startswith('s3://'):
+        return fs.FileSystem.from_uri(dataset_path)
+
+    return fs.LocalFileSystem(), path.abspath(dataset_path)
+
+
+def get_manifest_path(snapshot_path: str = SNAPSHOT_PATH) -> str:
+    """Returns where the manifest of the snapshot is kept"""
+    return snapshot_path + MANIFEST_SUFFIX
+
+
+def read_manifest(snapshot_path: str = SNAPSHOT_PATH) -> dict | None:
+    """Returns the manifest of the snapshot, or None if there is no snapshot yet"""
+    manifest_path = get_manifest_path(snapshot_path)
+    if not (path.exists(manifest_path) and path.exists(snapshot_path)):
+        return None
+
+    with open(manifest_path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def open_snapshot(snapshot_path: str = SNAPSHOT_PATH) -> pa.Table:
+    """Returns the snapshot as a table backed directly by the memory-mapped file"""
+    return pa.ipc.open_file(pa.memory_map(snapshot_path)).read_all()
+
+
+def list_partitions(filesystem: fs.FileSystem, transaction_dir: str) -> dict[str, dict]:
+    """Returns the size of each visible parquet file in every transaction partition,
+    keyed by the partition's year=/month=/day=/hour= path"""
+    selector = fs.FileSelector(transaction_dir, recursive=True, allow_not_found=True)
+    partitions = {}
+    for info in filesystem.get_file_info(selector):
+        if (info.type == fs.FileType.File and info.base_name.endswith('.parquet')
+                and not info.base_name.startswith(('_', '.'))):
+            partition = info.path.removeprefix(transaction_dir).strip('/').rsplit('/', 1)[0]
+            partitions.setdefault(partition, {})[info.base_name] = info.size
+
+    return partitions
+
+
+def get_partition_key(partition: str) -> tuple[int, ...]:
+    """Returns the year, month, day and hour of a partition path, for sorting"""
+    values = dict(part.split('=', 1) for part in partition.split('/'))
+    return tuple(int(values[column]) for column in PARTITION_COLS)
+
+
+def read_dimensions(filesystem: fs.FileSystem, dataset_path: str) -> tuple[pa.Table, pa.Table, str]:
+    """Returns the truck and payment method tables and a version that changes with their files"""
+    version = sha1()
+    tables = []
+    for table, columns in [('truck', ['truck_id', 'truck_name']),
+                           ('payment_method', ['payment_method_id', 'payment_method'])]:
+        file_path = f'{dataset_path}/{table}/{table}.parquet'
+        info = filesystem.get_file_info(file_path)
+        version.update(f'{file_path}:{info.size}:{info.mtime}'.encode())
+        dimension = pq.read_table(file_path, columns=columns, filesystem=filesystem)
+        tables.append(dimension.combine_chunks().cast(
+            pa.schema([(columns[0], pa.int64()), (columns[1], pa.string())])))
+
+    return tables[0], tables[1], version.hexdigest()
+
+
+def get_dictionary_column(ids: pa.ChunkedArray, dimension: pa.Table) -> pa.ChunkedArray:
+    """Returns the dimension's name for each id, dictionary encoded against every name in
+    the dimension so each partition of the snapshot shares the same dictionary"""
+    indices = pc.index_in(ids.cast(pa.int64()), value_set=dimension.column(0)).cast(pa.int8())
+    return pa.chunked_array([
+        pa.DictionaryArray.from_arrays(chunk, dimension.column(1).chunk(0))
+        for chunk in indices.chunks
+    ], type=pa.dictionary(pa.int8(), pa.string()))
+
+
+def read_partition(filesystem: fs.FileSystem, partition_dir: str, filenames: list[str],
+                   trucks: pa.Table, payment_methods: pa.Table) -> pa.Table:
+    """Returns the partition's transactions joined to their truck and payment method names.
+    Like the notebook's merges, transactions with an unknown truck or payment method are dropped"""
+    transactions = pq.read_table(
+        [f'{partition_dir}/{filename}' for filename in sorted(filenames)], filesystem=filesystem,
+        columns=['transaction_id', 'truck_id', 'payment_method_id', 'total', 'at'])
+
+    table = pa.table({
+        "transaction_id": transactions['transaction_id'].cast(pa.int32()),
+        "truck_id": transactions['truck_id'].cast(pa.int16()),
+        "truck_name": get_dictionary_column(transactions['truck_id'], trucks),
+        "payment_method": get_dictionary_column(transactions['payment_method_id'],
+                                                payment_methods),
+        "total": transactions['total'].cast(pa.int32()),
+        "at": transactions['at'].cast(pa.timestamp('s'))
+    }, schema=SNAPSHOT_SCHEMA)
+
+    return table.filter(pc.and_(pc.is_valid(table['truck_name']),
+                                pc.is_valid(table['payment_method'])))
+
+
+def write_manifest(manifest: dict, snapshot_path: str) -> None:
+    """Saves the manifest, replacing the old one in one step"""
+    manifest_path = get_manifest_path(snapshot_path)
+    with open(manifest_path + '.tmp', 'w', encoding='utf-8') as f:
+        json.dump(manifest, f)
+    replace(manifest_path + '.tmp', manifest_path)
+
+
+def build_snapshot(dataset_path: str = DEFAULT_DATASET_PATH,
+                   snapshot_path: str = SNAPSHOT_PATH) -> dict:
+    """Writes the snapshot of the dataset, reusing the rows of every partition whose files
+    haven't changed since the last snapshot. Returns the new manifest"""
+    filesystem, dataset_path = get_filesystem(dataset_path.rstrip('/'))
+    transaction_dir = f'{dataset_path}/transaction/transaction.parquet'
+    trucks, payment_methods, dimensions_version = read_dimensions(filesystem, dataset_path)
+
+    old_manifest = read_manifest(snapshot_path)
+    if old_manifest is not None and old_manifest['dimensions_version'] == dimensions_version:
+        old_table = open_snapshot(snapshot_path)
+        old_partitions = old_manifest['partitions']
+    else:
+        old_table = None
+        old_partitions = {}
+
+    makedirs(path.dirname(snapshot_path) or '.', exist_ok=True)
+    partitions = {}
+    offset = 0
+    read_count = 0
+    with pa.ipc.new_file(snapshot_path + '.tmp', SNAPSHOT_SCHEMA) as writer:
+        for partition, files in sorted(list_partitions(filesystem, transaction_dir).items(),
+                                       key=lambda item: get_partition_key(item[0])):
+            old = old_partitions.get(partition)
+            if old is not None and old['files'] == files:
+                table = old_table.slice(old['offset'], old['rows'])
+            else:
+                table = read_partition(filesystem, f'{transaction_dir}/{partition}', list(files),
+                                       trucks, payment_methods)
+                read_count += 1
+
+            writer.write_table(table)
+            partitions[partition] = {"files": files, "offset": offset, "rows": table.num_rows}
+            offset += table.num_rows
+
+    replace(snapshot_path + '.tmp', snapshot_path)
+    manifest = {
+        "version": (old_manifest or {}).get('version', 0) + 1,
+        "built_at": datetime.now(timezone.utc).isoformat(timespec='seconds'),
+        "source": dataset_path,
+        "dimensions_version": dimensions_version,
+        "rows": offset,
+        "partitions_read": read_count,
+        "partitions": partitions
+    }
+    write_manifest(manifest, snapshot_path)
+
+    return manifest
+
+
+def filter_snapshot(table: pa.Table, group_columns: list[str], start_date: date,
+                    end_date: date, truck_ids: list[int] | None = None) -> pa.Table:
+    """Returns the snapshot's transactions between the dates for the given trucks,
+    with any year, month, day or hour group columns added"""
+    unknown_columns = set(group_columns) - set(SNAPSHOT_GROUP_COLUMNS)
+    if unknown_columns:
+        raise ValueError(f'Cannot group the snapshot by {unknown_columns}')
+
+    start = pa.scalar(datetime.combine(start_date, datetime.min.time()), pa.timestamp('s'))
+    end = pa.scalar(datetime.combine(end_date + timedelta(days=1), datetime.min.time()),
+                    pa.timestamp('s'))
+    condition = pc.and_(pc.greater_equal(table['at'], start), pc.less(table['at'], end))
+    if truck_ids is not None:
+        condition = pc.and_(condition, pc.is_in(table['truck_id'],
+                                                value_set=pa.array(truck_ids, pa.int16())))
+    table = table.filter(condition)
+
+    for column in set(group_columns) & set(PARTITION_COLS):
+        table = table.append_column(column, getattr(pc, column)(table['at']))
+
+    return table
+
+
+def query_snapshot_rollup(table: pa.Table, group_columns: list[str], start_date: date,
+                          end_date: date, truck_ids: list[int] | None = None) -> pd.DataFrame:
+    """Returns the transaction counts and values summed per group column, as
+    build_rollup_query does, computed from the snapshot instead of the rollup"""
+    table = filter_snapshot(table, group_columns, start_date, end_date, truck_ids)
+
+    return (table.group_by(group_columns)
+            .aggregate([('total', 'count'), ('total', 'sum')])
+            .rename_columns({"total_count": 'transaction_count', "total_sum": 'total_value'})
+            .to_pandas())
+
+
+def query_snapshot_sketch(table: pa.Table, group_columns: list[str], start_date: date,
+                          end_date: date, truck_ids: list[int] | None = None) -> pd.DataFrame:
+    """Returns the count of each distinct total per group column, as centroids in the
+    form build_sketch_query returns, ready for get_percentiles"""
+    table = filter_snapshot(table, group_columns, start_date, end_date, truck_ids)
+
+    return (table.group_by(group_columns + ['total'])
+            .aggregate([('total', 'count')])
+            .rename_columns({"total": 'mean', "total_count": 'weight'})
+            .to_pandas())
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='Builds or refreshes the local transaction snapshot')
+    parser.add_argument('--dataset-path', default=environ.get('DATASET_PATH', DEFAULT_DATASET_PATH),
+                        help='local directory or s3:// prefix holding the loaded tables')
+    parser.add_argument('--snapshot-path', default=SNAPSHOT_PATH)
+    args = parser.parse_args()
+
+    start_time = perf_counter()
+    new_manifest = build_snapshot(args.dataset_path, args.snapshot_path)
+    print(f'Snapshot version {new_manifest["version"]}: {new_manifest["rows"]:,} transactions, '
+          f'{new_manifest["partitions_read"]} of {len(new_manifest["partitions"])} partitions '
+          f'read in {perf_counter() - start_time:.2f}s')
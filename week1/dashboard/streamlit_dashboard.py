@@ -1,13 +1,22 @@
 # pylint: disable = W0612
 """Creates a streamlit dashboard to show food truck data visualisations"""
-from os import environ
+from os import environ, path, stat
+from threading import Lock
+from time import time
+from datetime import date, timedelta
 import streamlit as st
-import awswrangler as wr
 import pandas as pd
+import pyarrow as pa
 from streamlit.delta_generator import DeltaGenerator
 from dotenv import load_dotenv
-
-# .env variables loaded so awswrangler can access them
+from aggregations import add_derived_columns, get_cube
+from truck_common.query_backend import get_backend
+from truck_common.query_builder import build_rollup_query, build_sketch_query
+from truck_common.quantile_sketch import get_percentiles
+from snapshot import (SNAPSHOT_PATH, open_snapshot, query_snapshot_rollup,
+                      query_snapshot_sketch)
+
+# .env variables loaded so the query backend can access them
 load_dotenv()
 AWS_SECRET_ACCESS_KEY = environ['AWS_SECRET_ACCESS_KEY']
 AWS_ACCESS_KEY_ID = environ['AWS_ACCESS_KEY_ID']
@@ -15,45 +24,145 @@ AWS_REGION = environ['AWS_REGION']
 S3_BUCKET_NAME = environ['S3_BUCKET_NAME']
 DATABASE_NAME = environ['DATABASE_NAME']
 
-@st.cache_data
-def get_truck_data() -> pd.DataFrame:
-    """Returns a joined dataframe of all truck data"""
+CACHE_TTL_SECONDS = 300
+MAX_CACHED_QUERIES = 32
+DEFAULT_DAYS_SHOWN = 30
+
+# Matches the types the pipeline writes, see week2/pipeline/schema.py
+TRUCK_DATA_DTYPES = {
+    "transaction_count": 'Int32',
+    "total_value": 'Int64',
+    "payment_method": 'category',
+    "truck_name": 'category'
+}
+
+
+@st.cache_resource(max_entries=1)
+def open_shared_snapshot(modified_at: int) -> pa.Table:
+    """Returns the memory-mapped snapshot, shared by every session until it is rebuilt"""
+    return open_snapshot(SNAPSHOT_PATH)
+
+
+def get_snapshot() -> pa.Table | None:
+    """Returns the local transaction snapshot, or None if there isn't one to query"""
+    if not path.exists(SNAPSHOT_PATH):
+        return None
+
+    return open_shared_snapshot(stat(SNAPSHOT_PATH).st_mtime_ns)
+
+
+@st.cache_data(ttl=3600)
+def get_trucks() -> pd.DataFrame:
+    """Returns the id and name of every truck"""
+    snapshot = get_snapshot()
+    if snapshot is not None:
+        trucks = snapshot.group_by(['truck_id', 'truck_name']).aggregate([]).to_pandas()
+        return trucks.astype({"truck_name": str}).sort_values('truck_name', ignore_index=True)
+
     sql_query = """
-        SELECT
-            transaction.transaction_id,
-            transaction.total,
-            transaction.at,
-            pm.payment_method,
-            truck.truck_name,
-            truck.truck_description,
-            truck.has_card_reader,
-            truck.fsa_rating
-        FROM transaction
-        JOIN payment_method AS pm
-            ON transaction.payment_method_id = pm.payment_method_id
-        JOIN truck
-            ON transaction.truck_id = truck.truck_id;
+        SELECT truck_id, truck_name
+        FROM truck
+        ORDER BY truck_name;
     """
-    return wr.athena.read_sql_query(sql_query, DATABASE_NAME)
+    return get_backend(database=DATABASE_NAME).query(sql_query)
 
 
-def get_total_over_time(df: pd.DataFrame, time_scale: str,
-                              truck_filter: list) -> DeltaGenerator:
-    """Generates a chart to show total revenue over time"""
-    if time_scale == 'Hour':
-        df['time_period'] = df['at'].dt.hour
-    elif time_scale == 'Day':
-        df['time_period'] = df['at'].dt.day_name()
+@st.cache_resource
+def get_query_cache() -> dict:
+    """Returns the store of query results shared by every dashboard session"""
+    return {}
 
-    df['total'] = df['total'] / 100 # convert pence to pounds
 
-    total_per_truck = df[df['truck_name'].isin(truck_filter)]
-    total_per_truck = total_per_truck.groupby(
-        ['time_period', 'truck_name'])['total'].sum().reset_index(name='total_revenue')
+@st.cache_resource
+def get_query_cache_lock() -> Lock:
+    """Returns the lock held while a session's thread reads or changes the query cache"""
+    return Lock()
 
+
+def query_truck_data(start_date: date, end_date: date, truck_ids: tuple[int],
+                     time_scale: str) -> pd.DataFrame:
+    """Returns the transaction rollup for the given dates and trucks, summed per hour when
+    the time scale is 'Hour' and per day otherwise. Only the matching partitions are read,
+    or the local snapshot is summed if there is one"""
+    group_columns = ['year', 'month', 'day', 'payment_method', 'truck_name']
+    if time_scale == 'Hour':
+        group_columns.append('hour')
+
+    snapshot = get_snapshot()
+    if snapshot is not None:
+        df = query_snapshot_rollup(snapshot, group_columns, start_date, end_date, truck_ids)
+    else:
+        df = get_backend(database=DATABASE_NAME).query(
+            build_rollup_query(group_columns, start_date, end_date, truck_ids))
+    if 'hour' not in df.columns:
+        df['hour'] = 0
+    df['at'] = pd.to_datetime(df[['year', 'month', 'day', 'hour']].astype(int))
+
+    df = df.drop(columns=['year', 'month', 'day', 'hour']).astype(TRUCK_DATA_DTYPES)
+
+    return add_derived_columns(df)
+
+
+def get_truck_data(start_date: date, end_date: date, truck_ids: tuple[int],
+                   time_scale: str) -> tuple[pd.DataFrame, tuple]:
+    """Returns the truck data for the selection, from the cache where possible,
+    along with a version that changes whenever the data is refreshed.
+    Once a cached result is older than CACHE_TTL_SECONDS only the days from its
+    latest data onwards are queried again and merged in"""
+    if not truck_ids:
+        empty_df = pd.DataFrame({column: pd.Series(dtype=dtype)
+                                 for column, dtype in TRUCK_DATA_DTYPES.items()})
+        return add_derived_columns(empty_df.assign(at=pd.Series(dtype='datetime64[s]'))), ()
+
+    cache = get_query_cache()
+    key = (start_date, end_date, truck_ids, time_scale)
+    with get_query_cache_lock():
+        cached = cache.get(key)
+
+    if cached is not None and time() - cached['fetched_at'] < CACHE_TTL_SECONDS:
+        return cached['data'], (key, cached['fetched_at'])
+
+    if cached is None or cached['data'].empty:
+        df = query_truck_data(start_date, end_date, truck_ids, time_scale)
+    else:
+        refresh_from = cached['data']['at'].max().date()
+        older_df = cached['data'][cached['data']['at'].dt.date < refresh_from]
+        newer_df = query_truck_data(refresh_from, end_date, truck_ids, time_scale)
+        df = pd.concat([older_df, newer_df], ignore_index=True).astype(
+            {**TRUCK_DATA_DTYPES, "day_of_week": newer_df['day_of_week'].dtype})
+
+    fetched_at = time()
+    with get_query_cache_lock():
+        cache.pop(key, None)
+        if len(cache) >= MAX_CACHED_QUERIES:
+            cache.pop(next(iter(cache)))
+        cache[key] = {"data": df, "fetched_at": fetched_at}
+
+    return df, (key, fetched_at)
+
+
+@st.cache_data(ttl=CACHE_TTL_SECONDS)
+def get_value_percentiles(start_date: date, end_date: date,
+                          truck_ids: tuple[int]) -> pd.DataFrame:
+    """Returns the median and 95th percentile transaction value of each truck in pounds,
+    merged from the hourly sketches, or counted from the local snapshot if there is one"""
+    snapshot = get_snapshot()
+    if snapshot is not None:
+        centroids = query_snapshot_sketch(snapshot, ['truck_name'], start_date, end_date,
+                                          truck_ids)
+    else:
+        centroids = get_backend(database=DATABASE_NAME).query(
+            build_sketch_query(['truck_name'], start_date, end_date, truck_ids))
+
+    percentiles = get_percentiles(centroids, ['truck_name'])
+    return percentiles.assign(p50=percentiles['p50'] / 100, p95=percentiles['p95'] / 100)
+
+
+def get_total_over_time(cube: pd.DataFrame, time_scale: str) -> DeltaGenerator:
+    """Generates a chart to show total revenue over time"""
     st.subheader(f'Total Revenue Per {time_scale}')
     chart = st.bar_chart(
-        total_per_truck,
+        cube,
         x = 'time_period',
         y = 'total_revenue',
         color = 'truck_name',
@@ -63,22 +172,11 @@ def get_total_over_time(df: pd.DataFrame, time_scale: str,
     return chart
 
 
-def get_average_value_over_time(df: pd.DataFrame, time_scale: str,
-                                truck_filter: list) -> DeltaGenerator:
+def get_average_value_over_time(cube: pd.DataFrame, time_scale: str) -> DeltaGenerator:
     """Generates a chart to show average transaction value over time"""
-    if time_scale == 'Hour':
-        df['time_period'] = df['at'].dt.hour
-    elif time_scale == 'Day':
-        df['time_period'] = df['at'].dt.day_name()
-
-    total_per_truck = df[df['truck_name'].isin(truck_filter)]
-    total_per_truck = total_per_truck.groupby(
-        ['time_period', 'truck_name'])['total'].mean().reset_index(
-            name='average_transaction_value')
-
     st.subheader(f'Average Transaction Value Per {time_scale}')
     chart = st.bar_chart(
-        total_per_truck,
+        cube,
         x = 'time_period',
         y = 'average_transaction_value',
         color = 'truck_name',
@@ -88,37 +186,51 @@ def get_average_value_over_time(df: pd.DataFrame, time_scale: str,
     return chart
 
 
-def get_revenue_per_payment_method(df: pd.DataFrame, truck_filter: list) -> DeltaGenerator:
+def get_revenue_per_payment_method(cube: pd.DataFrame) -> DeltaGenerator:
     """Generates a chart to show total revenue per payment method"""
-    df['total'] = df['total'] / 100 # convert pence to pounds
-
-    total_per_truck = df[df['truck_name'].isin(truck_filter)]
-    total_per_truck = total_per_truck.groupby(
-        ['payment_method', 'truck_name'])['total'].sum().reset_index(
-            name='total_revenue')
-
     st.subheader('Total Revenue Per Payment Method')
     chart = st.bar_chart(
-        total_per_truck,
+        cube,
         x = 'payment_method',
-        y = 'total_revenue',
+        y = 'payment_method_revenue',
         color = 'truck_name',
         x_label = 'Payment Method',
         y_label = 'Total Revenue (£)'
         )
     return chart
 
-
 if __name__ == '__main__':
-    truck_df = get_truck_data()
+    all_trucks = get_trucks()
     st.title('T3 Transaction Dashboard')
     with st.sidebar:
-        trucks = list(truck_df['truck_name'].unique())
+        trucks = list(all_trucks['truck_name'])
         truck_filter_selection = st.multiselect('Select Truck', trucks, default = trucks)
+        date_selection = st.date_input(
+            'Select Dates',
+            (date.today() - timedelta(days=DEFAULT_DAYS_SHOWN), date.today())
+        )
         time_scale_selection = st.radio(
             'Select Time Scale',
             ['Hour', 'Day']
         )
-    get_total_over_time(truck_df, time_scale_selection, truck_filter_selection)
-    get_average_value_over_time(truck_df, time_scale_selection, truck_filter_selection)
-    get_revenue_per_payment_method(truck_df, truck_filter_selection)
+
+    start_date_selection = date_selection[0]
+    end_date_selection = date_selection[-1]
+    truck_id_selection = tuple(sorted(
+        all_trucks[all_trucks['truck_name'].isin(truck_filter_selection)]['truck_id']))
+    truck_df, truck_data_version = get_truck_data(
+        start_date_selection, end_date_selection, truck_id_selection, time_scale_selection)
+
+    get_total_over_time(get_cube(
+        truck_df, truck_data_version, 'total_revenue',
+        time_scale_selection, truck_filter_selection), time_scale_selection)
+    get_average_value_over_time(get_cube(
+        truck_df, truck_data_version, 'average_transaction_value',
+        time_scale_selection, truck_filter_selection), time_scale_selection)
+    get_revenue_per_payment_method(get_cube(
+        truck_df, truck_data_version, 'payment_method_revenue',
+        time_scale_selection, truck_filter_selection))
+
+    st.subheader('Transaction Value Percentiles (£)')
+    st.dataframe(get_value_percentiles(start_date_selection, end_date_selection,
+                                       truck_id_selection), hide_index=True)
@@ -1,8 +1,9 @@
 """Extracts food truck data from RDS"""
-from os import environ
+from os import environ, path, remove
 from pymysql import connect, Connection
 from dotenv import load_dotenv
 import pandas as pd
+from truck_common.fingerprint import DIMENSION_TABLES, find_unchanged_tables
 
 def get_db_connection() -> None:
     """Returns a live connection to the database"""
@@ -19,13 +20,20 @@ def get_db_connection() -> None:
 
 
 def download_save_data(conn: Connection) -> None:
-    """Downloads and saves all data from the given database connection"""
-    truck_df = pd.read_sql('SELECT * FROM DIM_Truck;', conn)
-    payment_method_df = pd.read_sql('SELECT * FROM DIM_Payment_Method;', conn)
-    transaction_df = pd.read_sql('SELECT * FROM FACT_Transaction;', conn)
+    """Downloads and saves all data from the given database connection.
+    Dimension tables unchanged since they were last loaded are skipped"""
+    unchanged_tables = find_unchanged_tables(conn)
+    for table, source_table in DIMENSION_TABLES.items():
+        if table in unchanged_tables:
+            print(f'{source_table} is unchanged, skipping it')
+            if path.exists(f'./data/{table}.csv'):
+                remove(f'./data/{table}.csv')
+            continue
+
+        pd.read_sql(f'SELECT * FROM {source_table};', conn).to_csv(
+            f'./data/{table}.csv', index = False)
 
-    truck_df.to_csv('./data/truck.csv', index = False)
-    payment_method_df.to_csv('./data/payment_method.csv', index = False)
+    transaction_df = pd.read_sql('SELECT * FROM FACT_Transaction;', conn)
     transaction_df.to_csv('./data/transaction.csv', index = False)
 
 
@@ -2,8 +2,10 @@
 # pylint: disable = C0103
 import pandas as pd
 import awswrangler as wr
-from os import environ
+from os import environ, path
 from dotenv import load_dotenv
+from truck_common.fingerprint import (DIMENSION_TABLES, get_fingerprint, read_fingerprint,
+                                      write_fingerprint, clear_pending_checksums)
 
 # .env variables loaded so awswrangler can access them
 load_dotenv()
@@ -15,15 +17,25 @@ S3_FILEPATH = 's3://c20-sami-truck-s3-bucket/input/'
 
 
 def save_data_to_parquet() -> dict[pd.DataFrame]:
-    """Loads and saves truck and payment data to parquet files"""
-    truck_df = pd.read_csv('data/clean_truck.csv')
-    payment_df = pd.read_csv('data/clean_payment_method.csv')
+    """Loads and saves truck and payment data to parquet files.
+    Tables extract skipped, or whose contents match the last upload, aren't uploaded"""
+    for table in DIMENSION_TABLES:
+        if not path.exists(f'data/clean_{table}.csv'):
+            print(f'Skipping unchanged {table} table')
+            continue
 
-    truck_df.to_parquet('data/clean_truck.parquet')
-    payment_df.to_parquet('data/clean_payment_method.parquet')
+        df = pd.read_csv(f'data/clean_{table}.csv')
+        fingerprint = get_fingerprint(df, table)
+        stored_fingerprint = read_fingerprint(table, S3_FILEPATH)
+        if stored_fingerprint.get('content_hash') == fingerprint['content_hash']:
+            print(f'Skipping unchanged {table} table')
+        else:
+            df.to_parquet(f'data/clean_{table}.parquet')
+            upload_parquet_to_s3(df, table, False)
+        if stored_fingerprint != fingerprint:
+            write_fingerprint(table, fingerprint, S3_FILEPATH)
 
-    upload_parquet_to_s3(truck_df, 'truck', False)
-    upload_parquet_to_s3(payment_df, 'payment_method', False)
+    clear_pending_checksums()
 
 def create_time_partitioned_parquet() -> None:
     """Loads and saves transaction data to time partitioned parquet files"""
@@ -1,17 +1,15 @@
 # pylint: disable = W0612
+from os import path
 import pandas as pd
 
 
 def load_all_data() -> pd.DataFrame:
-    """Returns 3 dataframes of all the data for payment_method, transaction and truck"""
-    payment_method_df = pd.read_csv('data/payment_method.csv')
-    transaction_df = pd.read_csv('data/transaction.csv')
-    truck_df = pd.read_csv('data/truck.csv')
-
+    """Returns dataframes of the data for transaction, and for payment_method and truck
+    unless extract skipped them as unchanged"""
     return {
-        "transaction": transaction_df,
-        "payment_method": payment_method_df,
-        "truck": truck_df
+        key: pd.read_csv(f'data/{key}.csv')
+        for key in ['transaction', 'payment_method', 'truck']
+        if path.exists(f'data/{key}.csv')
     }
 
 
@@ -58,8 +56,10 @@ def clean_truck_data(truck_df: pd.DataFrame) -> pd.DataFrame:
 
 def clean_all_data(all_data: dict[str: pd.DataFrame]) -> pd.DataFrame:
     """Iterates through all tables and cleans their data"""
-    all_data['truck'] = clean_truck_data(all_data['truck'])
-    all_data['payment_method'] = clean_payment_method_data(all_data['payment_method'])
+    if 'truck' in all_data:
+        all_data['truck'] = clean_truck_data(all_data['truck'])
+    if 'payment_method' in all_data:
+        all_data['payment_method'] = clean_payment_method_data(all_data['payment_method'])
     all_data['transaction'] = clean_transaction_data(all_data['transaction'])
 
     for key in all_data:
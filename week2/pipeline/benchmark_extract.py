@@ -0,0 +1,78 @@
+"""Compares the single query extraction with the pooled parallel extraction.
+A SQLite database with the RDS table layout stands in for the source, so it runs
+without the database. The parallel result is checked against the single query
+with and without a watermark"""
+import sqlite3
+from argparse import ArgumentParser
+from datetime import datetime, timedelta
+from os import chdir, makedirs, path
+from tempfile import TemporaryDirectory
+from time import perf_counter
+import numpy as np
+import pandas as pd
+from extract import get_transaction_query
+from parallel_extract import download_data_parallel
+
+
+def create_stand_in_database(db_path: str, rows: int) -> None:
+    """Creates DIM_Truck, DIM_Payment_Method and FACT_Transaction with made up rows"""
+    rng = np.random.default_rng(0)
+    start = datetime(2025, 1, 1)
+    seconds = np.sort(rng.integers(0, 30 * 24 * 3600, rows))
+
+    with sqlite3.connect(db_path) as conn:
+        pd.DataFrame({"truck_id": range(1, 7),
+                      "truck_name": [f'Truck {i}' for i in range(1, 7)]}
+                     ).to_sql('DIM_Truck', conn, index=False)
+        pd.DataFrame({"payment_method_id": [1, 2], "payment_method": ['cash', 'card']}
+                     ).to_sql('DIM_Payment_Method', conn, index=False)
+        pd.DataFrame({
+            "transaction_id": np.arange(1, rows + 1),
+            "truck_id": rng.integers(1, 7, rows),
+            "payment_method_id": rng.integers(1, 3, rows),
+            "total": rng.integers(100, 2500, rows) / 100,
+            "at": [str(start + timedelta(seconds=int(second))) for second in seconds]
+        }).to_sql('FACT_Transaction', conn, index=False)
+        conn.execute('CREATE INDEX transaction_at ON FACT_Transaction (at, transaction_id);')
+
+
+def read_single_query(db_path: str, watermark) -> pd.DataFrame:
+    """Returns the transactions after the watermark read in one query on one connection"""
+    sql_query, params = get_transaction_query(watermark)
+    with sqlite3.connect(db_path) as conn:
+        return pd.read_sql(sql_query.replace('%s', '?'), conn, params=params)
+
+
+def time_call(function, *args, **kwargs) -> tuple[float, object]:
+    """Returns the seconds a call took and its result"""
+    start = perf_counter()
+    result = function(*args, **kwargs)
+    return perf_counter() - start, result
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='Benchmarks parallel extraction against SQLite')
+    parser.add_argument('--rows', type=int, default=500_000)
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4, 8])
+    args = parser.parse_args()
+
+    with TemporaryDirectory() as work_dir:
+        chdir(work_dir)
+        makedirs('data')
+        database_path = path.join(work_dir, 'stand_in.db')
+        create_stand_in_database(database_path, args.rows)
+
+        def connect() -> sqlite3.Connection:
+            """Opens a connection to the stand in that can be shared between threads"""
+            return sqlite3.connect(database_path, check_same_thread=False)
+
+        for mark in [None, (datetime(2025, 1, 15), 0)]:
+            seconds, expected = time_call(read_single_query, database_path, mark)
+            print(f'Watermark {mark}: {len(expected)} rows')
+            print(f'{"single query":<16}{seconds:>8.2f}s')
+
+            for worker_count in args.workers:
+                seconds, result = time_call(download_data_parallel, mark, worker_count,
+                                            connect)
+                pd.testing.assert_frame_equal(result['transaction'], expected)
+                print(f'{f"{worker_count} workers":<16}{seconds:>8.2f}s')
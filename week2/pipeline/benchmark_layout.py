@@ -0,0 +1,135 @@
+"""Compares the parquet layout of each writer profile on a local copy of the dataset.
+The transactions are rewritten under every profile, with their rollup and sketches,
+then the dashboard's queries.py workload is run against each copy with DuckDB,
+along with queries on single trucks that read the transactions themselves"""
+import shutil
+from argparse import ArgumentParser
+from datetime import date, timedelta
+from os import environ, path, walk
+from statistics import median
+from tempfile import TemporaryDirectory
+from time import perf_counter
+import pandas as pd
+import pyarrow.dataset as ds
+from partition_writer import WRITER_PROFILES, write_partitioned_dataset
+from rollup import rebuild_rollup
+from truck_common.query_backend import PARTITIONED_TABLES, SINGLE_FILE_TABLES, DuckDBBackend
+from truck_common.query_builder import build_dashboard_workload, get_date_filter
+
+DAYS_QUERIED = 30
+
+
+def get_workload(start_date: date, end_date: date, truck_id: int) -> dict[str, str]:
+    """Returns the queries.py queries over the range, and queries for one truck's transactions"""
+    day_filter = get_date_filter(start_date, end_date)
+    return {
+        **build_dashboard_workload(start_date, end_date),
+        "one truck's transactions": f"""
+            SELECT COUNT(*) AS count, SUM(total) AS total_value
+            FROM transaction
+            WHERE {day_filter} AND truck_id = {truck_id};
+        """,
+        "one truck's payment methods": f"""
+            SELECT payment_method_id, COUNT(*) AS count
+            FROM transaction
+            WHERE {day_filter} AND truck_id = {truck_id}
+            GROUP BY payment_method_id;
+        """,
+        "one truck's last evening": f"""
+            SELECT hour, SUM(total) AS total_value
+            FROM transaction
+            WHERE {get_date_filter(end_date, end_date)} AND truck_id = {truck_id}
+            AND "at" >= TIMESTAMP '{end_date} 18:00:00'
+            GROUP BY hour;
+        """
+    }
+
+
+def get_directory_size(directory: str) -> int:
+    """Returns the total size of the parquet files under the directory"""
+    return sum(path.getsize(path.join(root, name))
+               for root, _, names in walk(directory) for name in names
+               if name.endswith('.parquet'))
+
+
+def write_layout(transaction_df: pd.DataFrame, dataset_path: str, out_dir: str,
+                 profile: str) -> dict[str, int]:
+    """Writes the transactions, rollup and sketches with the profile and copies the
+    dimension tables beside them. Returns the bytes written for each partitioned table"""
+    table_paths = {table: f'{out_dir}/{table}/{table}.parquet' for table in PARTITIONED_TABLES}
+    write_partitioned_dataset(transaction_df, table_paths['transaction'], profile=profile)
+    rebuild_rollup(table_paths['transaction'], table_paths['transaction_rollup'],
+                   table_paths['transaction_sketch'], profile)
+    for table in SINGLE_FILE_TABLES:
+        shutil.copytree(f'{dataset_path}/{table}', f'{out_dir}/{table}')
+
+    return {table: get_directory_size(table_path) for table, table_path in table_paths.items()}
+
+
+def time_query(backends: dict[str, DuckDBBackend], sql_query: str,
+               runs: int) -> dict[str, float]:
+    """Returns the median seconds the query takes on each profile's copy, after a warm up run.
+    Each run goes through the profiles in turn so a change in the machine's speed hits them alike"""
+    timings = {profile: [] for profile in backends}
+    for run in range(runs + 1):
+        for profile, backend in backends.items():
+            start = perf_counter()
+            backend.query(sql_query)
+            if run > 0:
+                timings[profile].append(perf_counter() - start)
+
+    return {profile: median(profile_timings) for profile, profile_timings in timings.items()}
+
+
+def compare_layouts(dataset_path: str, runs: int = 5) -> tuple[pd.DataFrame, pd.DataFrame]:
+    """Returns the file sizes of each profile's tables, and the bytes scanned and
+    median time of each workload query, over the last DAYS_QUERIED days of the dataset"""
+    transaction_df = ds.dataset(f'{dataset_path}/transaction/transaction.parquet',
+                                partitioning='hive').to_table().to_pandas()
+    end_date = transaction_df['at'].max().date()
+    start_date = end_date - timedelta(days=DAYS_QUERIED - 1)
+    truck_id = int(transaction_df['truck_id'].mode()[0])
+    workload = get_workload(start_date, end_date, truck_id)
+
+    sizes = []
+    backends = {}
+    results = []
+    with TemporaryDirectory() as temp_dir:
+        for profile in WRITER_PROFILES:
+            out_dir = f'{temp_dir}/{profile}'
+            start = perf_counter()
+            table_sizes = write_layout(transaction_df, dataset_path, out_dir, profile)
+            sizes.append({"profile": profile, **table_sizes,
+                          "write_seconds": round(perf_counter() - start, 2)})
+            backends[profile] = DuckDBBackend(out_dir)
+
+        for name, sql_query in workload.items():
+            seconds = time_query(backends, sql_query, runs)
+            for profile, backend in backends.items():
+                results.append({
+                    "query": name,
+                    "profile": profile,
+                    "bytes_scanned": backend.get_bytes_scanned(sql_query),
+                    "ms": round(seconds[profile] * 1000, 1)
+                })
+
+    results = pd.DataFrame(results).pivot(index='query', columns='profile',
+                                          values=['bytes_scanned', 'ms'])
+    return pd.DataFrame(sizes), results.loc[list(workload)]
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='Benchmarks the parquet writer profiles')
+    parser.add_argument('--dataset-path', default=environ.get('DATASET_PATH'),
+                        required='DATASET_PATH' not in environ,
+                        help='local directory laid out like the bucket\'s input/ prefix, holding '
+                             'the transaction, truck and payment_method tables, e.g. a copy '
+                             'made with aws s3 sync. Defaults to DATASET_PATH')
+    parser.add_argument('--runs', type=int, default=5,
+                        help='times each query is timed, after a warm up run')
+    args = parser.parse_args()
+
+    size_df, query_df = compare_layouts(args.dataset_path.rstrip('/'), args.runs)
+    print(size_df.to_string(index=False))
+    print()
+    print(query_df.to_string())
@@ -0,0 +1,107 @@
+"""Compares the csv hand-off between the pipeline scripts with the in-memory runner.
+Starts from raw extract output (truck.csv, payment_method.csv, transaction.csv) and
+writes parquet locally, so it runs without the database or S3"""
+import json
+import subprocess
+import sys
+from argparse import ArgumentParser
+from resource import getrusage, RUSAGE_SELF
+from tempfile import TemporaryDirectory
+from time import perf_counter
+import pandas as pd
+from transform import clean_all_data
+
+PARTITION_COLS = ['year', 'month', 'day', 'hour']
+
+
+def read_raw_data(data_dir: str) -> dict[str, pd.DataFrame]:
+    """Returns the raw tables, as extract would have downloaded them"""
+    return {
+        "transaction": pd.read_csv(f'{data_dir}/transaction.csv'),
+        "payment_method": pd.read_csv(f'{data_dir}/payment_method.csv'),
+        "truck": pd.read_csv(f'{data_dir}/truck.csv')
+    }
+
+
+def write_transaction_parquet(transaction_df: pd.DataFrame, out_dir: str) -> None:
+    """Writes transactions as hour partitioned parquet, as the load step does"""
+    transaction_df['year'] = transaction_df['at'].dt.year
+    transaction_df['month'] = transaction_df['at'].dt.month
+    transaction_df['day'] = transaction_df['at'].dt.day
+    transaction_df['hour'] = transaction_df['at'].dt.hour
+    transaction_df.to_parquet(f'{out_dir}/transaction', partition_cols=PARTITION_COLS)
+
+
+def run_file_flow(all_data: dict[str, pd.DataFrame], out_dir: str) -> None:
+    """Extract, transform and load handing over through csv files"""
+    for key in all_data:
+        all_data[key].to_csv(f'{out_dir}/{key}.csv', index=False)
+
+    raw_data = {key: pd.read_csv(f'{out_dir}/{key}.csv') for key in all_data}
+    clean_data = clean_all_data(raw_data)
+    for key in clean_data:
+        clean_data[key].to_csv(f'{out_dir}/clean_{key}.csv', index=False)
+
+    truck_df = pd.read_csv(f'{out_dir}/clean_truck.csv')
+    payment_df = pd.read_csv(f'{out_dir}/clean_payment_method.csv')
+    truck_df.to_parquet(f'{out_dir}/clean_truck.parquet')
+    payment_df.to_parquet(f'{out_dir}/clean_payment_method.parquet')
+
+    transaction_df = pd.read_csv(f'{out_dir}/clean_transaction.csv')
+    transaction_df['at'] = pd.to_datetime(transaction_df['at'])
+    write_transaction_parquet(transaction_df, out_dir)
+
+
+def run_memory_flow(all_data: dict[str, pd.DataFrame], out_dir: str) -> None:
+    """Extract, transform and load handing over dataframes in memory"""
+    clean_data = clean_all_data(all_data)
+    clean_data['truck'].to_parquet(f'{out_dir}/clean_truck.parquet')
+    clean_data['payment_method'].to_parquet(f'{out_dir}/clean_payment_method.parquet')
+    write_transaction_parquet(clean_data['transaction'], out_dir)
+
+
+def measure_flow(flow: str, data_dir: str) -> dict:
+    """Runs one flow and returns its wall time and peak memory use"""
+    all_data = read_raw_data(data_dir)
+    rows = len(all_data['transaction'])
+    with TemporaryDirectory() as out_dir:
+        start = perf_counter()
+        if flow == 'files':
+            run_file_flow(all_data, out_dir)
+        else:
+            run_memory_flow(all_data, out_dir)
+        seconds = perf_counter() - start
+
+    return {
+        "flow": flow,
+        "rows": rows,
+        "seconds": round(seconds, 3),
+        "peak_rss_mb": round(getrusage(RUSAGE_SELF).ru_maxrss / 1024, 1)
+    }
+
+
+def compare_flows(data_dir: str) -> pd.DataFrame:
+    """Runs each flow in a fresh process so their peak memory use is measured separately"""
+    results = []
+    for flow in ['files', 'memory']:
+        output = subprocess.run(
+            [sys.executable, __file__, '--data-dir', data_dir, '--flow', flow],
+            capture_output=True, text=True, check=True
+        ).stdout
+        results.append(json.loads(output.splitlines()[-1]))
+
+    return pd.DataFrame(results)
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='Benchmarks the csv and in-memory pipeline flows')
+    parser.add_argument('--data-dir', default='data',
+                        help='directory holding the raw extract csv files')
+    parser.add_argument('--flow', choices=['files', 'memory'],
+                        help='run a single flow and print its result as json')
+    args = parser.parse_args()
+
+    if args.flow:
+        print(json.dumps(measure_flow(args.flow, args.data_dir)))
+    else:
+        print(compare_flows(args.data_dir).to_string(index=False))
@@ -0,0 +1,67 @@
+"""Measures the memory and parquet size of the joined transaction table
+with pandas' default types and with the compact types from schema.py"""
+from argparse import ArgumentParser
+from os import path, walk
+from tempfile import TemporaryDirectory
+import pandas as pd
+from schema import TABLE_DTYPES
+from transform import clean_all_data
+
+
+def join_tables(all_data: dict[str, pd.DataFrame]) -> pd.DataFrame:
+    """Returns the transactions joined to their truck and payment method"""
+    joined_df = all_data['transaction'].merge(all_data['truck'], on='truck_id')
+    return joined_df.merge(all_data['payment_method'], on='payment_method_id')
+
+
+def get_default_types(all_data: dict[str, pd.DataFrame]) -> dict[str, pd.DataFrame]:
+    """Returns the tables with the types pandas gives them without a schema"""
+    return {
+        key: df.astype({
+            column: 'object' if isinstance(dtype, pd.CategoricalDtype) else 'float64'
+            for column, dtype in df.dtypes.items()
+            if column in TABLE_DTYPES[key] and column != 'at'
+        })
+        for key, df in all_data.items()
+        if key in TABLE_DTYPES
+    }
+
+
+def get_parquet_size(df: pd.DataFrame) -> int:
+    """Returns the bytes taken by the dataframe written as parquet"""
+    with TemporaryDirectory() as out_dir:
+        df.to_parquet(path.join(out_dir, 'table.parquet'))
+        return sum(path.getsize(path.join(root, name))
+                   for root, _, names in walk(out_dir) for name in names)
+
+
+def compare_schemas(data_dir: str) -> pd.DataFrame:
+    """Returns the memory and parquet size of the joined table under each schema"""
+    raw_data = {
+        "transaction": pd.read_csv(f'{data_dir}/transaction.csv'),
+        "payment_method": pd.read_csv(f'{data_dir}/payment_method.csv'),
+        "truck": pd.read_csv(f'{data_dir}/truck.csv')
+    }
+    compact_data = clean_all_data(raw_data)
+    tables = {
+        "default": join_tables(get_default_types(compact_data)),
+        "compact": join_tables(compact_data)
+    }
+
+    results = pd.DataFrame([{
+        "schema": name,
+        "rows": len(df),
+        "memory_mb": round(df.memory_usage(deep=True).sum() / 1e6, 2),
+        "parquet_mb": round(get_parquet_size(df) / 1e6, 2)
+    } for name, df in tables.items()])
+
+    return results
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='Benchmarks the compact table schema')
+    parser.add_argument('--data-dir', default='data',
+                        help='directory holding the raw extract csv files')
+    args = parser.parse_args()
+
+    print(compare_schemas(args.data_dir).to_string(index=False))
@@ -0,0 +1,167 @@
+"""Times every stage of the truck data flow on synthetic data at increasing scale.
+For each scale a SQLite stand-in for RDS is generated, then extract, transform,
+load to a local directory standing in for S3, the daily report metrics and the
+dashboard aggregations are run in a fresh process. Throughput, peak RSS and
+output size are printed and appended as json lines to --output, so runs can be
+compared to spot regressions"""
+import json
+import sqlite3
+import subprocess
+import sys
+from argparse import ArgumentParser, SUPPRESS
+from datetime import date, datetime, timezone
+from os import makedirs, path, walk
+from resource import getrusage, RUSAGE_SELF
+from tempfile import TemporaryDirectory
+from time import perf_counter
+
+PIPELINE_DIR = path.dirname(path.abspath(__file__))
+# The report and dashboard modules live in their own image directories
+sys.path += [path.join(PIPELINE_DIR, '..', 'reporting'),
+             path.join(PIPELINE_DIR, '..', '..', 'week1', 'dashboard')]
+
+DEFAULT_SCALES = [1_000, 10_000, 100_000, 1_000_000]
+DEFAULT_DIRTY_RATE = 0.01
+DEFAULT_WORKERS = 4
+DAYS = 30
+
+
+def get_directory_size(directory: str) -> int:
+    """Returns the total size in bytes of the files under the directory"""
+    return sum(path.getsize(path.join(root, filename))
+               for root, _, filenames in walk(directory) for filename in filenames)
+
+
+def get_peak_rss_mb() -> float:
+    """Returns the most memory this process has held so far, in MB"""
+    return getrusage(RUSAGE_SELF).ru_maxrss / 1024
+
+
+def run_scale(rows: int, workers: int) -> list[dict]:
+    """Runs every stage on the rows synthetic transactions in source.db in the current
+    directory. Returns a result per stage"""
+    # pylint: disable = C0415
+    import pandas as pd
+    from generate_data import DEFAULT_START
+    from parallel_extract import download_data_parallel
+    from transform import clean_all_data
+    from partition_writer import write_partitioned_dataset, get_written_partitions
+    from rollup import update_rollup
+    from truck_common.query_backend import DuckDBBackend
+    from truck_common.query_builder import build_rollup_query
+    from generate_report import compute_report_metrics
+    from aggregations import METRICS, TIME_SCALE_COLUMNS, add_derived_columns, compute_cube
+
+    makedirs('data', exist_ok=True)
+    results = []
+
+    def record(stage: str, seconds: float, stage_rows: int, output_bytes: int | None = None):
+        results.append({
+            "stage": stage, "rows": rows, "stage_rows": stage_rows,
+            "seconds": round(seconds, 4), "rows_per_second": round(stage_rows / seconds),
+            "peak_rss_mb": round(get_peak_rss_mb(), 1), "output_bytes": output_bytes
+        })
+
+    start = perf_counter()
+    all_data = download_data_parallel(
+        None, workers, lambda: sqlite3.connect('source.db', check_same_thread=False))
+    record('extract', perf_counter() - start, len(all_data['transaction']))
+
+    start = perf_counter()
+    clean_data = clean_all_data(all_data)
+    transaction_df = clean_data['transaction']
+    record('transform', perf_counter() - start, rows)
+
+    start = perf_counter()
+    transaction_path = 'input/transaction/transaction.parquet'
+    for table in ['truck', 'payment_method']:
+        makedirs(f'input/{table}')
+        clean_data[table].to_parquet(f'input/{table}/{table}.parquet')
+    transaction_df = transaction_df.assign(
+        year=transaction_df['at'].dt.year, month=transaction_df['at'].dt.month,
+        day=transaction_df['at'].dt.day, hour=transaction_df['at'].dt.hour)
+    files = write_partitioned_dataset(transaction_df, transaction_path, write_mode='dedupe')
+    update_rollup(get_written_partitions(files), transaction_path,
+                  'input/transaction_rollup/transaction_rollup.parquet',
+                  'input/transaction_sketch/transaction_sketch.parquet')
+    record('load', perf_counter() - start, len(transaction_df), get_directory_size('input'))
+
+    backend = DuckDBBackend('input')
+    first_day = DEFAULT_START.date()
+    last_day = date.fromordinal(first_day.toordinal() + DAYS - 1)
+
+    start = perf_counter()
+    report_df = backend.query(
+        build_rollup_query(['truck_name', 'payment_method', 'hour'], first_day, first_day))
+    compute_report_metrics(report_df, first_day)
+    record('report', perf_counter() - start, int(report_df['transaction_count'].sum()))
+
+    start = perf_counter()
+    dashboard_df = backend.query(build_rollup_query(
+        ['year', 'month', 'day', 'hour', 'payment_method', 'truck_name'], first_day, last_day))
+    dashboard_df['at'] = pd.to_datetime(
+        dashboard_df[['year', 'month', 'day', 'hour']].astype(int))
+    dashboard_df = add_derived_columns(dashboard_df)
+    trucks = tuple(dashboard_df['truck_name'].unique())
+    for metric in METRICS:
+        for time_scale in TIME_SCALE_COLUMNS:
+            compute_cube(dashboard_df, metric, time_scale, trucks)
+    record('dashboard', perf_counter() - start, int(dashboard_df['transaction_count'].sum()))
+
+    return results
+
+
+def run_scale_in_subprocess(rows: int, dirty_rate: float, workers: int) -> list[dict]:
+    """Generates the data, then runs the stages in a new interpreter and working directory
+    so the peak RSS of each scale is its own and doesn't include generating the data"""
+    with TemporaryDirectory() as work_dir:
+        start = perf_counter()
+        subprocess.run(
+            [sys.executable, path.join(PIPELINE_DIR, 'generate_data.py'), str(rows),
+             '--out', 'source.db', '--dirty-rate', str(dirty_rate), '--days', str(DAYS)],
+            cwd=work_dir, check=True
+        )
+        generate_seconds = perf_counter() - start
+        source_bytes = path.getsize(path.join(work_dir, 'source.db'))
+
+        result = subprocess.run(
+            [sys.executable, path.abspath(__file__), '--run-scale', str(rows),
+             '--workers', str(workers)],
+            cwd=work_dir, capture_output=True, text=True, check=True
+        )
+
+    generate_result = {
+        "stage": 'generate', "rows": rows, "stage_rows": rows,
+        "seconds": round(generate_seconds, 4), "rows_per_second": round(rows / generate_seconds),
+        "peak_rss_mb": None, "output_bytes": source_bytes
+    }
+    return [generate_result] + json.loads(result.stdout.strip().splitlines()[-1])
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='Benchmarks each pipeline stage at increasing scale')
+    parser.add_argument('--scales', type=int, nargs='+', default=DEFAULT_SCALES,
+                        help='numbers of transactions to generate')
+    parser.add_argument('--dirty-rate', type=float, default=DEFAULT_DIRTY_RATE)
+    parser.add_argument('--workers', type=int, default=DEFAULT_WORKERS,
+                        help='connections the extract step reads over')
+    parser.add_argument('--output', default='benchmark_results.jsonl',
+                        help='file the results are appended to')
+    parser.add_argument('--run-scale', type=int, help=SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run_scale:
+        print(json.dumps(run_scale(args.run_scale, args.workers)))
+        sys.exit(0)
+
+    run_at = datetime.now(timezone.utc).isoformat(timespec='seconds')
+    print(f'{"rows":>12} {"stage":<10}{"seconds":>10}{"rows/s":>14}'
+          f'{"peak RSS MB":>13}{"output bytes":>14}')
+    with open(args.output, 'a', encoding='utf-8') as f:
+        for scale in args.scales:
+            for stage_result in run_scale_in_subprocess(scale, args.dirty_rate, args.workers):
+                f.write(json.dumps({"run_at": run_at, **stage_result}) + '\n')
+                print(f'{scale:>12,} {stage_result["stage"]:<10}'
+                      f'{stage_result["seconds"]:>10.2f}{stage_result["rows_per_second"]:>14,}'
+                      f'{stage_result["peak_rss_mb"] or "":>13}'
+                      f'{stage_result["output_bytes"] or "":>14}')
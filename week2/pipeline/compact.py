@@ -0,0 +1,145 @@
+"""Compacts the small files in closed hour partitions of the transaction dataset.
+Each incremental load adds another file to the current hour, so once an hour is
+over its files are rewritten into one. The compacted file records which files
+it replaced, so a run that stops part way through is finished off by the next"""
+import json
+from argparse import ArgumentParser
+from datetime import datetime, timedelta
+from uuid import uuid4
+import pyarrow as pa
+import pyarrow.parquet as pq
+from pyarrow import fs
+from partition_writer import (PARQUET_WRITER_PROFILE, drop_duplicate_transactions,
+                              get_filesystem, get_parquet_filename, write_parquet)
+
+TRANSACTION_DATASET_PATH = 's3://c20-sami-truck-s3-bucket/input/transaction/transaction.parquet'
+COMPACTED_PREFIX = 'compacted-'
+SOURCES_METADATA_KEY = b'compacted_from'
+DEFAULT_GRACE_HOURS = 1
+
+
+def get_partition_files(filesystem: fs.FileSystem, path: str) -> dict[str, list[fs.FileInfo]]:
+    """Returns the visible parquet files in the dataset grouped by their partition directory"""
+    selector = fs.FileSelector(path, recursive=True, allow_not_found=True)
+    partitions = {}
+    for info in filesystem.get_file_info(selector):
+        if (info.type == fs.FileType.File and info.base_name.endswith('.parquet')
+                and not info.base_name.startswith(('_', '.'))):
+            partitions.setdefault(info.path.rsplit('/', 1)[0], []).append(info)
+
+    return partitions
+
+
+def get_partition_values(partition_dir: str) -> dict[str, int]:
+    """Returns the partition column values from a year=/month=/day=/hour= directory"""
+    parts = [part.split('=', 1) for part in partition_dir.split('/') if '=' in part]
+    return {column: int(value) for column, value in parts}
+
+
+def get_partition_hour(partition_dir: str) -> datetime:
+    """Returns the start of the hour a partition directory holds"""
+    return datetime(**get_partition_values(partition_dir))
+
+
+def is_closed_partition(partition_dir: str, grace_hours: int = DEFAULT_GRACE_HOURS) -> bool:
+    """Returns True if the partition's hour ended more than grace_hours ago"""
+    hour_end = get_partition_hour(partition_dir) + timedelta(hours=1)
+    return hour_end + timedelta(hours=grace_hours) <= datetime.now()
+
+
+def remove_replaced_files(filesystem: fs.FileSystem,
+                          files: list[fs.FileInfo]) -> list[fs.FileInfo]:
+    """Deletes files an earlier compaction already merged but didn't get to delete.
+    Returns the files that are left"""
+    replaced = set()
+    for info in files:
+        if info.base_name.startswith(COMPACTED_PREFIX):
+            metadata = pq.read_schema(info.path, filesystem=filesystem).metadata or {}
+            replaced.update(json.loads(metadata.get(SOURCES_METADATA_KEY, b'[]')))
+
+    for info in files:
+        if info.base_name in replaced:
+            filesystem.delete_file(info.path)
+
+    return [info for info in files if info.base_name not in replaced]
+
+
+def compact_partition(filesystem: fs.FileSystem, partition_dir: str,
+                      files: list[fs.FileInfo],
+                      profile: str = PARQUET_WRITER_PROFILE) -> fs.FileInfo:
+    """Rewrites the partition's files as one file and deletes the originals.
+    The new file is written under a hidden name first and then moved into place.
+    Until the originals are deleted readers see their rows twice, which the rollup allows for.
+    With a sorting writer profile the rows of every file are sorted together.
+    Partitions written before loads were deduplicated can hold a transaction more than once,
+    so only its first row is kept"""
+    table = drop_duplicate_transactions(pa.concat_tables(
+        [pq.read_table(info.path, filesystem=filesystem) for info in files],
+        promote_options='permissive'
+    ))
+    sources = json.dumps([info.base_name for info in files]).encode('utf-8')
+    table = table.replace_schema_metadata(
+        {**(table.schema.metadata or {}), SOURCES_METADATA_KEY: sources})
+
+    filename = get_parquet_filename(f'{COMPACTED_PREFIX}{uuid4().hex}', profile)
+    temp_path = f'{partition_dir}/_{filename}'
+    compacted_path = f'{partition_dir}/{filename}'
+
+    # On S3 a move is a copy then a delete, so the hidden file is removed if either fails
+    try:
+        write_parquet(table, temp_path, filesystem, profile)
+        filesystem.move(temp_path, compacted_path)
+    finally:
+        if filesystem.get_file_info(temp_path).type == fs.FileType.File:
+            filesystem.delete_file(temp_path)
+    for info in files:
+        filesystem.delete_file(info.path)
+
+    return filesystem.get_file_info(compacted_path)
+
+
+def compact_dataset(path: str = TRANSACTION_DATASET_PATH,
+                    grace_hours: int = DEFAULT_GRACE_HOURS,
+                    dry_run: bool = False) -> dict[str, int]:
+    """Compacts every closed partition with more than one file.
+    Returns the number of files and bytes in those partitions before and after"""
+    filesystem, path = get_filesystem(path)
+    stats = {"partitions": 0, "files_before": 0, "bytes_before": 0,
+             "files_after": 0, "bytes_after": 0}
+
+    for partition_dir, files in sorted(get_partition_files(filesystem, path).items()):
+        if not is_closed_partition(partition_dir, grace_hours):
+            continue
+        if not dry_run:
+            files = remove_replaced_files(filesystem, files)
+        if len(files) <= 1:
+            continue
+
+        stats['partitions'] += 1
+        stats['files_before'] += len(files)
+        stats['bytes_before'] += sum(info.size for info in files)
+        if dry_run:
+            continue
+
+        compacted = compact_partition(filesystem, partition_dir, files)
+        stats['files_after'] += 1
+        stats['bytes_after'] += compacted.size
+
+    print(f'Compacted {stats["partitions"]} partitions: '
+          f'{stats["files_before"]} files ({stats["bytes_before"]} bytes) -> '
+          f'{stats["files_after"]} files ({stats["bytes_after"]} bytes)')
+
+    return stats
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='Compacts closed hour partitions of the transactions')
+    parser.add_argument('--path', default=TRANSACTION_DATASET_PATH,
+                        help='local or s3:// path of the partitioned transaction dataset')
+    parser.add_argument('--grace-hours', type=int, default=DEFAULT_GRACE_HOURS,
+                        help='hours to wait after a partition closes before compacting it')
+    parser.add_argument('--dry-run', action='store_true',
+                        help='only report what would be compacted')
+    args = parser.parse_args()
+
+    compact_dataset(args.path, args.grace_hours, args.dry_run)
@@ -1,12 +1,30 @@
 """Extracts food truck data from RDS"""
-from os import environ
+from os import environ, path, remove
+from argparse import ArgumentParser
 from datetime import datetime
+from time import perf_counter
 from pymysql import connect, Connection
+from pymysql.cursors import SSCursor
 from dotenv import load_dotenv
 import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
 import awswrangler as wr
+from truck_common.query_backend import get_backend
+from watermark import Watermark, read_watermark, stage_watermark
+from truck_common.instrumentation import stage, get_frame_bytes
+from truck_common.fingerprint import DIMENSION_TABLES, find_unchanged_tables, read_loaded_table
 
 DATABASE_NAME = 'c20-sami-truck-database'
+STREAM_BATCH_SIZE = 50_000
+STREAMED_TRANSACTION_PATH = './data/transaction.parquet'
+TRANSACTION_SCHEMA = pa.schema([
+    ('transaction_id', pa.int64()),
+    ('truck_id', pa.int64()),
+    ('payment_method_id', pa.int64()),
+    ('total', pa.float64()),
+    ('at', pa.timestamp('us'))
+])
 
 
 def get_db_connection() -> None:
@@ -27,14 +45,14 @@ def get_most_recent_timestamp() -> datetime | None:
     """Returns a datetime for the most recent entry found in the database"""
     sql_query = """
         SELECT
-            at
+            "at"
         FROM transaction
-        ORDER BY at DESC
+        ORDER BY "at" DESC
         LIMIT 1;
     """
 
     try:
-        timestamp = wr.athena.read_sql_query(sql_query, DATABASE_NAME)['at'][0]
+        timestamp = get_backend(database=DATABASE_NAME).query(sql_query)['at'][0]
         return timestamp.to_pydatetime()
     except wr.exceptions.QueryFailed as e:
         print(f'Could not retrieve most recent timestamp from database: {e}')
@@ -46,30 +64,170 @@ def get_all_data() -> pd.DataFrame:
     sql_query = """
         SELECT *
         FROM transaction
-        ORDER BY at DESC;
+        ORDER BY "at" DESC;
     """
 
-    data = wr.athena.read_sql_query(sql_query, DATABASE_NAME)
+    data = get_backend(database=DATABASE_NAME).query(sql_query)
     return data
 
 
-def download_save_data(conn: Connection, timestamp: datetime) -> None:
+def get_starting_watermark() -> Watermark | None:
+    """Returns the stored watermark, falling back to athena on the first run"""
+    watermark = read_watermark()
+    if watermark is not None:
+        return watermark
+
+    timestamp = get_most_recent_timestamp()
+    if timestamp is None:
+        return None
+    return timestamp, None
+
+
+def get_watermark_condition(watermark: Watermark | None) -> tuple[str, tuple]:
+    """Returns the condition matching transactions after the watermark, with its parameters"""
+    if watermark is None:
+        return 'TRUE', ()
+    if watermark[1] is None:
+        return 'at >= %s', (watermark[0],)
+
+    return '(at, transaction_id) > (%s, %s)', tuple(watermark)
+
+
+def get_transaction_query(watermark: Watermark | None,
+                          limit: int | None = None) -> tuple[str, tuple]:
+    """Returns a keyset query for transactions after the watermark, with its parameters.
+    With a limit only the first rows after the watermark are returned"""
+    condition, params = get_watermark_condition(watermark)
+    sql_query = f"""
+        SELECT transaction_id, truck_id, payment_method_id, total, at
+        FROM FACT_Transaction
+        WHERE {condition}
+    """
+    limit_clause = f' LIMIT {int(limit)}' if limit is not None else ''
+
+    return sql_query + f' ORDER BY at, transaction_id{limit_clause};', params
+
+
+def download_dimension_data(conn: Connection) -> dict[str, pd.DataFrame]:
+    """Returns the truck and payment method tables.
+    Tables unchanged since they were last loaded are read from the loaded copy instead"""
+    unchanged_tables = find_unchanged_tables(conn)
+    dimension_data = {}
+    for table, source_table in DIMENSION_TABLES.items():
+        if table in unchanged_tables:
+            print(f'{source_table} is unchanged, using the loaded copy')
+            dimension_data[table] = read_loaded_table(table)
+        else:
+            dimension_data[table] = pd.read_sql(f'SELECT * FROM {source_table};', conn)
+
+    return dimension_data
+
+
+def download_data(conn: Connection, watermark: Watermark | None) -> dict[str, pd.DataFrame]:
+    """Returns all tables, with only the transactions after the watermark"""
+    all_data = download_dimension_data(conn)
+
+    sql_query, params = get_transaction_query(watermark)
+    transaction_df = pd.read_sql(sql_query, conn, params=params)
+    all_data['transaction'] = transaction_df
+
+    if not transaction_df.empty:
+        last_row = transaction_df.iloc[-1]
+        stage_watermark((last_row['at'].to_pydatetime(), int(last_row['transaction_id'])))
+
+    return all_data
+
+
+def save_data(all_data: dict[str, pd.DataFrame]) -> None:
+    """Saves each table in the given dict to a csv file.
+    Transform reads streamed transactions in preference to the csv, so any left by an
+    earlier --stream run are removed rather than reloaded in place of these"""
+    for key in all_data:
+        all_data[key].to_csv(f'./data/{key}.csv', index=False)
+    if 'transaction' in all_data and path.exists(STREAMED_TRANSACTION_PATH):
+        remove(STREAMED_TRANSACTION_PATH)
+
+
+def download_save_dimension_data(conn: Connection) -> None:
+    """Downloads and saves the truck and payment method tables"""
+    save_data(download_dimension_data(conn))
+
+
+def download_save_data(conn: Connection, watermark: Watermark | None) -> None:
     """Downloads and saves all data from the given database connection"""
-    truck_df = pd.read_sql('SELECT * FROM DIM_Truck;', conn)
-    payment_method_df = pd.read_sql('SELECT * FROM DIM_Payment_Method;', conn)
-    transaction_df = pd.read_sql(f"""
-            SELECT * FROM FACT_Transaction
-            WHERE at >= '{timestamp}'
-            ORDER BY at DESC;
-        """, conn)
+    save_data(download_data(conn, watermark))
+
+
+def batch_to_arrow(rows: tuple[tuple], columns: list[str]) -> pa.Table:
+    """Converts a batch of cursor rows into an arrow table matching TRANSACTION_SCHEMA"""
+    values = dict(zip(columns, zip(*rows)))
+
+    return pa.Table.from_arrays(
+        [pa.array(values[field.name]).cast(field.type) for field in TRANSACTION_SCHEMA],
+        schema=TRANSACTION_SCHEMA
+    )
 
-    truck_df.to_csv('./data/truck.csv', index=False)
-    payment_method_df.to_csv('./data/payment_method.csv', index=False)
-    transaction_df.to_csv('./data/transaction.csv', index=False)
+
+def stream_transaction_data(conn: Connection, watermark: Watermark | None,
+                            filepath: str = STREAMED_TRANSACTION_PATH,
+                            batch_size: int = STREAM_BATCH_SIZE) -> dict[str, float]:
+    """Streams new transactions through an unbuffered cursor into a parquet file,
+    writing one row group per batch so memory use doesn't grow with the row count"""
+    sql_query, params = get_transaction_query(watermark)
+
+    start = perf_counter()
+    row_count = 0
+    bytes_read = 0
+    last_row = None
+
+    with conn.cursor(SSCursor) as cursor, pq.ParquetWriter(filepath, TRANSACTION_SCHEMA) as writer:
+        cursor.execute(sql_query, params)
+        columns = [description[0] for description in cursor.description]
+
+        while rows := cursor.fetchmany(batch_size):
+            batch = batch_to_arrow(rows, columns)
+            writer.write_table(batch, row_group_size=batch_size)
+            row_count += batch.num_rows
+            bytes_read += batch.nbytes
+            last_row = rows[-1]
+
+    if last_row is not None:
+        last_row = dict(zip(columns, last_row))
+        stage_watermark((last_row['at'], last_row['transaction_id']))
+
+    seconds = max(perf_counter() - start, 1e-9)
+    stats = {
+        "rows": row_count,
+        "bytes_read": bytes_read,
+        "bytes_written": path.getsize(filepath),
+        "seconds": seconds,
+        "rows_per_second": row_count / seconds,
+        "bytes_per_second": bytes_read / seconds
+    }
+    print(f'Streamed {row_count} transactions in {seconds:.2f}s '
+          f'({stats["rows_per_second"]:.0f} rows/s, {stats["bytes_per_second"] / 1e6:.2f} MB/s)')
+
+    return stats
 
 
 if __name__ == '__main__':
-    most_recent_timestamp = get_most_recent_timestamp()
-    connection = get_db_connection()
-    download_save_data(connection, most_recent_timestamp)
-    connection.close()
+    parser = ArgumentParser(description='Extracts new truck transactions from RDS')
+    parser.add_argument('--stream', action='store_true',
+                        help='stream transactions to parquet in bounded batches')
+    args = parser.parse_args()
+
+    with stage('extract', streamed=args.stream) as metrics:
+        starting_watermark = get_starting_watermark()
+        connection = get_db_connection()
+        if args.stream:
+            download_save_dimension_data(connection)
+            stream_stats = stream_transaction_data(connection, starting_watermark)
+            metrics['rows_out'] = stream_stats['rows']
+            metrics['bytes_read'] = stream_stats['bytes_read']
+            metrics['bytes_written'] = stream_stats['bytes_written']
+        else:
+            extracted_data = download_data(connection, starting_watermark)
+            metrics['rows_out'] = len(extracted_data['transaction'])
+            metrics['bytes_read'] = sum(get_frame_bytes(df) for df in extracted_data.values())
+            save_data(extracted_data)
+        connection.close()
@@ -0,0 +1,174 @@
+"""Generates synthetic truck data in the layout of the RDS tables, at any scale.
+The trucks, prices, payment methods and hours of trade follow the real sample in
+week1/pipeline/all_data.csv. A share of the transactions can be made invalid in
+each of the ways the transform step rejects. Transactions are generated in chunks,
+so 100M rows can be written to csv or a SQLite stand-in without holding them at once"""
+import sqlite3
+from argparse import ArgumentParser
+from collections.abc import Iterator
+from datetime import datetime
+from os import makedirs, path
+import numpy as np
+import pandas as pd
+
+CHUNK_SIZE = 1_000_000
+DEFAULT_START = datetime(2025, 10, 1)
+TRUCKS = pd.DataFrame({
+    "truck_id": [1, 2, 3, 4, 5, 6],
+    "truck_name": ['Burrito Madness', 'Kings of Kebabs', 'Cupcakes by Michelle',
+                   "Hartmann's Jellied Eels", 'Yoghurt Heaven', 'SuperSmoothie'],
+    "truck_description": [
+        'An authentic taste of Mexico.',
+        'Locally-sourced meat cooked over a charcoal grill.',
+        'Handcrafted cupcakes made with high-quality, organic ingredients.',
+        'A taste of history with this classic English dish.',
+        'All the great tastes, but only some of the calories!',
+        "Pick any fruit or vegetable, and we'll make you a delicious, healthy, "
+        'multi-vitamin shake. Live well; live wild.'
+    ],
+    "has_card_reader": [1, 1, 1, 1, 1, 0],
+    "fsa_rating": [4, 2, 5, 4, 4, 3]
+})
+PAYMENT_METHODS = pd.DataFrame({"payment_method_id": [1, 2], "payment_method": ['cash', 'card']})
+
+TRUCK_WEIGHTS = [0.22, 0.16, 0.21, 0.05, 0.22, 0.14]
+CARD_SHARE = [0.52, 0.58, 0.55, 0.58, 0.51, 0.0]
+# (menu prices in pence, their weights, share of orders priced between the tail bounds)
+TRUCK_PRICES = [
+    ([700], [1.0], 0.3),
+    ([700], [1.0], 0.7),
+    ([499, 799, 299, 1299, 199], [0.33, 0.29, 0.2, 0.09, 0.09], 0.0),
+    ([99, 399, 499], [0.5, 0.33, 0.17], 0.0),
+    ([500], [1.0], 0.09),
+    ([599, 499, 699], [0.49, 0.32, 0.19], 0.0)
+]
+PRICE_TAIL = (800, 1100)
+HOUR_WEIGHTS = {9: 0.029, 10: 0.031, 11: 0.099, 12: 0.125, 13: 0.16, 14: 0.195, 15: 0.114,
+                16: 0.103, 17: 0.028, 18: 0.032, 19: 0.021, 20: 0.019, 21: 0.019, 22: 0.014,
+                23: 0.011}
+
+DIRTY_ROW_KINDS = ['missing_transaction_id', 'unknown_truck_id', 'unknown_payment_method_id',
+                   'invalid_total', 'invalid_at']
+
+
+def generate_totals(rng: np.random.Generator, truck_index: np.ndarray) -> np.ndarray:
+    """Returns an order total in pence for each row, from its truck's menu"""
+    totals = np.empty(len(truck_index))
+    for index, (prices, weights, tail_share) in enumerate(TRUCK_PRICES):
+        rows = np.flatnonzero(truck_index == index)
+        totals[rows] = rng.choice(prices, size=len(rows), p=weights)
+        in_tail = rows[rng.random(len(rows)) < tail_share]
+        totals[in_tail] = rng.integers(*PRICE_TAIL, len(in_tail)) // 10 * 10
+
+    return totals
+
+
+def generate_times(rng: np.random.Generator, positions: np.ndarray, rows: int,
+                   start: datetime, days: int) -> np.ndarray:
+    """Returns a time for each row, spreading the rows evenly over the days in order
+    and over the hours of trade as the real trucks are"""
+    day = positions * days // rows
+    hour = rng.choice(list(HOUR_WEIGHTS), size=len(positions),
+                      p=np.array(list(HOUR_WEIGHTS.values())) / sum(HOUR_WEIGHTS.values()))
+    seconds = day * 86400 + hour * 3600 + rng.integers(0, 3600, len(positions)) // 60 * 60
+
+    return np.sort(np.datetime64(start, 's') + seconds.astype('timedelta64[s]'))
+
+
+def add_dirty_rows(rng: np.random.Generator, df: pd.DataFrame, dirty_rate: float) -> pd.DataFrame:
+    """Breaks dirty_rate of the rows, split evenly between the kinds of invalid row"""
+    dirty = np.flatnonzero(rng.random(len(df)) < dirty_rate)
+    kinds = rng.integers(0, len(DIRTY_ROW_KINDS), len(dirty))
+    df = df.astype({"transaction_id": 'float64', "truck_id": 'float64',
+                    "payment_method_id": 'float64', "at": 'object'})
+
+    for kind_index, kind in enumerate(DIRTY_ROW_KINDS):
+        rows = df.index[dirty[kinds == kind_index]]
+        if kind == 'missing_transaction_id':
+            df.loc[rows, 'transaction_id'] = np.nan
+        elif kind == 'unknown_truck_id':
+            df.loc[rows, 'truck_id'] = TRUCKS['truck_id'].max() + 1
+        elif kind == 'unknown_payment_method_id':
+            df.loc[rows, 'payment_method_id'] = PAYMENT_METHODS['payment_method_id'].max() + 1
+        elif kind == 'invalid_total':
+            df.loc[rows, 'total'] = rng.choice([0, np.nan], len(rows))
+        else:
+            df.loc[rows, 'at'] = None
+
+    return df
+
+
+def generate_transaction_chunks(rows: int, dirty_rate: float = 0.0, days: int = 30,
+                                start: datetime = DEFAULT_START, seed: int = 0,
+                                chunk_size: int = CHUNK_SIZE) -> Iterator[pd.DataFrame]:
+    """Yields FACT_Transaction rows in time order, chunk_size at a time"""
+    rng = np.random.default_rng(seed)
+    for chunk_start in range(0, rows, chunk_size):
+        positions = np.arange(chunk_start, min(chunk_start + chunk_size, rows))
+        truck_index = rng.choice(len(TRUCKS), size=len(positions), p=TRUCK_WEIGHTS)
+        is_card = rng.random(len(positions)) < np.array(CARD_SHARE)[truck_index]
+
+        df = pd.DataFrame({
+            "transaction_id": positions + 1,
+            "truck_id": TRUCKS['truck_id'].to_numpy()[truck_index],
+            "payment_method_id": np.where(is_card, 2, 1),
+            "total": generate_totals(rng, truck_index),
+            "at": generate_times(rng, positions, rows, start, days).astype(str)
+        })
+        df['at'] = df['at'].str.replace('T', ' ')
+
+        yield add_dirty_rows(rng, df, dirty_rate) if dirty_rate else df
+
+
+def generate_data(rows: int, dirty_rate: float = 0.0, days: int = 30,
+                  seed: int = 0) -> dict[str, pd.DataFrame]:
+    """Returns the truck, payment method and transaction tables, as extract downloads them"""
+    return {
+        "truck": TRUCKS.copy(),
+        "payment_method": PAYMENT_METHODS.copy(),
+        "transaction": pd.concat(generate_transaction_chunks(rows, dirty_rate, days, seed=seed),
+                                 ignore_index=True)
+    }
+
+
+def write_csv(out_dir: str, rows: int, dirty_rate: float = 0.0, days: int = 30,
+              seed: int = 0) -> None:
+    """Writes truck.csv, payment_method.csv and transaction.csv, as extract saves them"""
+    makedirs(out_dir, exist_ok=True)
+    TRUCKS.to_csv(path.join(out_dir, 'truck.csv'), index=False)
+    PAYMENT_METHODS.to_csv(path.join(out_dir, 'payment_method.csv'), index=False)
+
+    transaction_path = path.join(out_dir, 'transaction.csv')
+    for index, chunk in enumerate(generate_transaction_chunks(rows, dirty_rate, days, seed=seed)):
+        chunk.to_csv(transaction_path, index=False, mode='w' if index == 0 else 'a',
+                     header=index == 0)
+
+
+def write_sqlite(db_path: str, rows: int, dirty_rate: float = 0.0, days: int = 30,
+                 seed: int = 0) -> None:
+    """Writes DIM_Truck, DIM_Payment_Method and FACT_Transaction to a SQLite database
+    that can stand in for RDS"""
+    with sqlite3.connect(db_path) as conn:
+        TRUCKS.to_sql('DIM_Truck', conn, index=False, if_exists='replace')
+        PAYMENT_METHODS.to_sql('DIM_Payment_Method', conn, index=False, if_exists='replace')
+        conn.execute('DROP TABLE IF EXISTS FACT_Transaction;')
+        for chunk in generate_transaction_chunks(rows, dirty_rate, days, seed=seed):
+            chunk.to_sql('FACT_Transaction', conn, index=False, if_exists='append')
+        conn.execute('CREATE INDEX transaction_at ON FACT_Transaction (at, transaction_id);')
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='Generates synthetic truck data')
+    parser.add_argument('rows', type=int, help='number of transactions')
+    parser.add_argument('--out', default='./data',
+                        help='directory for csv files, or a .db file for SQLite')
+    parser.add_argument('--dirty-rate', type=float, default=0.0,
+                        help='share of transactions the transform step should reject')
+    parser.add_argument('--days', type=int, default=30)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    if args.out.endswith('.db'):
+        write_sqlite(args.out, args.rows, args.dirty_rate, args.days, args.seed)
+    else:
+        write_csv(args.out, args.rows, args.dirty_rate, args.days, args.seed)
@@ -3,9 +3,19 @@
 """The data uploading step of the pipeline.
 Pushes cleaned data as parquet files to an S3 bucket."""
 from os import environ
+from argparse import ArgumentParser
 import pandas as pd
 import awswrangler as wr
 from dotenv import load_dotenv
+from watermark import commit_pending_watermark
+from schema import (TRANSACTION_DTYPES, TRUCK_DTYPES, PAYMENT_METHOD_DTYPES,
+                    TABLE_STORAGE_DTYPES, apply_schema)
+from partition_writer import (PARQUET_WRITER_PROFILE, WRITER_PROFILES, write_partitioned_dataset,
+                              get_files_size, get_written_partitions)
+from rollup import update_rollup
+from truck_common.instrumentation import stage
+from truck_common.fingerprint import (get_fingerprint, read_fingerprint, write_fingerprint,
+                                      clear_pending_checksums)
 
 load_dotenv()
 AWS_SECRET_ACCESS_KEY = environ['AWS_SECRET_ACCESS_KEY']
@@ -15,53 +25,130 @@ S3_BUCKET_NAME = environ['S3_BUCKET_NAME']
 S3_FILEPATH = 's3://c20-sami-truck-s3-bucket/input/'
 
 
-def save_and_upload_parquet() -> dict[pd.DataFrame]:
-    """Saves truck and payment data as parquet files, and uploads them to an S3"""
-    truck_df = pd.read_csv('data/clean_truck.csv')
-    payment_df = pd.read_csv('data/clean_payment_method.csv')
+def upload_dimension_data(truck_df: pd.DataFrame, payment_df: pd.DataFrame,
+                          save_local: bool = False) -> tuple[int, list[str]]:
+    """Uploads truck and payment data to an S3, optionally saving local parquet copies.
+    Tables whose contents haven't changed since the last upload are skipped.
+    Returns the number of bytes uploaded and the tables skipped"""
+    if save_local:
+        truck_df.to_parquet('data/clean_truck.parquet')
+        payment_df.to_parquet('data/clean_payment_method.parquet')
 
-    truck_df.to_parquet('data/clean_truck.parquet')
-    payment_df.to_parquet('data/clean_payment_method.parquet')
+    bytes_written = 0
+    skipped_tables = []
+    for table, df in {"truck": truck_df, "payment_method": payment_df}.items():
+        fingerprint = get_fingerprint(df, table)
+        stored_fingerprint = read_fingerprint(table, S3_FILEPATH)
+        if stored_fingerprint.get('content_hash') == fingerprint['content_hash']:
+            skipped_tables.append(table)
+        else:
+            bytes_written += upload_parquet_to_s3(df, table, False)
+        if stored_fingerprint != fingerprint:
+            write_fingerprint(table, fingerprint, S3_FILEPATH)
 
-    upload_parquet_to_s3(truck_df, 'truck', False)
-    upload_parquet_to_s3(payment_df, 'payment_method', False)
+    clear_pending_checksums()
+    if skipped_tables:
+        print(f'Skipped unchanged dimension tables: {skipped_tables}')
 
+    return bytes_written, skipped_tables
 
-def save_and_upload_partitioned_parquet() -> None:
-    """Saves transaction data as partitioned parquet files, and uploads them to an S3"""
-    transaction_df = pd.read_csv('data/clean_transaction.csv')
-    transaction_df['at'] = pd.to_datetime(transaction_df['at'])
 
+def add_time_partition_columns(transaction_df: pd.DataFrame) -> pd.DataFrame:
+    """Adds the year, month, day and hour columns the transactions are partitioned by"""
     transaction_df['year'] = transaction_df['at'].dt.year
     transaction_df['month'] = transaction_df['at'].dt.month
     transaction_df['day'] = transaction_df['at'].dt.day
     transaction_df['hour'] = transaction_df['at'].dt.hour
 
-    transaction_df.to_parquet('data/clean_transaction.parquet',
-                              partition_cols=['year', 'month', 'day', 'hour'])
+    return transaction_df
 
-    upload_parquet_to_s3(transaction_df, 'transaction', True)
 
+def upload_transaction_data(transaction_df: pd.DataFrame, save_local: bool = False,
+                            profile: str = PARQUET_WRITER_PROFILE) -> int:
+    """Uploads transactions to an S3 partitioned by hour, optionally saving a local copy.
+    Transactions already in the dataset are skipped, and the hourly rollup and sketches are
+    updated for the hours that got new transactions, so reloading the same rows rewrites nothing.
+    Every file is written with the given writer profile.
+    Returns the number of bytes of transactions uploaded"""
+    transaction_df = add_time_partition_columns(transaction_df)
 
-def upload_parquet_to_s3(
-        data: pd.DataFrame, filename: str, is_time_partitioned: bool = False) -> None:
-    """Uploads parquet files to an S3. Can handle both partitioned and non-partitioned"""
+    if save_local:
+        local_files = write_partitioned_dataset(transaction_df, 'data/clean_transaction.parquet',
+                                                write_mode='dedupe', profile=profile)
+        update_rollup(get_written_partitions(local_files), 'data/clean_transaction.parquet',
+                      'data/clean_transaction_rollup.parquet',
+                      'data/clean_transaction_sketch.parquet', profile)
+
+    dataset_path = f'{S3_FILEPATH}transaction/transaction.parquet'
+    files = upload_partitioned_parquet(transaction_df, 'transaction', 'dedupe', profile)
+    update_rollup(get_written_partitions(files), dataset_path,
+                  f'{S3_FILEPATH}transaction_rollup/transaction_rollup.parquet',
+                  f'{S3_FILEPATH}transaction_sketch/transaction_sketch.parquet', profile)
+
+    return get_files_size(files, dataset_path)
+
+
+def save_and_upload_parquet(save_local: bool = False) -> tuple[int, list[str]]:
+    """Uploads truck and payment data to an S3, optionally saving them as local parquet files.
+    Returns the number of bytes uploaded and the unchanged tables skipped"""
+    truck_df = apply_schema(pd.read_csv('data/clean_truck.csv'), TRUCK_DTYPES)
+    payment_df = apply_schema(pd.read_csv('data/clean_payment_method.csv'), PAYMENT_METHOD_DTYPES)
+
+    return upload_dimension_data(truck_df, payment_df, save_local)
+
+
+def save_and_upload_partitioned_parquet(save_local: bool = False,
+                                        profile: str = PARQUET_WRITER_PROFILE) -> tuple[int, int]:
+    """Uploads transaction data to an S3 partitioned by hour,
+    optionally saving it as local partitioned parquet files.
+    Returns the number of transactions and bytes uploaded"""
+    transaction_df = pd.read_csv('data/clean_transaction.csv', parse_dates=['at'])
+    transaction_df = apply_schema(transaction_df, TRANSACTION_DTYPES)
+
+    return len(transaction_df), upload_transaction_data(transaction_df, save_local, profile)
+
+
+def upload_partitioned_parquet(data: pd.DataFrame, filename: str, write_mode: str = 'append',
+                               profile: str = PARQUET_WRITER_PROFILE) -> list[str]:
+    """Uploads the data to an S3 partitioned by hour, laid out by the named writer profile.
+    Rows already stored are skipped with write_mode='dedupe'. Returns the files written"""
+    files = write_partitioned_dataset(data, f'{S3_FILEPATH}{filename}/{filename}.parquet',
+                                      write_mode=write_mode, profile=profile)
+    print(f'Uploaded {len(files)} {filename} partitions')
+
+    return files
+
+
+def upload_parquet_to_s3(data: pd.DataFrame, filename: str, is_time_partitioned: bool = False,
+                         write_mode: str = 'append', profile: str = PARQUET_WRITER_PROFILE) -> int:
+    """Uploads parquet files to an S3. Can handle both partitioned and non-partitioned.
+    Partitioned uploads can skip rows already stored with write_mode='dedupe',
+    and are laid out by the named writer profile.
+    Returns the number of bytes uploaded"""
     if is_time_partitioned:
-        wr.s3.to_parquet(
-            df = data,
-            path = f'{S3_FILEPATH}{filename}/{filename}.parquet',
-            dataset = True,
-            partition_cols = ['year', 'month', 'day', 'hour']
-        )
-        return
-
-    wr.s3.to_parquet(
-        df = data,
+        files = upload_partitioned_parquet(data, filename, write_mode, profile)
+        return get_files_size(files, f'{S3_FILEPATH}{filename}/{filename}.parquet')
+
+    result = wr.s3.to_parquet(
+        df = apply_schema(data, TABLE_STORAGE_DTYPES.get(filename, {})),
         path = f'{S3_FILEPATH}{filename}/{filename}.parquet',
         dataset = False
     )
+    return sum(wr.s3.size_objects(result['paths']).values())
 
 
 if __name__ == '__main__':
-    save_and_upload_parquet()
-    save_and_upload_partitioned_parquet()
+    parser = ArgumentParser(description='Uploads the cleaned truck data to S3')
+    parser.add_argument('--save-local', action='store_true',
+                        help='also save the parquet files to ./data')
+    parser.add_argument('--writer-profile', choices=list(WRITER_PROFILES),
+                        default=PARQUET_WRITER_PROFILE,
+                        help='how the transaction, rollup and sketch files are laid out')
+    args = parser.parse_args()
+
+    with stage('load') as metrics:
+        dimension_bytes, metrics['skipped_dimensions'] = save_and_upload_parquet(args.save_local)
+        metrics['rows_in'], transaction_bytes = save_and_upload_partitioned_parquet(
+            args.save_local, args.writer_profile)
+        metrics['bytes_written'] = dimension_bytes + transaction_bytes
+    commit_pending_watermark()
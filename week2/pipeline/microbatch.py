@@ -0,0 +1,189 @@
+"""Runs extract, transform and load continuously in small batches.
+FACT_Transaction is polled over one long lived connection for rows after the
+watermark, at most MAX_BATCH_ROWS at a time so memory stays bounded. A full batch
+means the loader is behind, so the next poll runs straight away instead of waiting.
+Each batch is cleaned, appended to its hour partitions and the rollup and sketches
+updated, and an hour is compacted into one file once transactions from a later hour
+have arrived"""
+import signal
+from argparse import ArgumentParser
+from collections.abc import Callable
+from datetime import datetime
+from os import environ
+from time import perf_counter, sleep
+import pandas as pd
+from pymysql import Connection
+from pymysql.err import OperationalError
+from extract import get_db_connection, get_starting_watermark, get_transaction_query
+from transform import clean_dimension_data, clean_transaction_data, count_rejections
+from partition_writer import (get_filesystem, get_partition_dir, get_written_partitions,
+                              write_partitioned_dataset)
+from compact import (TRANSACTION_DATASET_PATH, get_partition_files, remove_replaced_files,
+                     compact_partition)
+from rollup import ROLLUP_DATASET_PATH, SKETCH_DATASET_PATH, update_rollup
+from parallel_extract import DIMENSION_QUERIES, ConnectionPool
+from watermark import write_watermark
+from truck_common.instrumentation import stage
+
+POLL_SECONDS = float(environ.get('MICROBATCH_POLL_SECONDS', '30'))
+MAX_BATCH_ROWS = int(environ.get('MICROBATCH_MAX_ROWS', '10000'))
+DIMENSION_REFRESH_SECONDS = 3600
+
+
+class MicroBatchLoader:
+    """Polls for new transactions and loads them until stopped"""
+
+    def __init__(self, connection_factory: Callable[[], Connection] = get_db_connection,
+                 transaction_path: str = TRANSACTION_DATASET_PATH,
+                 rollup_path: str = ROLLUP_DATASET_PATH,
+                 sketch_path: str = SKETCH_DATASET_PATH,
+                 max_batch_rows: int = MAX_BATCH_ROWS):
+        self.connection_factory = connection_factory
+        self.pool = ConnectionPool(connection_factory, 1)
+        self.transaction_path = transaction_path
+        self.rollup_path = rollup_path
+        self.sketch_path = sketch_path
+        self.max_batch_rows = max_batch_rows
+        self.watermark = get_starting_watermark()
+        self.open_hours = set()
+        self.dimensions = None
+        self.dimensions_loaded_at = 0.0
+        self.stopped = False
+
+    def reconnect(self) -> None:
+        """Replaces the connection after it has dropped"""
+        try:
+            self.pool.close()
+        except OperationalError:
+            pass
+        self.pool = ConnectionPool(self.connection_factory, 1)
+
+    def get_dimensions(self) -> tuple[pd.DataFrame, pd.DataFrame]:
+        """Returns the cleaned truck and payment method tables, re-reading them hourly"""
+        if self.dimensions is None or (
+                perf_counter() - self.dimensions_loaded_at > DIMENSION_REFRESH_SECONDS):
+            self.dimensions = clean_dimension_data(
+                self.pool.read_sql(DIMENSION_QUERIES['truck']),
+                self.pool.read_sql(DIMENSION_QUERIES['payment_method']))
+            self.dimensions_loaded_at = perf_counter()
+
+        return self.dimensions
+
+    def read_batch(self) -> pd.DataFrame:
+        """Returns up to max_batch_rows transactions after the watermark"""
+        sql_query, params = get_transaction_query(self.watermark, self.max_batch_rows)
+        return self.pool.read_sql(sql_query, params)
+
+    def seal_hours(self, before: datetime) -> list[tuple]:
+        """Compacts every hour written to that ended before the given time.
+        Returns the partitions sealed"""
+        filesystem, dataset_path = get_filesystem(self.transaction_path)
+        sealed = [values for values in self.open_hours if datetime(*values) < before]
+
+        for partition_values in sealed:
+            partition_dir = get_partition_dir(dataset_path, partition_values)
+            files = get_partition_files(filesystem, partition_dir).get(partition_dir, [])
+            files = remove_replaced_files(filesystem, files)
+            if len(files) > 1:
+                compact_partition(filesystem, partition_dir, files)
+            self.open_hours.discard(partition_values)
+
+        return sealed
+
+    def load_batch(self, batch_df: pd.DataFrame) -> dict:
+        """Cleans and loads one batch, then advances the stored watermark.
+        Returns the batch's metrics"""
+        truck_df, payment_method_df = self.get_dimensions()
+        valid_df, rejected_df = clean_transaction_data(batch_df, truck_df, payment_method_df)
+        valid_df = valid_df.assign(
+            year=valid_df['at'].dt.year, month=valid_df['at'].dt.month,
+            day=valid_df['at'].dt.day, hour=valid_df['at'].dt.hour)
+
+        files = write_partitioned_dataset(valid_df, self.transaction_path, write_mode='dedupe')
+        written_partitions = get_written_partitions(files)
+        update_rollup(written_partitions, self.transaction_path, self.rollup_path,
+                      self.sketch_path)
+        self.open_hours.update(
+            tuple(int(value) for value in partition_values)
+            for partition_values in written_partitions.itertuples(index=False))
+
+        # Rows missing the keyset columns sort first, so the watermark is the last complete row.
+        # A batch without one keeps the previous watermark rather than stopping the loader
+        complete_df = batch_df.dropna(subset=['at', 'transaction_id'])
+        if not complete_df.empty:
+            last_row = complete_df.iloc[-1]
+            self.watermark = (pd.Timestamp(last_row['at']).to_pydatetime(),
+                              int(last_row['transaction_id']))
+            write_watermark(self.watermark)
+        else:
+            print('No transaction in the batch has a time and id, keeping the watermark')
+
+        sealed_hours = []
+        if self.watermark is not None:
+            sealed_hours = self.seal_hours(
+                self.watermark[0].replace(minute=0, second=0, microsecond=0))
+        return {
+            "rows_in": len(batch_df),
+            "rows_out": len(valid_df),
+            "rejected": count_rejections(rejected_df),
+            "files_written": len(files),
+            "watermark_advanced": not complete_df.empty,
+            "sealed_hours": len(sealed_hours),
+            "freshness_seconds": round(
+                (datetime.now() - valid_df['at'].max()).total_seconds(), 1)
+            if not valid_df.empty else None
+        }
+
+    def poll_once(self) -> bool:
+        """Reads and loads one batch. Returns True if the batch was full and moved the
+        watermark on, meaning more rows are waiting"""
+        with stage('microbatch', watermark=self.watermark) as metrics:
+            batch_df = self.read_batch()
+            metrics['backlogged'] = len(batch_df) == self.max_batch_rows
+            if not batch_df.empty:
+                metrics.update(self.load_batch(batch_df))
+                metrics['backlogged'] = metrics['backlogged'] and metrics['watermark_advanced']
+
+        return metrics['backlogged']
+
+    def stop(self, *_) -> None:
+        """Asks the loop to finish after the current batch"""
+        self.stopped = True
+
+    def run(self, poll_seconds: float = POLL_SECONDS, max_batches: int | None = None) -> None:
+        """Polls until stopped, SIGTERM is received or max_batches have been read"""
+        signal.signal(signal.SIGTERM, self.stop)
+        batches = 0
+
+        while not self.stopped and (max_batches is None or batches < max_batches):
+            try:
+                backlogged = self.poll_once()
+            except OperationalError as e:
+                print(f'Lost the database connection, reconnecting: {e}')
+                self.reconnect()
+                backlogged = False
+            batches += 1
+
+            if not backlogged and not self.stopped:
+                sleep(poll_seconds)
+
+        self.pool.close()
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='Loads new truck transactions continuously')
+    parser.add_argument('--poll-seconds', type=float, default=POLL_SECONDS,
+                        help='seconds to wait between polls when there is no backlog')
+    parser.add_argument('--max-batch-rows', type=int, default=MAX_BATCH_ROWS,
+                        help='most transactions read and held at once')
+    parser.add_argument('--max-batches', type=int, help='stop after this many polls')
+    parser.add_argument('--transaction-path', default=TRANSACTION_DATASET_PATH)
+    parser.add_argument('--rollup-path', default=ROLLUP_DATASET_PATH)
+    parser.add_argument('--sketch-path', default=SKETCH_DATASET_PATH)
+    args = parser.parse_args()
+
+    loader = MicroBatchLoader(transaction_path=args.transaction_path,
+                              rollup_path=args.rollup_path,
+                              sketch_path=args.sketch_path,
+                              max_batch_rows=args.max_batch_rows)
+    loader.run(args.poll_seconds, args.max_batches)
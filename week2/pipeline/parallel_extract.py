@@ -0,0 +1,138 @@
+"""Extracts the truck tables over a pool of database connections.
+The dimension tables are read alongside the transactions, and the transactions
+after the watermark are split into time ranges read in parallel. The ranges are
+joined back in order, so the result matches a single ordered query"""
+import sqlite3
+from argparse import ArgumentParser
+from collections.abc import Callable
+from concurrent.futures import ThreadPoolExecutor
+from os import environ
+from queue import Queue
+import pandas as pd
+from pymysql import Connection
+from extract import (get_db_connection, get_watermark_condition, get_starting_watermark,
+                     save_data)
+from watermark import Watermark, stage_watermark
+
+EXTRACT_WORKERS = int(environ.get('EXTRACT_WORKERS', '4'))
+RANGES_PER_WORKER = 4
+TRANSACTION_COLUMNS = ['transaction_id', 'truck_id', 'payment_method_id', 'total', 'at']
+DIMENSION_QUERIES = {
+    "truck": 'SELECT * FROM DIM_Truck;',
+    "payment_method": 'SELECT * FROM DIM_Payment_Method;'
+}
+
+
+class ConnectionPool:
+    """A fixed set of connections that queries borrow one at a time"""
+
+    def __init__(self, connection_factory: Callable[[], Connection], size: int):
+        self.connections = [connection_factory() for _ in range(size)]
+        self.available = Queue()
+        for conn in self.connections:
+            self.available.put(conn)
+
+    def read_sql(self, sql_query: str, params: tuple = ()) -> pd.DataFrame:
+        """Runs the query on a free connection and returns the result as a dataframe.
+        The read's transaction is then ended, as under REPEATABLE READ a connection
+        otherwise keeps seeing the snapshot its first query took"""
+        conn = self.available.get()
+        try:
+            if isinstance(conn, sqlite3.Connection):
+                sql_query = sql_query.replace('%s', '?')
+            df = pd.read_sql(sql_query, conn, params=params)
+            conn.rollback()
+            return df
+        finally:
+            self.available.put(conn)
+
+    def close(self) -> None:
+        """Closes every connection in the pool"""
+        for conn in self.connections:
+            conn.close()
+
+
+def get_time_ranges(pool: ConnectionPool, watermark: Watermark | None,
+                    range_count: int) -> list[tuple[str, str, bool, bool]]:
+    """Returns up to range_count (start, end, is_first, is_last) ranges of at that together
+    cover the transactions after the watermark. Each range includes its start and excludes
+    its end, apart from the last which includes both"""
+    condition, params = get_watermark_condition(watermark)
+    bounds = pool.read_sql(
+        f'SELECT MIN(at) AS first_at, MAX(at) AS last_at FROM FACT_Transaction WHERE {condition};',
+        params
+    )
+    if bounds['first_at'].isna().iloc[0]:
+        return []
+
+    first_at = pd.Timestamp(bounds['first_at'].iloc[0])
+    last_at = pd.Timestamp(bounds['last_at'].iloc[0])
+    step = (last_at - first_at) / range_count
+    starts = sorted({(first_at + step * i).floor('s') for i in range(range_count)})
+    ends = starts[1:] + [last_at]
+
+    return [(str(start), str(end), i == 0, i == len(starts) - 1)
+            for i, (start, end) in enumerate(zip(starts, ends))]
+
+
+def read_transaction_range(pool: ConnectionPool, watermark: Watermark | None,
+                           time_range: tuple[str, str, bool, bool]) -> pd.DataFrame:
+    """Returns the transactions after the watermark within one time range, in order.
+    The first range also holds any rows without a time, which sort first"""
+    condition, params = get_watermark_condition(watermark)
+    start, end, is_first, is_last = time_range
+    sql_query = f"""
+        SELECT {', '.join(TRANSACTION_COLUMNS)}
+        FROM FACT_Transaction
+        WHERE {condition}
+        AND (at >= %s AND at {'<=' if is_last else '<'} %s{' OR at IS NULL' if is_first else ''})
+        ORDER BY at, transaction_id;
+    """
+
+    return pool.read_sql(sql_query, params + (start, end))
+
+
+def download_data_parallel(watermark: Watermark | None, workers: int = EXTRACT_WORKERS,
+                           connection_factory: Callable[[], Connection] = get_db_connection
+                           ) -> dict[str, pd.DataFrame]:
+    """Returns all tables, with only the transactions after the watermark, reading them
+    over a pool of workers connections. connection_factory makes each connection, so a
+    local MySQL or SQLite copy of the tables can stand in for RDS. SQLite connections
+    need check_same_thread=False as they're shared between threads"""
+    pool = ConnectionPool(connection_factory, workers)
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            dimension_futures = {
+                table: executor.submit(pool.read_sql, sql_query)
+                for table, sql_query in DIMENSION_QUERIES.items()
+            }
+            time_ranges = get_time_ranges(pool, watermark, workers * RANGES_PER_WORKER)
+            range_frames = list(executor.map(
+                lambda time_range: read_transaction_range(pool, watermark, time_range),
+                time_ranges
+            ))
+            all_data = {table: future.result() for table, future in dimension_futures.items()}
+    finally:
+        pool.close()
+
+    if range_frames:
+        transaction_df = pd.concat(range_frames, ignore_index=True)
+    else:
+        transaction_df = pd.DataFrame(columns=TRANSACTION_COLUMNS)
+    all_data['transaction'] = transaction_df
+
+    if not transaction_df.empty:
+        last_row = transaction_df.iloc[-1]
+        stage_watermark((pd.Timestamp(last_row['at']).to_pydatetime(),
+                         int(last_row['transaction_id'])))
+
+    return all_data
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='Extracts new truck transactions from RDS in parallel')
+    parser.add_argument('--workers', type=int, default=EXTRACT_WORKERS,
+                        help='database connections to read over')
+    args = parser.parse_args()
+
+    save_data(download_data_parallel(get_starting_watermark(), args.workers))
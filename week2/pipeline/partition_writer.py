@@ -0,0 +1,236 @@
+"""Writes transactions as an hour partitioned parquet dataset.
+The frame is grouped once and each partition is written on a thread pool,
+so S3 uploads overlap instead of running one after another.
+Each partition can keep an index of its transaction ids so reloaded rows are skipped.
+Files are written with a writer profile: 'default' leaves the layout to pyarrow, while
+'tuned' sorts each file by truck and time, sizes its row groups, compresses it with zstd
+and dictionary encodes only the low cardinality columns, so the min/max statistics of
+each row group let readers skip the trucks and times a query doesn't ask for"""
+from os import environ
+from os.path import abspath
+from time import sleep
+from hashlib import sha1
+from uuid import uuid4
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from pyarrow import fs
+from schema import TABLE_STORAGE_DTYPES, apply_schema
+
+PARTITION_COLS = ['year', 'month', 'day', 'hour']
+MAX_CONCURRENT_UPLOADS = int(environ.get('MAX_CONCURRENT_UPLOADS', '8'))
+MAX_RETRIES = 3
+RETRY_DELAY_SECONDS = 0.5
+ID_INDEX_FILENAME = '_transaction_ids.parquet'
+WRITE_MODES = ['append', 'dedupe']
+PARQUET_WRITER_PROFILE = environ.get('PARQUET_WRITER_PROFILE', 'tuned')
+PARQUET_ROW_GROUP_SIZE = int(environ.get('PARQUET_ROW_GROUP_SIZE', '131072'))
+WRITER_PROFILES = {
+    "default": {"sort_by": [], "compression": 'snappy', "options": {}},
+    "tuned": {
+        "sort_by": ['truck_id', 'at'],
+        "compression": 'zstd',
+        "options": {
+            "row_group_size": PARQUET_ROW_GROUP_SIZE,
+            "use_dictionary": ['truck_id', 'payment_method_id'],
+            "write_statistics": True
+        }
+    }
+}
+
+
+def get_filesystem(path: str) -> tuple[fs.FileSystem, str]:
+    """Returns the filesystem for a local or s3:// path, and the path within it"""
+    if '://' in path:
+        return fs.FileSystem.from_uri(path)
+    return fs.LocalFileSystem(), abspath(path)
+
+
+def get_files_size(file_paths: list[str], dataset_path: str) -> int:
+    """Returns the total size of files written under the dataset path"""
+    filesystem, _ = get_filesystem(dataset_path)
+    return sum(info.size for info in filesystem.get_file_info(file_paths))
+
+
+def get_writer_profile(profile: str) -> dict:
+    """Returns the named writer profile"""
+    if profile not in WRITER_PROFILES:
+        raise ValueError(
+            f'Unknown writer profile {profile}, expected one of {list(WRITER_PROFILES)}')
+    return WRITER_PROFILES[profile]
+
+
+def get_parquet_filename(name: str, profile: str = PARQUET_WRITER_PROFILE) -> str:
+    """Returns the file name for a parquet file written with the profile"""
+    return f'{name}.{get_writer_profile(profile)["compression"]}.parquet'
+
+
+def write_parquet(table: pa.Table, file_path: str, filesystem: fs.FileSystem,
+                  profile: str = PARQUET_WRITER_PROFILE) -> None:
+    """Writes the table with the profile's sort order and parquet options.
+    Sort and dictionary columns the table doesn't have are left out"""
+    writer_profile = get_writer_profile(profile)
+    options = dict(writer_profile['options'])
+    sort_by = [column for column in writer_profile['sort_by'] if column in table.column_names]
+    if sort_by:
+        table = table.sort_by([(column, 'ascending') for column in sort_by])
+    if isinstance(options.get('use_dictionary'), list):
+        options['use_dictionary'] = [
+            column for column in options['use_dictionary'] if column in table.column_names]
+
+    pq.write_table(table, file_path, filesystem=filesystem,
+                   compression=writer_profile['compression'], **options)
+
+
+def get_partition_dir(base_path: str, partition_values: tuple) -> str:
+    """Returns the hive style directory for the given partition"""
+    partition_dirs = '/'.join(
+        f'{column}={value}' for column, value in zip(PARTITION_COLS, partition_values))
+
+    return f'{base_path}/{partition_dirs}'
+
+
+def get_written_partitions(file_paths: list[str]) -> pd.DataFrame:
+    """Returns the partition values of the directories the files were written to, once each"""
+    rows = []
+    for file_path in file_paths:
+        values = dict(part.split('=', 1) for part in file_path.split('/') if '=' in part)
+        rows.append([int(values[column]) for column in PARTITION_COLS])
+
+    return pd.DataFrame(rows, columns=PARTITION_COLS).drop_duplicates()
+
+
+def read_id_index(filesystem: fs.FileSystem, partition_dir: str) -> np.ndarray:
+    """Returns the transaction ids already stored in the partition.
+    Partitions written before the index existed are indexed from their id column"""
+    index_path = f'{partition_dir}/{ID_INDEX_FILENAME}'
+    if filesystem.get_file_info(index_path).type == fs.FileType.File:
+        return pq.read_table(index_path, filesystem=filesystem)['transaction_id'].to_numpy()
+
+    selector = fs.FileSelector(partition_dir, allow_not_found=True)
+    data_files = [
+        info.path for info in filesystem.get_file_info(selector)
+        if info.base_name.endswith('.parquet') and not info.base_name.startswith(('_', '.'))
+    ]
+    return np.concatenate([np.array([], dtype='int64')] + [
+        pq.read_table(file_path, columns=['transaction_id'], filesystem=filesystem)
+        ['transaction_id'].to_numpy()
+        for file_path in data_files
+    ])
+
+
+def write_id_index(filesystem: fs.FileSystem, partition_dir: str, ids: np.ndarray) -> None:
+    """Replaces the partition's id index, writing it under a hidden name first"""
+    temp_path = f'{partition_dir}/_{uuid4().hex}.tmp'
+    pq.write_table(pa.table({"transaction_id": ids}), temp_path, filesystem=filesystem)
+    filesystem.move(temp_path, f'{partition_dir}/{ID_INDEX_FILENAME}')
+
+
+def drop_duplicate_transactions(table: pa.Table) -> pa.Table:
+    """Returns the table with only the first row of each transaction id"""
+    _, first_rows = np.unique(table['transaction_id'].to_numpy(zero_copy_only=False),
+                              return_index=True)
+    if len(first_rows) == table.num_rows:
+        return table
+
+    return table.take(np.sort(first_rows))
+
+
+def get_storage_table(partition_df: pd.DataFrame) -> pa.Table:
+    """Returns the partition's rows without the partition columns, as an arrow table
+    with the column types the transactions are stored with"""
+    partition_df = partition_df.drop(columns=PARTITION_COLS)
+    return pa.Table.from_pandas(apply_schema(partition_df, TABLE_STORAGE_DTYPES['transaction']),
+                                preserve_index=False)
+
+
+def write_new_transactions(partition_df: pd.DataFrame, partition_dir: str,
+                           filesystem: fs.FileSystem,
+                           profile: str = PARQUET_WRITER_PROFILE) -> str | None:
+    """Writes only the transactions whose ids aren't in the partition yet, then adds them
+    to its index. The file is named after the ids it holds, so if the index update fails
+    a rerun overwrites the same file instead of adding a duplicate"""
+    existing_ids = read_id_index(filesystem, partition_dir)
+    partition_df = partition_df.drop_duplicates('transaction_id')
+    partition_df = partition_df[~partition_df['transaction_id'].isin(existing_ids)]
+    if partition_df.empty:
+        return None
+
+    new_ids = np.sort(partition_df['transaction_id'].to_numpy(dtype='int64'))
+    filename = get_parquet_filename(sha1(new_ids.tobytes()).hexdigest(), profile)
+    file_path = f'{partition_dir}/{filename}'
+    table = get_storage_table(partition_df)
+
+    filesystem.create_dir(partition_dir, recursive=True)
+    write_parquet(table, file_path, filesystem, profile)
+    write_id_index(filesystem, partition_dir,
+                   np.concatenate([existing_ids.astype('int64'), new_ids]))
+
+    return file_path
+
+
+def append_transactions(partition_df: pd.DataFrame, partition_dir: str,
+                        filesystem: fs.FileSystem, profile: str = PARQUET_WRITER_PROFILE) -> str:
+    """Writes the partition's rows to a new file alongside any already there"""
+    file_path = f'{partition_dir}/{get_parquet_filename(uuid4().hex, profile)}'
+    table = get_storage_table(partition_df)
+
+    filesystem.create_dir(partition_dir, recursive=True)
+    write_parquet(table, file_path, filesystem, profile)
+
+    return file_path
+
+
+def write_partition(partition_df: pd.DataFrame, partition_dir: str, filesystem: fs.FileSystem,
+                    write_mode: str = 'append', retries: int = MAX_RETRIES,
+                    profile: str = PARQUET_WRITER_PROFILE) -> str | None:
+    """Writes one partition, retrying with a growing delay if the write fails.
+    Returns the file written, or None if every row was already stored"""
+    write = write_new_transactions if write_mode == 'dedupe' else append_transactions
+
+    for attempt in range(retries + 1):
+        try:
+            return write(partition_df, partition_dir, filesystem, profile)
+        except OSError as e:
+            if attempt == retries:
+                raise
+            print(f'Retrying write to {partition_dir} after error: {e}')
+            sleep(RETRY_DELAY_SECONDS * 2 ** attempt)
+
+    return None
+
+
+def write_partitioned_dataset(df: pd.DataFrame, path: str,
+                              filesystem: fs.FileSystem | None = None,
+                              write_mode: str = 'append',
+                              max_workers: int = MAX_CONCURRENT_UPLOADS,
+                              retries: int = MAX_RETRIES,
+                              profile: str = PARQUET_WRITER_PROFILE) -> list[str]:
+    """Writes the dataframe under path, one file per partition, and returns the files written.
+    path can be local or s3://, or a filesystem can be given, e.g. for a local S3 stand-in.
+    In 'dedupe' mode transactions already in their partition are skipped"""
+    if write_mode not in WRITE_MODES:
+        raise ValueError(f'Unknown write mode {write_mode}, expected one of {WRITE_MODES}')
+    get_writer_profile(profile)
+    if filesystem is None:
+        filesystem, path = get_filesystem(path)
+    path = path.rstrip('/')
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [
+            executor.submit(
+                write_partition,
+                partition_df,
+                get_partition_dir(path, partition_values),
+                filesystem,
+                write_mode,
+                retries,
+                profile
+            )
+            for partition_values, partition_df in df.groupby(PARTITION_COLS, sort=False)
+        ]
+
+    written = [future.result() for future in futures]
+    return [file_path for file_path in written if file_path is not None]
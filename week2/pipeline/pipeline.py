@@ -0,0 +1,61 @@
+"""Runs extract, transform and load in a single process.
+Tables are passed between the steps in memory rather than through csv files"""
+from argparse import ArgumentParser
+import pandas as pd
+from extract import get_db_connection, get_starting_watermark, download_data, save_data
+from parallel_extract import download_data_parallel
+from transform import clean_all_data, save_all_data, get_cleaning_metrics
+from load import upload_dimension_data, upload_transaction_data
+from watermark import commit_pending_watermark
+from truck_common.instrumentation import stage, get_frame_bytes
+
+
+def run_pipeline(write_files: bool = False, workers: int = 1) -> dict[str, pd.DataFrame]:
+    """Extracts new transactions, cleans them and uploads them to an S3.
+    With write_files the intermediate csv and parquet files are also saved to ./data.
+    With more than one worker the tables are read over that many connections.
+    Each step emits its timings and row counts as a json line"""
+    with stage('extract', workers=workers) as metrics:
+        watermark = get_starting_watermark()
+        if workers > 1:
+            all_data = download_data_parallel(watermark, workers)
+        else:
+            conn = get_db_connection()
+            try:
+                all_data = download_data(conn, watermark)
+            finally:
+                conn.close()
+        metrics['rows_out'] = len(all_data['transaction'])
+        metrics['bytes_read'] = sum(get_frame_bytes(df) for df in all_data.values())
+
+        if write_files:
+            save_data(all_data)
+
+    with stage('transform') as metrics:
+        metrics['rows_in'] = len(all_data['transaction'])
+        clean_data = clean_all_data(all_data)
+        metrics.update(get_cleaning_metrics(clean_data))
+
+        if write_files:
+            save_all_data(clean_data)
+
+    with stage('load') as metrics:
+        metrics['rows_in'] = len(clean_data['transaction'])
+        dimension_bytes, metrics['skipped_dimensions'] = upload_dimension_data(
+            clean_data['truck'], clean_data['payment_method'], save_local=write_files)
+        metrics['bytes_written'] = dimension_bytes + upload_transaction_data(
+            clean_data['transaction'], save_local=write_files)
+    commit_pending_watermark()
+
+    return clean_data
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='Runs the truck ETL pipeline in one process')
+    parser.add_argument('--write-files', action='store_true',
+                        help='also save each step\'s output to ./data for debugging')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='database connections to extract over in parallel')
+    args = parser.parse_args()
+
+    run_pipeline(args.write_files, args.workers)
@@ -0,0 +1,141 @@
+"""Maintains the hourly rollup of the transaction dataset.
+Each hour partition gets one small file holding the number and value of its
+transactions per truck and payment method, so reports and dashboards can
+aggregate thousands of rollup rows rather than every transaction.
+Given a sketch path, a t-digest of each truck's totals is written for the hour
+from the same read, so percentiles can be merged over any range as well"""
+from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
+from uuid import uuid4
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+from pyarrow import fs
+from partition_writer import (PARTITION_COLS, MAX_CONCURRENT_UPLOADS, PARQUET_WRITER_PROFILE,
+                              drop_duplicate_transactions, get_filesystem, get_partition_dir,
+                              write_parquet)
+from compact import TRANSACTION_DATASET_PATH, get_partition_files, get_partition_values
+from truck_common.quantile_sketch import compress_centroids
+
+ROLLUP_DATASET_PATH = (
+    's3://c20-sami-truck-s3-bucket/input/transaction_rollup/transaction_rollup.parquet')
+# The file names stay fixed whatever the writer profile compresses them with,
+# so a rewrite always replaces the hour's existing file
+ROLLUP_FILENAME = 'rollup.snappy.parquet'
+ROLLUP_GROUP_COLS = ['truck_id', 'payment_method_id']
+SKETCH_DATASET_PATH = (
+    's3://c20-sami-truck-s3-bucket/input/transaction_sketch/transaction_sketch.parquet')
+SKETCH_FILENAME = 'sketch.snappy.parquet'
+SKETCH_SCHEMA = pa.schema([('truck_id', pa.int16()), ('mean', pa.float64()),
+                           ('weight', pa.int64())])
+
+
+def aggregate_transactions(table: pa.Table) -> pa.Table:
+    """Returns the count and sum of total per truck and payment method.
+    Totals are stored as doubles of whole pence, so they are summed as integers"""
+    table = table.set_column(table.schema.get_field_index('total'), 'total',
+                             pc.round(table['total']).cast(pa.int64()))
+    return table.group_by(ROLLUP_GROUP_COLS).aggregate(
+        [('total', 'count'), ('total', 'sum')]
+    ).rename_columns(ROLLUP_GROUP_COLS + ['transaction_count', 'total_value'])
+
+
+def sketch_transactions(table: pa.Table) -> pa.Table:
+    """Returns a t-digest of total for each truck, with a row per centroid"""
+    truck_ids = table['truck_id'].to_numpy(zero_copy_only=False)
+    totals = table['total'].to_numpy(zero_copy_only=False)
+    sketches = [pa.table({"truck_id": [], "mean": [], "weight": []}, schema=SKETCH_SCHEMA)]
+
+    for truck_id in np.unique(truck_ids):
+        truck_totals = totals[truck_ids == truck_id]
+        means, weights = compress_centroids(truck_totals, np.ones(len(truck_totals)))
+        sketches.append(pa.table({
+            "truck_id": np.full(len(means), truck_id),
+            "mean": means,
+            "weight": weights.astype('int64')
+        }, schema=SKETCH_SCHEMA))
+
+    return pa.concat_tables(sketches)
+
+
+def replace_partition_file(filesystem: fs.FileSystem, table: pa.Table, partition_dir: str,
+                           filename: str, profile: str = PARQUET_WRITER_PROFILE) -> None:
+    """Writes the table under a hidden name and moves it over the partition's file"""
+    temp_path = f'{partition_dir}/_{uuid4().hex}.tmp'
+    filesystem.create_dir(partition_dir, recursive=True)
+    write_parquet(table, temp_path, filesystem, profile)
+    filesystem.move(temp_path, f'{partition_dir}/{filename}')
+
+
+def update_rollup_partition(filesystem: fs.FileSystem, transaction_dir: str,
+                            rollup_dir: str, sketch_dir: str | None = None,
+                            profile: str = PARQUET_WRITER_PROFILE) -> None:
+    """Recomputes one hour's rollup from its transactions and replaces the rollup file,
+    and the hour's sketch file if a sketch directory is given.
+    A transaction stored more than once is only counted once"""
+    transactions = drop_duplicate_transactions(pq.read_table(
+        transaction_dir, filesystem=filesystem,
+        columns=['transaction_id'] + ROLLUP_GROUP_COLS + ['total'], partitioning=None))
+
+    replace_partition_file(filesystem, aggregate_transactions(transactions), rollup_dir,
+                           ROLLUP_FILENAME, profile)
+    if sketch_dir is not None:
+        replace_partition_file(filesystem, sketch_transactions(transactions), sketch_dir,
+                               SKETCH_FILENAME, profile)
+
+
+def update_rollup(transaction_df: pd.DataFrame,
+                  transaction_path: str = TRANSACTION_DATASET_PATH,
+                  rollup_path: str = ROLLUP_DATASET_PATH,
+                  sketch_path: str | None = None,
+                  profile: str = PARQUET_WRITER_PROFILE) -> int:
+    """Updates the rollup, and the sketches if sketch_path is given, for every hour
+    partition the given transactions fall in. Returns the number of partitions updated"""
+    filesystem, transaction_path = get_filesystem(transaction_path)
+    _, rollup_path = get_filesystem(rollup_path)
+    if sketch_path is not None:
+        _, sketch_path = get_filesystem(sketch_path)
+    partitions = transaction_df[PARTITION_COLS].drop_duplicates().itertuples(index=False)
+
+    with ThreadPoolExecutor(max_workers=MAX_CONCURRENT_UPLOADS) as executor:
+        futures = [
+            executor.submit(update_rollup_partition, filesystem,
+                            get_partition_dir(transaction_path, tuple(partition_values)),
+                            get_partition_dir(rollup_path, tuple(partition_values)),
+                            get_partition_dir(sketch_path, tuple(partition_values))
+                            if sketch_path is not None else None,
+                            profile)
+            for partition_values in partitions
+        ]
+
+    for future in futures:
+        future.result()
+
+    return len(futures)
+
+
+def rebuild_rollup(transaction_path: str = TRANSACTION_DATASET_PATH,
+                   rollup_path: str = ROLLUP_DATASET_PATH,
+                   sketch_path: str | None = None,
+                   profile: str = PARQUET_WRITER_PROFILE) -> int:
+    """Recomputes the rollup and sketches for every partition in the transaction dataset"""
+    filesystem, dataset_path = get_filesystem(transaction_path)
+    partition_values = pd.DataFrame([
+        get_partition_values(partition_dir)
+        for partition_dir in get_partition_files(filesystem, dataset_path)
+    ], columns=PARTITION_COLS)
+
+    return update_rollup(partition_values, transaction_path, rollup_path, sketch_path, profile)
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='Rebuilds the hourly transaction rollup')
+    parser.add_argument('--transaction-path', default=TRANSACTION_DATASET_PATH)
+    parser.add_argument('--rollup-path', default=ROLLUP_DATASET_PATH)
+    parser.add_argument('--sketch-path', default=SKETCH_DATASET_PATH)
+    args = parser.parse_args()
+
+    rebuilt = rebuild_rollup(args.transaction_path, args.rollup_path, args.sketch_path)
+    print(f'Rebuilt {rebuilt} rollup partitions')
@@ -0,0 +1,59 @@
+"""The column types used for each table once it has been cleaned.
+Ids are small nullable integers, totals are whole pence and repeated text is
+categorical, which parquet stores dictionary encoded.
+Files are written with the wider storage types the tables have always had in S3,
+so new files match the old ones and the Glue schema"""
+import pandas as pd
+
+TRANSACTION_DTYPES = {
+    "transaction_id": 'Int32',
+    "truck_id": 'Int16',
+    "payment_method_id": 'Int8',
+    "total": 'Int32',
+    "at": 'datetime64[s]'
+}
+
+TRUCK_DTYPES = {
+    "truck_id": 'Int16',
+    "truck_name": 'category',
+    "truck_description": 'category',
+    "has_card_reader": 'Int8',
+    "fsa_rating": 'Int8'
+}
+
+PAYMENT_METHOD_DTYPES = {
+    "payment_method_id": 'Int8',
+    "payment_method": 'category'
+}
+
+TABLE_DTYPES = {
+    "transaction": TRANSACTION_DTYPES,
+    "truck": TRUCK_DTYPES,
+    "payment_method": PAYMENT_METHOD_DTYPES
+}
+
+TABLE_STORAGE_DTYPES = {
+    "transaction": {
+        "transaction_id": 'Int64',
+        "truck_id": 'Int64',
+        "payment_method_id": 'Int64',
+        "total": 'Float64'
+    },
+    "truck": {
+        "truck_id": 'Int64',
+        "has_card_reader": 'Int64',
+        "fsa_rating": 'Int64'
+    },
+    "payment_method": {
+        "payment_method_id": 'Int64'
+    }
+}
+
+
+def apply_schema(df: pd.DataFrame, dtypes: dict[str, str]) -> pd.DataFrame:
+    """Returns the dataframe with any columns found in dtypes converted to their type"""
+    dtypes = {column: dtype for column, dtype in dtypes.items() if column in df.columns}
+    if 'total' in dtypes:
+        df = df.assign(total=df['total'].round())
+
+    return df.astype(dtypes)
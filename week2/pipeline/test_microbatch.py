@@ -0,0 +1,61 @@
+"""Tests for the micro-batch loader's polling, run with pytest from this directory"""
+from datetime import datetime
+import pytest
+import microbatch
+
+
+class FakeCursor:
+    """Returns no rows and records each query on its connection"""
+
+    description = [(column,) for column in
+                   ['transaction_id', 'truck_id', 'payment_method_id', 'total', 'at']]
+
+    def __init__(self, events: list[str]):
+        self.events = events
+
+    def execute(self, sql_query, params=()):
+        """Records the query"""
+        self.events.append('query')
+
+    def fetchall(self):
+        """Returns no rows"""
+        return []
+
+    def close(self):
+        """Does nothing"""
+
+
+class FakeConnection:
+    """A DB-API connection that records whether a transaction ends between queries"""
+
+    def __init__(self):
+        self.events = []
+
+    def cursor(self):
+        """Returns a cursor recording into this connection's events"""
+        return FakeCursor(self.events)
+
+    def commit(self):
+        """Records the end of the transaction"""
+        self.events.append('end')
+
+    def rollback(self):
+        """Records the end of the transaction"""
+        self.events.append('end')
+
+    def close(self):
+        """Does nothing"""
+
+
+@pytest.mark.filterwarnings('ignore::UserWarning')
+def test_each_poll_ends_its_transaction(monkeypatch):
+    """A poll starts a new transaction, so it sees rows committed since the last one"""
+    monkeypatch.setattr(microbatch, 'get_starting_watermark',
+                        lambda: (datetime(2025, 10, 1), 1))
+    conn = FakeConnection()
+    loader = microbatch.MicroBatchLoader(connection_factory=lambda: conn)
+
+    loader.read_batch()
+    loader.read_batch()
+
+    assert conn.events == ['query', 'end', 'query', 'end']
@@ -1,12 +1,27 @@
 # pylint: disable = W0612
 """The data validation and cleaning step of the pipeline"""
+from os import path
+from typing import Callable
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+from schema import (TRANSACTION_DTYPES, TRUCK_DTYPES, PAYMENT_METHOD_DTYPES, TABLE_DTYPES,
+                    apply_schema)
+from truck_common.instrumentation import stage, get_frame_bytes
+
+TIMESTAMP_FORMAT = '%Y-%m-%d %H:%M:%S'
+TRANSACTION_NUMERIC_COLUMNS = ['transaction_id', 'truck_id', 'payment_method_id', 'total']
+REJECTED_KEY = 'rejected_transaction'
 
 
 def load_all_data() -> pd.DataFrame:
     """Returns 3 dataframes of all the data for payment_method, transaction and truck"""
     payment_method_df = pd.read_csv('data/payment_method.csv')
-    transaction_df = pd.read_csv('data/transaction.csv')
+    if path.exists('data/transaction.parquet'):
+        transaction_df = pd.read_parquet('data/transaction.parquet')
+    else:
+        transaction_df = pd.read_csv('data/transaction.csv')
     truck_df = pd.read_csv('data/truck.csv')
 
     return {
@@ -17,29 +32,93 @@ def load_all_data() -> pd.DataFrame:
 
 
 def save_all_data(all_data: dict[str: pd.DataFrame]) -> None:
-    """Saves keys in the given dict to a 'clean' csv file"""
+    """Saves keys in the given dict to a 'clean' csv file, and any rejected rows to their own"""
     for key in all_data:
-        all_data[key].to_csv(f'./data/clean_{key}.csv', index = False)
+        filename = key if key == REJECTED_KEY else f'clean_{key}'
+        all_data[key].to_csv(f'./data/{filename}.csv', index = False)
+
+
+def fits_integer_type(values: pd.Series, dtype: str) -> pd.Series:
+    """Returns True for each value that is a whole number within the range of the integer type"""
+    values = pd.to_numeric(values, errors='coerce').astype('float64')
+    limits = np.iinfo(pd.api.types.pandas_dtype(dtype).numpy_dtype)
+
+    return pd.Series((values % 1 == 0) & values.between(limits.min, limits.max),
+                     index=values.index)
+
+
+def get_transaction_rules(truck_df: pd.DataFrame, payment_method_df: pd.DataFrame
+                          ) -> dict[str, Callable[[pd.DataFrame], pd.Series]]:
+    """Returns the checks a transaction must pass, keyed by the reason given when one fails.
+    Valid ids are taken from the cleaned truck and payment method tables, and ids and
+    totals must fit their schema types so applying it can't fail"""
+    truck_ids = truck_df['truck_id'].to_numpy()
+    payment_method_ids = payment_method_df['payment_method_id'].to_numpy()
+
+    return {
+        "missing_transaction_id": lambda df: df['transaction_id'].notna(),
+        "invalid_transaction_id": lambda df: fits_integer_type(
+            df['transaction_id'], TRANSACTION_DTYPES['transaction_id']),
+        "invalid_truck_id": lambda df: fits_integer_type(
+            df['truck_id'], TRANSACTION_DTYPES['truck_id']),
+        "unknown_truck_id": lambda df: df['truck_id'].isin(truck_ids),
+        "invalid_payment_method_id": lambda df: fits_integer_type(
+            df['payment_method_id'], TRANSACTION_DTYPES['payment_method_id']),
+        "unknown_payment_method_id": lambda df: df['payment_method_id'].isin(payment_method_ids),
+        "invalid_total": lambda df: df['total'].notna() & (df['total'] != 0) & fits_integer_type(
+            df['total'].round(), TRANSACTION_DTYPES['total']),
+        "invalid_at": lambda df: df['at'].notna()
+    }
+
+
+def parse_timestamps(at: pd.Series) -> pd.Series:
+    """Parses transaction times using the source's fixed format. Invalid times become NaT"""
+    if pd.api.types.is_datetime64_any_dtype(at):
+        return at
 
+    parsed = pc.strptime(pa.array(at, type=pa.string(), from_pandas=True),
+                         format=TIMESTAMP_FORMAT, unit='s', error_is_null=True)
+    return pd.Series(parsed.to_pandas(), index=at.index, name=at.name)
+
+
+def coerce_transaction_types(transaction_df: pd.DataFrame) -> pd.DataFrame:
+    """Returns a new dataframe of the transactions with numeric ids and totals and parsed times"""
+    columns = {
+        column: pd.to_numeric(transaction_df[column], errors='coerce')
+        for column in TRANSACTION_NUMERIC_COLUMNS
+    }
+    columns['at'] = parse_timestamps(transaction_df['at'])
 
-def clean_transaction_data(transaction_df: pd.DataFrame) -> pd.DataFrame:
-    """Cleans the data in the transaction table"""
-    transaction_df['transaction_id'] = (
-        pd.to_numeric(transaction_df['transaction_id'], errors='coerce'))
+    return pd.DataFrame(columns, index=transaction_df.index)
 
-    transaction_df['truck_id'] = pd.to_numeric(transaction_df['truck_id'], errors='coerce')
-    transaction_df = transaction_df[transaction_df['truck_id'].between(1, 6)]
 
-    transaction_df['payment_method_id'] = (
-        pd.to_numeric(transaction_df['payment_method_id'], errors='coerce'))
-    transaction_df = transaction_df[transaction_df['payment_method_id'].isin([1, 2])]
+def validate_transaction_data(transaction_df: pd.DataFrame,
+                              rules: dict[str, Callable[[pd.DataFrame], pd.Series]]
+                              ) -> tuple[pd.DataFrame, pd.DataFrame]:
+    """Evaluates every rule once and combines them into a single mask.
+    Returns the valid rows, and the rejected rows with the first rule each one failed"""
+    coerced_df = coerce_transaction_types(transaction_df)
+    passed = [rule(coerced_df).to_numpy(dtype=bool) for rule in rules.values()]
 
-    transaction_df['total'] = pd.to_numeric(transaction_df['total'], errors='coerce')
-    transaction_df = transaction_df[transaction_df['total'] != 0]
+    is_valid = np.logical_and.reduce(passed)
+    reasons = np.select([~rule_passed for rule_passed in passed], list(rules), default='')
 
-    transaction_df['at'] = pd.to_datetime(transaction_df['at'], errors='coerce')
+    rejected_df = transaction_df[~is_valid].assign(reason=reasons[~is_valid])
+    return coerced_df[is_valid], rejected_df
 
-    return transaction_df
+
+def clean_transaction_data(transaction_df: pd.DataFrame, truck_df: pd.DataFrame,
+                           payment_method_df: pd.DataFrame) -> tuple[pd.DataFrame, pd.DataFrame]:
+    """Cleans the data in the transaction table, returning the valid and rejected rows"""
+    rules = get_transaction_rules(truck_df, payment_method_df)
+    valid_df, rejected_df = validate_transaction_data(transaction_df, rules)
+
+    return apply_schema(valid_df, TRANSACTION_DTYPES), rejected_df
+
+
+def count_rejections(rejected_df: pd.DataFrame) -> dict[str, int]:
+    """Returns the number of rejected transactions for each reason"""
+    return rejected_df['reason'].value_counts().to_dict()
 
 
 def clean_payment_method_data(payment_method_df: pd.DataFrame) -> pd.DataFrame:
@@ -59,20 +138,48 @@ def clean_truck_data(truck_df: pd.DataFrame) -> pd.DataFrame:
     return truck_df
 
 
+def clean_dimension_data(truck_df: pd.DataFrame, payment_method_df: pd.DataFrame
+                         ) -> tuple[pd.DataFrame, pd.DataFrame]:
+    """Cleans the truck and payment method tables and applies their schemas"""
+    truck_df = clean_truck_data(truck_df)
+    payment_method_df = clean_payment_method_data(payment_method_df)
+
+    truck_df = truck_df.dropna()
+    payment_method_df = payment_method_df.dropna()
+    truck_df = truck_df[fits_integer_type(truck_df['truck_id'], TRUCK_DTYPES['truck_id'])]
+    payment_method_df = payment_method_df[fits_integer_type(
+        payment_method_df['payment_method_id'], PAYMENT_METHOD_DTYPES['payment_method_id'])]
+
+    return (apply_schema(truck_df, TABLE_DTYPES['truck']),
+            apply_schema(payment_method_df, TABLE_DTYPES['payment_method']))
+
+
+def get_cleaning_metrics(clean_data: dict[str, pd.DataFrame]) -> dict:
+    """Returns the number of transactions kept and the number rejected by each rule"""
+    return {
+        "rows_out": len(clean_data['transaction']),
+        "rejected": count_rejections(clean_data[REJECTED_KEY])
+    }
+
+
 def clean_all_data(all_data: dict[str: pd.DataFrame]) -> pd.DataFrame:
     """Iterates through all tables and cleans their data"""
 
-    all_data['truck'] = clean_truck_data(all_data['truck'])
-    all_data['payment_method'] = clean_payment_method_data(all_data['payment_method'])
-    all_data['transaction'] = clean_transaction_data(all_data['transaction'])
+    all_data['truck'], all_data['payment_method'] = clean_dimension_data(
+        all_data['truck'], all_data['payment_method'])
 
-    for key in all_data:
-        all_data[key] = all_data[key].dropna()
+    all_data['transaction'], all_data[REJECTED_KEY] = clean_transaction_data(
+        all_data['transaction'], all_data['truck'], all_data['payment_method'])
+    print(f'Rejected transactions: {count_rejections(all_data[REJECTED_KEY])}')
 
     return all_data
 
 
 if __name__ == '__main__':
-    data = load_all_data()
-    clean_data = clean_all_data(data)
-    save_all_data(clean_data)
+    with stage('transform') as metrics:
+        data = load_all_data()
+        metrics['rows_in'] = len(data['transaction'])
+        metrics['bytes_read'] = sum(get_frame_bytes(df) for df in data.values())
+        clean_data = clean_all_data(data)
+        metrics.update(get_cleaning_metrics(clean_data))
+        save_all_data(clean_data)
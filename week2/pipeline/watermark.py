@@ -0,0 +1,72 @@
+"""Stores the extraction high-water mark between pipeline runs.
+The mark is the (at, transaction_id) of the last extracted transaction, kept in
+an S3 object, or a local json file for runs outside ECS, so each run can start where
+the last one ended. The ECS task's disk doesn't outlive a run, so it is kept in S3
+by default, outside the input/ prefix the tables are crawled from"""
+import json
+from os import environ, path, remove, replace
+from datetime import datetime
+from tempfile import NamedTemporaryFile
+import boto3
+
+WATERMARK_PATH = environ.get('WATERMARK_PATH',
+                            's3://c20-sami-truck-s3-bucket/state/watermark.json')
+PENDING_WATERMARK_PATH = 'data/pending_watermark.json'
+
+Watermark = tuple[datetime, int | None]
+
+
+def split_s3_path(location: str) -> tuple[str, str]:
+    """Returns the bucket and key for an s3:// location"""
+    bucket, _, key = location.removeprefix('s3://').partition('/')
+    return bucket, key
+
+
+def read_watermark(location: str = WATERMARK_PATH) -> Watermark | None:
+    """Returns the stored watermark, or None if one hasn't been saved yet"""
+    if location.startswith('s3://'):
+        bucket, key = split_s3_path(location)
+        s3_client = boto3.client('s3')
+        try:
+            body = s3_client.get_object(Bucket=bucket, Key=key)['Body'].read()
+        except s3_client.exceptions.NoSuchKey:
+            return None
+    else:
+        if not path.exists(location):
+            return None
+        with open(location, 'r', encoding='utf-8') as f:
+            body = f.read()
+
+    watermark = json.loads(body)
+    return datetime.fromisoformat(watermark['at']), watermark['transaction_id']
+
+
+def write_watermark(watermark: Watermark, location: str = WATERMARK_PATH) -> None:
+    """Saves the watermark, replacing the old one in a single atomic step"""
+    at, transaction_id = watermark
+    body = json.dumps({"at": at.isoformat(), "transaction_id": transaction_id})
+
+    if location.startswith('s3://'):
+        bucket, key = split_s3_path(location)
+        boto3.client('s3').put_object(Bucket=bucket, Key=key, Body=body.encode('utf-8'))
+        return
+
+    with NamedTemporaryFile('w', encoding='utf-8', delete=False,
+                            dir=path.dirname(location) or '.') as f:
+        f.write(body)
+    replace(f.name, location)
+
+
+def stage_watermark(watermark: Watermark) -> None:
+    """Records the watermark reached by extraction, to be committed once loaded"""
+    write_watermark(watermark, PENDING_WATERMARK_PATH)
+
+
+def commit_pending_watermark(location: str = WATERMARK_PATH) -> None:
+    """Advances the stored watermark to the staged one after a successful upload"""
+    watermark = read_watermark(PENDING_WATERMARK_PATH)
+    if watermark is None:
+        return
+
+    write_watermark(watermark, location)
+    remove(PENDING_WATERMARK_PATH)
@@ -0,0 +1,72 @@
+"""Regenerates the daily reports for a range of past days.
+The whole range is fetched in one partition-filtered query and its sale value
+sketches in another, both are split by day, then the reports are rendered in
+parallel in a pool of processes"""
+from argparse import ArgumentParser
+from concurrent.futures import ProcessPoolExecutor
+from datetime import date, timedelta
+from os import cpu_count
+from time import perf_counter
+import pandas as pd
+from generate_report import (REPORT_GROUP_COLUMNS, query_report_data, compute_report_metrics,
+                             query_sale_value_percentiles, generate_html_text,
+                             save_html_report_to_file)
+
+DATE_COLUMNS = ['year', 'month', 'day']
+
+
+def split_by_day(df: pd.DataFrame, start_date: date, end_date: date) -> dict[date, pd.DataFrame]:
+    """Returns the rows for each day in the range, with an empty frame for days without data"""
+    days = {}
+    report_date = start_date
+    while report_date <= end_date:
+        days[report_date] = df.iloc[:0].drop(columns=DATE_COLUMNS)
+        report_date += timedelta(days=1)
+
+    for (year, month, day), day_df in df.groupby(DATE_COLUMNS, sort=False):
+        days[date(int(year), int(month), int(day))] = day_df.drop(columns=DATE_COLUMNS)
+
+    return days
+
+
+def render_report(day_df: pd.DataFrame, report_date: date,
+                  percentiles_df: pd.DataFrame | None = None) -> str:
+    """Writes the html report for one day. Returns the file's name"""
+    metrics = compute_report_metrics(day_df, report_date, percentiles_df)
+    return save_html_report_to_file(generate_html_text(metrics), report_date)
+
+
+def backfill_reports(start_date: date, end_date: date,
+                     max_workers: int | None = None) -> list[str]:
+    """Writes report_data_<date>.html for every day from start_date to end_date.
+    Returns the files written"""
+    if start_date > end_date:
+        raise ValueError(f'Start date {start_date} is after end date {end_date}')
+
+    start_time = perf_counter()
+    df = query_report_data(start_date, end_date, DATE_COLUMNS + REPORT_GROUP_COLUMNS)
+    days = split_by_day(df, start_date, end_date)
+    percentiles = split_by_day(
+        query_sale_value_percentiles(start_date, end_date, DATE_COLUMNS + ['truck_name']),
+        start_date, end_date)
+    query_time = perf_counter() - start_time
+
+    with ProcessPoolExecutor(max_workers=max_workers or cpu_count()) as executor:
+        filenames = list(executor.map(render_report, days.values(), days.keys(),
+                                      [percentiles[day] for day in days]))
+
+    total_time = perf_counter() - start_time
+    print(f'Wrote {len(filenames)} reports in {total_time:.2f}s '
+          f'(query {query_time:.2f}s, {len(filenames) / total_time:.1f} reports/s)')
+
+    return filenames
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='Regenerates the daily reports for a range of days')
+    parser.add_argument('start_date', type=date.fromisoformat, help='first day, YYYY-MM-DD')
+    parser.add_argument('end_date', type=date.fromisoformat, help='last day, YYYY-MM-DD')
+    parser.add_argument('--workers', type=int, help='processes rendering reports')
+    args = parser.parse_args()
+
+    backfill_reports(args.start_date, args.end_date, args.workers)
@@ -0,0 +1,84 @@
+"""Reports how many bytes the report and dashboard queries scan.
+Run with QUERY_BACKEND=duckdb and DATASET_PATH to check a local copy of the dataset,
+or against Athena to see what the queries are billed for. With --max-bytes the run
+fails if any partition-filtered query scans more than the limit"""
+import sys
+from argparse import ArgumentParser
+from datetime import date, timedelta
+from dotenv import load_dotenv
+from truck_common.query_backend import get_backend
+from truck_common.query_builder import build_rollup_query, get_date_filter
+
+DASHBOARD_DAYS_SHOWN = 30
+
+
+def get_legacy_report_query(report_date: date) -> str:
+    """Returns the report query as it was written before the query builder, casting
+    the partition columns so every partition has to be read to compare them"""
+    return f"""
+        SELECT
+            truck.truck_name,
+            payment_method.payment_method,
+            transaction_rollup.hour,
+            transaction_rollup.transaction_count,
+            transaction_rollup.total_value
+        FROM transaction_rollup
+        JOIN truck
+            ON truck.truck_id = transaction_rollup.truck_id
+        JOIN payment_method
+            ON payment_method.payment_method_id = transaction_rollup.payment_method_id
+        WHERE CAST(year AS int) = {report_date.year}
+        AND CAST(month AS int) = {report_date.month}
+        AND CAST(day AS int) = {report_date.day};
+    """
+
+
+def get_benchmark_queries(report_date: date) -> dict[str, tuple[str, bool]]:
+    """Returns each query to measure and whether it should be partition filtered"""
+    dashboard_start = report_date - timedelta(days=DASHBOARD_DAYS_SHOWN)
+    return {
+        "report (legacy casts)": (get_legacy_report_query(report_date), False),
+        "report": (build_rollup_query(['truck_name', 'payment_method', 'hour'],
+                                      report_date, report_date), True),
+        "dashboard hourly": (build_rollup_query(
+            ['year', 'month', 'day', 'payment_method', 'truck_name', 'hour'],
+            dashboard_start, report_date), True),
+        "dashboard daily": (build_rollup_query(
+            ['year', 'month', 'day', 'payment_method', 'truck_name'],
+            dashboard_start, report_date), True),
+        "truck totals": (f"""
+            SELECT truck_id, SUM(transaction_count) AS count
+            FROM transaction_rollup
+            WHERE {get_date_filter(dashboard_start, report_date)}
+            GROUP BY truck_id;
+        """, True)
+    }
+
+
+def run_benchmark(report_date: date, max_bytes: int | None = None) -> bool:
+    """Prints the bytes each query scans. Returns False if a filtered query is over max_bytes"""
+    backend = get_backend()
+    within_limit = True
+
+    for name, (sql_query, is_filtered) in get_benchmark_queries(report_date).items():
+        bytes_scanned = backend.get_bytes_scanned(sql_query)
+        over_limit = is_filtered and max_bytes is not None and bytes_scanned > max_bytes
+        within_limit = within_limit and not over_limit
+        print(f'{name:<24}{bytes_scanned:>14,} bytes{"  OVER LIMIT" if over_limit else ""}')
+
+    return within_limit
+
+
+if __name__ == '__main__':
+    load_dotenv()
+
+    parser = ArgumentParser(description='Reports the bytes scanned by the truck queries')
+    parser.add_argument('--date', type=date.fromisoformat,
+                        default=date.today() - timedelta(days=1),
+                        help='day the report is for, defaulting to yesterday')
+    parser.add_argument('--max-bytes', type=int,
+                        help='fail if a partition filtered query scans more than this')
+    args = parser.parse_args()
+
+    if not run_benchmark(args.date, args.max_bytes):
+        sys.exit(1)
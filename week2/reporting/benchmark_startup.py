@@ -0,0 +1,83 @@
+"""Measures the Lambda's import time and the latency of its first and second invocations.
+Each run is a fresh interpreter, like a cold Lambda container. The query backend is
+replaced by a stub that waits a fixed time before returning made up rollup or sketch
+rows, so no AWS access is needed"""
+import json
+import subprocess
+import sys
+from argparse import ArgumentParser
+from os import environ, path
+from statistics import median
+from tempfile import TemporaryDirectory
+
+STUB_QUERY_SECONDS = 1.0
+
+CHILD_SCRIPT = """
+import json, sys
+from time import perf_counter, sleep
+
+start = perf_counter()
+import generate_report
+import_seconds = perf_counter() - start
+heavy_modules_imported = [name for name in ('pandas', 'boto3', 'awswrangler', 'duckdb')
+                          if name in sys.modules]
+
+
+class StubBackend:
+    def query(self, sql_query):
+        import pandas as pd
+
+        sleep(float(sys.argv[1]))
+        if 'transaction_sketch' in sql_query:
+            return pd.DataFrame([
+                {"truck_name": f'Truck {truck}', "mean": float(price), "weight": truck * 10}
+                for truck in range(1, 7) for price in (499, 700, 850, 1299)
+            ])
+        return pd.DataFrame([
+            {"truck_name": f'Truck {truck}', "payment_method": payment_method, "hour": str(hour),
+             "transaction_count": truck + hour, "total_value": (truck + hour) * 850}
+            for truck in range(1, 7) for payment_method in ('cash', 'card')
+            for hour in range(8, 21)
+        ])
+
+
+generate_report.get_backend = lambda *args, **options: StubBackend()
+
+invocations = []
+for _ in range(2):
+    start = perf_counter()
+    generate_report.lambda_handler({}, {})
+    invocations.append(perf_counter() - start)
+
+print(json.dumps({"import": import_seconds, "first": invocations[0],
+                  "second": invocations[1], "heavy_modules": heavy_modules_imported}))
+"""
+
+
+def run_cold_start(stub_query_seconds: float, dataset_path: str) -> dict:
+    """Runs one cold start and two invocations in a new interpreter and returns the timings"""
+    env = {**environ, "DATASET_PATH": dataset_path,
+           "ACCESS_KEY_ID": 'benchmark', "SECRET_ACCESS_KEY": 'benchmark'}
+    result = subprocess.run(
+        [sys.executable, '-c', CHILD_SCRIPT, str(stub_query_seconds)],
+        cwd=path.dirname(path.abspath(__file__)), env=env,
+        capture_output=True, text=True, check=True
+    )
+
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='Benchmarks the report Lambda\'s cold and warm starts')
+    parser.add_argument('--runs', type=int, default=3, help='cold starts to take the median of')
+    parser.add_argument('--query-seconds', type=float, default=STUB_QUERY_SECONDS,
+                        help='time the stubbed query takes')
+    args = parser.parse_args()
+
+    with TemporaryDirectory() as empty_dataset:
+        runs = [run_cold_start(args.query_seconds, empty_dataset) for _ in range(args.runs)]
+
+    print(f'Heavy modules imported at start up: {runs[0]["heavy_modules"] or "none"}')
+    for name in ['import', 'first', 'second']:
+        print(f'{name + " invocation" if name != "import" else "import":<20}'
+              f'{median(run[name] for run in runs) * 1000:>10.1f} ms')
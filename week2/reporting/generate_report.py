@@ -1,154 +1,433 @@
-# pylint: disable = W0613
-"""Generates a daily T3 report of yesterdays truck transactions.
-Configured to work as an AWS lambda function"""
-from os import environ
-from datetime import datetime
-import awswrangler as wr
-import pandas as pd
-import boto3
+# pylint: disable = W0613, C0415
+"""Generates a daily T3 report of yesterdays truck transactions, and one for each truck.
+Configured to work as an AWS lambda function. pandas, boto3 and awswrangler are
+only imported when a report has to be built, and the session, clients and built
+reports are kept at module level so warm invocations reuse them"""
+from __future__ import annotations
+import re
+from argparse import ArgumentParser
+from os import environ, walk, path
+from collections import OrderedDict
+from dataclasses import dataclass
+from datetime import datetime, date, timedelta
+from functools import lru_cache
+from hashlib import sha1
+from html import escape
+from string import Template
+from typing import TYPE_CHECKING
 from dotenv import load_dotenv
+from truck_common.query_backend import DEFAULT_DATASET_PATH, get_backend
+from truck_common.query_builder import build_rollup_query, build_sketch_query
+from truck_common.instrumentation import stage
 
-DATABASE_NAME = 'c20-sami-truck-database'
-
-def query_highest_transaction_truck() -> pd.DataFrame:
-    """Returns a dataframe of the food trucks sorted by total transactions"""
-    load_dotenv()
-
-    sql_query = """
-        SELECT
-            transaction.transaction_id,
-            truck.truck_name,
-            transaction.total,
-            payment_method.payment_method,
-            transaction.at
-        FROM transaction
-        JOIN truck
-            ON truck.truck_id = transaction.truck_id
-        JOIN payment_method
-            ON payment_method.payment_method_id = transaction.payment_method_id
-        WHERE CAST(year AS int) = year(date_add('day', -1, current_date))
-        AND CAST(month AS int) = month(date_add('day', -1, current_date))
-        AND CAST(day AS int) = day(date_add('day', -1, current_date));
-    """
-
-    session = boto3.Session(aws_access_key_id=environ["ACCESS_KEY_ID"],
-                            aws_secret_access_key=environ["SECRET_ACCESS_KEY"],
-                            region_name='eu-west-2')
-
-    return wr.athena.read_sql_query(
-        sql_query, DATABASE_NAME, boto3_session=session, ctas_approach=False).drop_duplicates()
-
-
-def get_total_transaction_value(df: pd.DataFrame) -> float:
-    """Returns the total value of all transactions in the given dataframe"""
-    return df['total'].sum()
-
-
-def get_total_transaction_number(df: pd.DataFrame) -> int:
-    """Returns the number of transactions in the given dataframe"""
-    return df.size
-
-
-def get_transactions_per_truck(df: pd.DataFrame) -> pd.DataFrame:
-    """Returns a dataframe of the number of transactions per truck"""
-    return (
-        df.groupby('truck_name')
-        .size()
-        .reset_index(name='transaction_count')
-        .sort_values(by='transaction_count', ascending=False)
-    )
-
-
-def get_transaction_value_per_truck(df: pd.DataFrame) -> pd.DataFrame:
-    """Returns a dataframe of the total revenue per truck"""
-    return (
-        df.groupby('truck_name')['total']
-        .sum()
-        .reset_index(name='total_value')
-        .sort_values(by='total_value', ascending=False)
-    )
-
-
-def generate_daily_report(all_data: pd.DataFrame) -> None:
-    """Queries the truck database to generate a daily report"""
-    today = datetime.today().date()
-    total_revenue = get_total_transaction_value(all_data)
-    number_of_sales = get_total_transaction_number(all_data)
-    number_of_sales_per_truck = get_transactions_per_truck(all_data)
-    revenue_per_truck = get_transaction_value_per_truck(all_data)
-
-    report_data = {
-        "date": today,
-        "total_revenue": total_revenue,
-        "number_of_sales": number_of_sales,
-        "number_of_sales_per_truck": number_of_sales_per_truck, #.to_dict(orient='records'),
-        "revenue_per_truck": revenue_per_truck #.to_dict(orient='records')
-    }
+if TYPE_CHECKING:
+    import boto3
+    import pandas as pd
 
-    return report_data
+DATABASE_NAME = 'c20-sami-truck-database'
+ROLLUP_DATASET_DIR = 'transaction_rollup/transaction_rollup.parquet'
+MAX_CACHED_REPORTS = 8
+COMPANY_REPORT_KEY = 'company'
 
+REPORT_GROUP_COLUMNS = ['truck_name', 'payment_method', 'hour']
 
-def generate_html_text(report_data: dict) -> str:
-    """Generates a formatted html report for the given data"""
-    html_text = f"""
+# Parsed once per container and filled in for the company report and every truck's
+REPORT_TEMPLATE = Template("""
         <head>
-            <title>T3 DAILY REPORT</title>
+            <title>$title</title>
         </head>
         <style>
-            table {{
+            table {
                 border-collapse: collapse;
                 width: 100%;
                 margin-bottom: 20px;
-            }}
-            th, td {{
+            }
+            th, td {
                 border: 1px solid #999;
                 padding: 8px;
                 text-align: left;
-            }}
-            th {{
+            }
+            th {
                 background-color: #f2f2f2;
-            }}
+            }
         </style>
         <body style="font-family: Arial;">
             <center>
-            <h1>T3 DAILY REPORT</h1>
-            <p>{report_data.get('date')}</p>
+            <h1>$title</h1>
+            <p>$date</p>
 
             <h2>Key Metrics</h2>
 
-            <li>Total Transactions: {report_data.get('number_of_sales')}</li>
-            <li>Total Revenue: £{report_data.get('total_revenue')/100}</li>
-
-            <h2>Trucks</h2>
-            <h3>Number Of Sales Per Truck</h3>
-            {report_data.get('number_of_sales_per_truck').to_html(index=False)}
-            <h3>Total Revenue Per Truck</h3>
-            {report_data.get('revenue_per_truck').to_html(index=False)}
+            <li>Total Transactions: $number_of_sales</li>
+            <li>Total Revenue: £$total_revenue</li>
+            <li>Average Transaction Value: £$average_transaction_value</li>
+$sections
             </center>
         </body>
-    """
+    """)
+TABLE_TEMPLATE = Template("""<table border="1" class="dataframe">
+<thead><tr style="text-align: right;">$header</tr></thead>
+<tbody>
+$rows
+</tbody>
+</table>""")
+SECTION_TEMPLATE = Template("""
+            <h2>$heading</h2>
+            <h3>$table_heading</h3>
+            $table""")
+
+report_cache = OrderedDict()
+
+
+@lru_cache
+def get_session() -> boto3.Session:
+    """Returns the boto3 session, created once per Lambda container"""
+    import boto3
+
+    load_dotenv()
+    return boto3.Session(aws_access_key_id=environ["ACCESS_KEY_ID"],
+                         aws_secret_access_key=environ["SECRET_ACCESS_KEY"],
+                         region_name='eu-west-2')
+
+
+@lru_cache
+def get_s3_client():
+    """Returns an S3 client from the shared session"""
+    return get_session().client('s3')
+
 
-    return html_text
+def get_report_backend():
+    """Returns the query backend, giving Athena the report's session and options.
+    Only Athena needs the AWS credentials, so reports can be made offline with DuckDB"""
+    if environ.get('QUERY_BACKEND', 'athena') == 'athena':
+        return get_backend('athena', database=DATABASE_NAME, boto3_session=get_session(),
+                           ctas_approach=False)
 
+    return get_backend()
+
+
+def get_data_version(report_date: date) -> str:
+    """Returns a fingerprint of the rollup files for the day, which changes whenever
+    the pipeline or compaction rewrites that day's data"""
+    dataset_path = environ.get('DATASET_PATH', DEFAULT_DATASET_PATH).rstrip('/')
+    day_path = (f'{dataset_path}/{ROLLUP_DATASET_DIR}/year={report_date.year}'
+                f'/month={report_date.month}/day={report_date.day}/')
+
+    if day_path.startswith('s3://'):
+        bucket, prefix = day_path.removeprefix('s3://').split('/', 1)
+        paginator = get_s3_client().get_paginator('list_objects_v2')
+        files = [
+            f'{file["Key"]}:{file["ETag"]}'
+            for page in paginator.paginate(Bucket=bucket, Prefix=prefix)
+            for file in page.get('Contents', [])
+        ]
+    else:
+        files = [
+            f'{path.join(directory, filename)}:{path.getmtime(path.join(directory, filename))}'
+            for directory, _, filenames in walk(day_path) for filename in filenames
+        ]
+
+    return sha1('\n'.join(sorted(files)).encode('utf-8')).hexdigest()
+
+
+def query_report_data(start_date: date, end_date: date,
+                      group_columns: list[str] = None) -> pd.DataFrame:
+    """Returns the hourly transaction counts and values per truck and payment method
+    between the dates, reading only the partitions in that range"""
+    sql_query = build_rollup_query(group_columns or REPORT_GROUP_COLUMNS, start_date, end_date)
+
+    return get_report_backend().query(sql_query)
+
+
+def query_sale_value_percentiles(start_date: date, end_date: date,
+                                 group_columns: list[str] = None) -> pd.DataFrame:
+    """Returns the median and 95th percentile sale value per truck between the dates,
+    merged from the hourly sketches of the partitions in that range"""
+    from truck_common.quantile_sketch import get_percentiles
+
+    group_columns = group_columns or ['truck_name']
+    centroids = get_report_backend().query(
+        build_sketch_query(group_columns, start_date, end_date))
+
+    return get_percentiles(centroids, group_columns)
+
+
+def query_highest_transaction_truck() -> pd.DataFrame:
+    """Returns yesterday's hourly transaction counts and values per truck and payment method"""
+    yesterday = date.today() - timedelta(days=1)
+    return query_report_data(yesterday, yesterday)
+
+
+@dataclass(frozen=True)
+class ReportMetrics:
+    """The figures shown in the daily report"""
+    date: date
+    total_revenue: int
+    number_of_sales: int
+    average_transaction_value: float
+    sales_per_truck: pd.DataFrame
+    sales_per_payment_method: pd.DataFrame
+    sale_value_percentiles: pd.DataFrame | None = None
+
+
+def add_average_value(df: pd.DataFrame) -> pd.DataFrame:
+    """Returns the counts and values sorted by value with the average value of a sale added"""
+    import pandas as pd
+
+    return df.astype({"transaction_count": 'int64'}).assign(
+        average_value=(df['total_value'] / df['transaction_count'].replace(0, pd.NA)).fillna(0)
+    ).sort_values(by='total_value', ascending=False).reset_index()
+
+
+def compute_report_metrics(df: pd.DataFrame, report_date: date,
+                           percentiles_df: pd.DataFrame | None = None) -> ReportMetrics:
+    """Returns every report metric from one grouped pass over the data.
+    The rows are summed per truck and payment method once, and the totals and
+    breakdowns are all taken from that small table"""
+    grouped = df.groupby(['truck_name', 'payment_method'], observed=True, sort=False)[
+        ['transaction_count', 'total_value']].sum()
+    number_of_sales = int(grouped['transaction_count'].sum())
+    total_revenue = int(grouped['total_value'].sum())
+
+    return ReportMetrics(
+        date=report_date,
+        total_revenue=total_revenue,
+        number_of_sales=number_of_sales,
+        average_transaction_value=total_revenue / number_of_sales if number_of_sales else 0,
+        sales_per_truck=add_average_value(grouped.groupby(level='truck_name').sum()),
+        sales_per_payment_method=add_average_value(grouped.groupby(level='payment_method').sum()),
+        sale_value_percentiles=percentiles_df
+    )
 
-def save_html_report_to_file(html_text: str) -> None:
-    """Saves the given html string to an html file with today's date as a name"""
-    with open(f'report_data_{datetime.today().date()}.html', 'w', encoding='utf-8') as f:
+
+def generate_daily_report(all_data: pd.DataFrame,
+                          percentiles_df: pd.DataFrame | None = None) -> ReportMetrics:
+    """Computes the metrics for the daily report from the queried truck data"""
+    return compute_report_metrics(all_data, datetime.today().date(), percentiles_df)
+
+
+@dataclass(frozen=True)
+class TruckReportMetrics:
+    """The figures shown in one truck's daily report"""
+    truck_name: str
+    date: date
+    total_revenue: int
+    number_of_sales: int
+    average_transaction_value: float
+    sales_per_payment_method: pd.DataFrame
+    sales_per_hour: pd.DataFrame
+
+
+def compute_truck_report_metrics(df: pd.DataFrame,
+                                 report_date: date) -> dict[str, TruckReportMetrics]:
+    """Returns the report metrics of every truck from one grouped pass over the data.
+    The rows are summed per truck, payment method and hour once, and each truck's
+    totals and breakdowns are split out of that small table"""
+    import pandas as pd
+
+    grouped = df.assign(hour=pd.to_numeric(df['hour'])).groupby(
+        ['truck_name', 'payment_method', 'hour'], observed=True, sort=False)[
+        ['transaction_count', 'total_value']].sum()
+    totals = grouped.groupby(level='truck_name', observed=True).sum()
+    payment_method_tables = dict(iter(add_average_value(
+        grouped.groupby(level=['truck_name', 'payment_method'], observed=True).sum()
+    ).groupby('truck_name', observed=True, sort=False)))
+    hour_tables = dict(iter(add_average_value(
+        grouped.groupby(level=['truck_name', 'hour'], observed=True).sum()
+    ).sort_values('hour').groupby('truck_name', observed=True, sort=False)))
+
+    return {
+        str(truck_name): TruckReportMetrics(
+            truck_name=str(truck_name),
+            date=report_date,
+            total_revenue=int(row['total_value']),
+            number_of_sales=int(row['transaction_count']),
+            average_transaction_value=(row['total_value'] / row['transaction_count']
+                                       if row['transaction_count'] else 0),
+            sales_per_payment_method=payment_method_tables[truck_name].drop(columns='truck_name'),
+            sales_per_hour=hour_tables[truck_name].drop(columns='truck_name')
+        )
+        for truck_name, row in totals.iterrows()
+    }
+
+
+def format_money_table(df: pd.DataFrame) -> str:
+    """Returns the table as html with its pence columns shown in pounds"""
+    labels = df.drop(columns=['transaction_count', 'total_value', 'average_value'])
+    header = ''.join(f'<th>{escape(str(column))}</th>' for column in
+                     [*labels.columns, 'number_of_sales', 'revenue', 'average_sale'])
+    rows = '\n'.join(
+        '<tr>' + ''.join(f'<td>{escape(str(label))}</td>' for label in row[:-3])
+        + f'<td>{row[-3]}</td><td>{row[-2] / 100:.2f}</td><td>{row[-1] / 100:.2f}</td></tr>'
+        for row in zip(*(labels[column] for column in labels.columns), df['transaction_count'],
+                       df['total_value'], df['average_value'])
+    )
+
+    return TABLE_TEMPLATE.substitute(header=header, rows=rows)
+
+
+def format_percentile_table(df: pd.DataFrame) -> str:
+    """Returns the table of percentiles as html with the values shown in pounds"""
+    value_columns = [column for column in df.columns if re.fullmatch(r'p[\d.]+', column)]
+    labels = df.drop(columns=value_columns)
+    header = ''.join(f'<th>{escape(str(column))}</th>' for column in [*labels.columns,
+                                                                       *value_columns])
+    rows = '\n'.join(
+        '<tr>' + ''.join(f'<td>{escape(str(label))}</td>' for label in row[:len(labels.columns)])
+        + ''.join(f'<td>{value / 100:.2f}</td>' for value in row[len(labels.columns):]) + '</tr>'
+        for row in zip(*(df[column] for column in [*labels.columns, *value_columns]))
+    )
+
+    return TABLE_TEMPLATE.substitute(header=header, rows=rows)
+
+
+def format_report_html(title: str, report_date: date, total_revenue: int, number_of_sales: int,
+                       average_transaction_value: float,
+                       sections: list[tuple[str, str, str]]) -> str:
+    """Fills the report template. Each section is a heading, a table heading and the table"""
+    return REPORT_TEMPLATE.substitute(
+        title=title,
+        date=report_date,
+        number_of_sales=number_of_sales,
+        total_revenue=total_revenue / 100,
+        average_transaction_value=f'{average_transaction_value / 100:.2f}',
+        sections=''.join(SECTION_TEMPLATE.substitute(heading=heading, table_heading=table_heading,
+                                                     table=table)
+                         for heading, table_heading, table in sections)
+    )
+
+
+def generate_html_text(report_data: ReportMetrics) -> str:
+    """Generates a formatted html report for the given data"""
+    sections = [('Trucks', 'Sales Per Truck', format_money_table(report_data.sales_per_truck)),
+                ('Payment Methods', 'Sales Per Payment Method',
+                 format_money_table(report_data.sales_per_payment_method))]
+    if report_data.sale_value_percentiles is not None:
+        sections.append(('Sale Values', 'Sale Value Percentiles Per Truck',
+                         format_percentile_table(report_data.sale_value_percentiles)))
+
+    return format_report_html(
+        'T3 DAILY REPORT', report_data.date, report_data.total_revenue,
+        report_data.number_of_sales, report_data.average_transaction_value, sections
+    )
+
+
+def generate_truck_html_text(report_data: TruckReportMetrics) -> str:
+    """Generates a formatted html report for one truck's data"""
+    return format_report_html(
+        f'{report_data.truck_name.upper()} DAILY REPORT', report_data.date,
+        report_data.total_revenue, report_data.number_of_sales,
+        report_data.average_transaction_value,
+        [('Payment Methods', 'Sales Per Payment Method',
+          format_money_table(report_data.sales_per_payment_method)),
+         ('Hours', 'Sales Per Hour', format_money_table(report_data.sales_per_hour))]
+    )
+
+
+def generate_report_set(report_date: date, max_workers: int = 1) -> dict[str, str]:
+    """Returns the company report and every truck's report for the day, keyed by
+    COMPANY_REPORT_KEY or the truck's name, from one query and one grouped pass.
+    With more than one worker the truck reports are rendered in a pool of processes,
+    which Lambda doesn't support"""
+    with stage('report_set', report_date=report_date) as metrics:
+        data = query_report_data(report_date, report_date)
+        truck_metrics = compute_truck_report_metrics(data, report_date)
+
+        if max_workers > 1:
+            from concurrent.futures import ProcessPoolExecutor
+
+            with ProcessPoolExecutor(max_workers=max_workers) as executor:
+                truck_reports = list(executor.map(generate_truck_html_text,
+                                                  truck_metrics.values()))
+        else:
+            truck_reports = [generate_truck_html_text(truck) for truck in truck_metrics.values()]
+
+        reports = {
+            COMPANY_REPORT_KEY: generate_html_text(compute_report_metrics(
+                data, report_date, query_sale_value_percentiles(report_date, report_date))),
+            **dict(zip(truck_metrics, truck_reports))
+        }
+        metrics['rows_in'] = len(data)
+        metrics['reports'] = len(reports)
+        metrics['bytes_written'] = sum(len(html.encode('utf-8')) for html in reports.values())
+
+        return reports
+
+
+def save_report_set(reports: dict[str, str], report_date: date) -> list[str]:
+    """Saves each report of the set to its own html file. Returns the files' names"""
+    filenames = []
+    for name, html_text in reports.items():
+        filename = f'report_data_{report_date}.html'
+        if name != COMPANY_REPORT_KEY:
+            filename = f'report_data_{report_date}_{re.sub(r"[^a-z0-9]+", "_", name.lower())}.html'
+        with open(filename, 'w', encoding='utf-8') as f:
+            f.write(html_text)
+        filenames.append(filename)
+
+    return filenames
+
+
+def save_html_report_to_file(html_text: str, report_date: date | None = None) -> str:
+    """Saves the given html string to an html file named with the report's date,
+    today by default. Returns the file's name"""
+    filename = f'report_data_{report_date or datetime.today().date()}.html'
+    with open(filename, 'w', encoding='utf-8') as f:
         f.write(html_text)
 
+    return filename
+
+
+def get_report_html(report_date: date) -> str:
+    """Returns the html report for the day, reusing one already built in this container
+    unless the day's data has changed since"""
+    with stage('report', report_date=report_date) as metrics:
+        key = (report_date, get_data_version(report_date))
+        metrics['cache_hit'] = key in report_cache
+        if key in report_cache:
+            report_cache.move_to_end(key)
+            return report_cache[key]
 
-def lambda_handler(event: dict, context: dict) -> dict[str, str]:
-    """The entry point for the AWS Lambda"""
-    data = query_highest_transaction_truck()
-    formatted_data = generate_daily_report(data)
-    html_text = generate_html_text(formatted_data)
+        data = query_report_data(report_date, report_date)
+        html_text = generate_html_text(generate_daily_report(
+            data, query_sale_value_percentiles(report_date, report_date)))
+        metrics['rows_in'] = len(data)
+        metrics['bytes_written'] = len(html_text.encode('utf-8'))
 
-    return {"html": html_text}
+        report_cache[key] = html_text
+        if len(report_cache) > MAX_CACHED_REPORTS:
+            report_cache.popitem(last=False)
+
+        return html_text
+
+
+def lambda_handler(event: dict, context: dict) -> dict:
+    """The entry point for the AWS Lambda. An event with "per_truck" set also returns
+    each truck's report, keyed by truck name"""
+    yesterday = date.today() - timedelta(days=1)
+    if event.get('per_truck'):
+        reports = generate_report_set(yesterday)
+        return {"html": reports.pop(COMPANY_REPORT_KEY), "truck_reports": reports}
+
+    return {"html": get_report_html(yesterday)}
 
 
 if __name__ == '__main__':
-    truck_data = query_highest_transaction_truck()
-    print(truck_data)
-    formatted_truck_data = generate_daily_report(truck_data)
-    output_html = generate_html_text(formatted_truck_data)
-    save_html_report_to_file(output_html)
+    parser = ArgumentParser(description="Generates the daily report of yesterday's transactions")
+    parser.add_argument('--per-truck', action='store_true',
+                        help="also write each truck's report")
+    parser.add_argument('--workers', type=int, default=1,
+                        help='processes rendering the truck reports')
+    args = parser.parse_args()
+
+    if args.per_truck:
+        report_day = date.today() - timedelta(days=1)
+        print(save_report_set(generate_report_set(report_day, args.workers), report_day))
+    else:
+        truck_data = query_highest_transaction_truck()
+        print(truck_data)
+        report_day = date.today() - timedelta(days=1)
+        formatted_truck_data = generate_daily_report(
+            truck_data, query_sale_value_percentiles(report_day, report_day))
+        output_html = generate_html_text(formatted_truck_data)
+        save_html_report_to_file(output_html)
@@ -0,0 +1,12 @@
+"""Smoke test for the start up benchmark, run with pytest from this directory"""
+from tempfile import TemporaryDirectory
+from benchmark_startup import run_cold_start
+
+
+def test_run_cold_start_times_both_invocations():
+    """The stubbed Lambda runs end to end and reports every timing"""
+    with TemporaryDirectory() as empty_dataset:
+        timings = run_cold_start(0, empty_dataset)
+
+    assert set(timings) == {'import', 'first', 'second', 'heavy_modules'}
+    assert all(timings[name] >= 0 for name in ['import', 'first', 'second'])